@@ -0,0 +1,41 @@
+# Measures the route lookup latency of koa.common.router() for growing numbers of
+# routes, which should stay flat (the lookup walks a trie of path components instead
+# of trying every route in turn). Also measures repeated lookups of the same path, 
+# which are served by the router's match cache.
+# Usage: python benchmarks/router_benchmark.py
+
+import asyncio
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import koa.common
+
+@asyncio.coroutine
+def handler(koa_context, next):
+  koa_context.response.body = "ok"
+
+def create_router(route_count):
+  router = koa.common.router()
+  for i in range(route_count):
+    router.get('/api/v1/resource{}/:id'.format(i), handler)
+    router.post('/api/v1/resource{}'.format(i), handler)
+  return router
+
+# returns the seconds per lookup, for both uncached (trie) and cached lookups
+def benchmark(route_count, lookups=100000):
+  router = create_router(route_count // 2)
+  router.compile()
+  # a path matching the last route registered, which was the worst case for a linear scan
+  path = '/api/v1/resource{}/123'.format(route_count // 2 - 1)
+  assert len(router.find_routes('GET', path)) == 1
+  uncached = min(timeit.repeat(lambda: router.find_routes('GET', path), number=lookups, repeat=3))
+  cached = min(timeit.repeat(lambda: router.match('GET', path), number=lookups, repeat=3))
+  return (uncached / lookups, cached / lookups)
+
+if __name__ == '__main__':
+  print('{:>8} {:>14} {:>14}'.format('routes', 'us per lookup', 'us cached'))
+  for route_count in (10, 100, 1000, 10000):
+    (uncached, cached) = benchmark(route_count)
+    print('{:>8} {:>14.3f} {:>14.3f}'.format(route_count, uncached * 1e6, cached * 1e6))
@@ -5,6 +5,7 @@ import aiohttp
 import aiohttp.server
 import os
 import pdb
+import koa
 import koa.core
 import koa.common
 
@@ -32,7 +33,7 @@ def handle_get_user(koa_context, next):
 # handles post to /users
 @asyncio.coroutine
 def handle_post_user(koa_context, next):
-  user = koa_context.request.body    # this requires app.use(koa.common.body_parser)
+  user = yield from koa_context.request.json()    # this requires app.use(koa.common.lazy_body_parser) or body_parser
   assert(isinstance(user, dict)) # POSTed JSON
   print("posted user:", user)
   users.append(user)
@@ -58,7 +59,7 @@ def create_app():
   # compose the koa app
   app = koa.core.app()
   app.use(koa.common.logger)
-  app.use(koa.common.body_parser)
+  app.use(koa.common.lazy_body_parser) # only reads request bodies if a handler asks for them
   router = koa.common.router()
   router.get("/admin/version", handle_get_version)
   app.use(router.middleware())
@@ -74,15 +75,12 @@ def run_server_forever():
   # compose the koa app
   app = create_app()
 
-  # serve the koa app via asyncio http server
-  loop = asyncio.get_event_loop()
+  # serve the koa app via asyncio http server. This defaults to a single process since the
+  # users list lives in process memory: with several worker processes a POST and a later 
+  # GET may hit different workers (see 'Running on multiple cores' in readme.md).
   port = int(os.environ.get('PORT', 8480)) # for Heroku, which sets env var PORT before it spawns your web process
-  srv = loop.run_until_complete(loop.create_server(app.get_http_request_handler, '0.0.0.0', port))
-  print('serving on', srv.sockets[0].getsockname())
-  try:
-    loop.run_forever()
-  except KeyboardInterrupt:
-    pass
+  workers = int(os.environ.get('WEB_CONCURRENCY', 1))
+  koa.serve(app, port=port, workers=workers)
 
 if __name__ == '__main__':
   run_server_forever()
@@ -30,7 +30,8 @@ def run_server_forever():
   try:
     loop.run_forever()
   except KeyboardInterrupt:
-    pass
+    # let in-flight requests finish (for up to 10 seconds) before exiting
+    loop.run_until_complete(app.shutdown(srv, timeout=10))
 
 if __name__ == '__main__':
   run_server_forever()
@@ -0,0 +1 @@
+from koa.server import serve
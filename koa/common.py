@@ -9,13 +9,27 @@
 import asyncio
 import aiohttp
 import time
+import math
 import datetime
 import pdb
-import json
 import os
 import os.path
 import urllib
 import base64
+import re
+import zlib
+import io
+import stat
+import hashlib
+import hmac
+import binascii
+import email.utils
+from wsgiref.handlers import format_date_time
+import tempfile
+import threading
+import collections
+import concurrent.futures
+import mimetypes
 import koa.core
 
 # koa.js-style middleware for logging request handling times.
@@ -26,8 +40,7 @@ def logger(koa_context, next):
 
   # logging at the beginning of a request is kinda spammy:
   #   print("request method={} path={}".format(koa_context.request.method, koa_context.request.path.path))
-  # Having a watchdog here would be nice to have though, something that logs if request handling didn't 
-  # complete within a certain period (e.g. 5 seconds), like Q.delay(5000, function() {"potentially stalled request..."})
+  # For logging requests that didn't complete within a certain period see watchdog() below.
 
   yield from next
   end_time = time.clock()
@@ -39,31 +52,906 @@ def logger(koa_context, next):
     durationInMs
   ))
 
+# Middleware logging potentially stalled requests: requests that didn't complete within
+# soft_timeout seconds get logged (once) together with the middleware they're stuck in,
+# like Q.delay(5000, function() {"potentially stalled request..."}). Unlike hard deadlines
+# (app.server_settings.request_timeout) this doesn't cancel anything.
+# Usage: app.use(koa.common.watchdog(5)), ideally as the first middleware.
+# param log is a func taking the message string
+def watchdog(soft_timeout=5, log=print):
+
+  def report_stalled_request(koa_context, start_time):
+    middleware = koa_context.active_middleware
+    log("{} potentially stalled request: {} {} running for {} ms, in middleware {}".format(
+      datetime.datetime.now().isoformat(),
+      koa_context.request.method,
+      koa_context.request.original_path.path,
+      round((time.time() - start_time) * 1000),
+      getattr(middleware, '__qualname__', middleware)
+    ))
+
+  @asyncio.coroutine
+  def watchdog_middleware(koa_context, next):
+    timer = asyncio.get_event_loop().call_later(soft_timeout, report_stalled_request, koa_context, time.time())
+    try:
+      yield from next
+    finally:
+      timer.cancel()
+
+  return watchdog_middleware
+
 # middleware similar to https://www.npmjs.org/package/koa-body-parser
 # Reads the aiohttp.streams.FlowControlStreamReader payload storing the result 
 # in koa_context.request.body. 
 # Parses payload as JSON if "Content-Type: application/json".
+# Bodies larger than max_size bytes are rejected with a 413, without reading them if
+# the Content-Length header already says they're too large. Middleware that wants to
+# process large bodies incrementally should read request.stream instead.
+# With lazy=True request.body becomes a koa.core.KoaLazyBody, which reads & decodes the 
+# payload only once a handler asks for it via 'yield from request.body' (or 'yield from 
+# request.json()'), so requests rejected by basic_auth() or unmatched routes never pay
+# for buffering & decoding their payload.
 # Example curl: curl --verbose -X POST -H "Content-Type: application/json" -d '{"foo":"xyz","bar":"xyz"}' http://localhost:8480/effective_config
-@asyncio.coroutine
-def body_parser(koa_context, next):
-  request = koa_context.request
-  if 'CONTENT-TYPE' in koa_context.request._message.headers: # typically POST, PUT have a payload, but it's valid for other requests like GET also
-
-    # Should we use aiohttp.protocol.HttpPayloadParser instead? How? Doing it manually for now:
-    content_type = koa_context.request._message.headers['CONTENT-TYPE'].split(';')
-    type = content_type[0]
-    encoding = content_type[1].split('=')[1] if len(content_type) >= 2 and content_type[1].startswith('charset=') else 'utf-8' # thats probably not general enough, TODO
-    lines = []
-    for i in range(0,10):
-      line = yield from koa_context.request.payload.readline()
-      if len(line) == 0:
-        break # is the the proper EOS?
-      lines.append(line.decode(encoding))
-    payload_string = "".join(lines)
-    koa_context.request.body = json.loads(payload_string) if type == 'application/json' else payload_string
-    #print("stored payload in request.body:", koa_context.request.body)
+# Usage: app.use(koa.common.create_body_parser(max_size=10*1024*1024))
+def create_body_parser(max_size=1024*1024, lazy=False):
 
-  yield from next
+  @asyncio.coroutine
+  def read_body(koa_context):
+    request = koa_context.request
+    stream = request.stream
+    length = request.length
+    if length != None:
+      if length > max_size:
+        koa_context.throw("request body too large", 413)
+      try:
+        return (yield from stream.readexactly(length))
+      except asyncio.IncompleteReadError:
+        koa_context.throw("incomplete request body", 400)
+    # no Content-Length, so chunked transfer encoding (or a body delimited by EOF)
+    chunks = []
+    size = 0
+    while True:
+      chunk = yield from stream.readany()
+      if len(chunk) == 0:
+        break
+      size += len(chunk)
+      if size > max_size:
+        koa_context.throw("request body too large", 413)
+      chunks.append(chunk)
+    return b"".join(chunks)
+
+  @asyncio.coroutine
+  def read_and_decode_body(koa_context):
+    request = koa_context.request
+    payload = yield from read_body(koa_context)
+    # decoders for JSON (and MessagePack/CBOR if installed) are registered in app.serializers
+    decode = koa_context.app.serializers.get_decoder(request.type) if koa_context.app != None else None
+    try:
+      return decode(payload, request.charset) if decode != None else payload.decode(request.charset or 'utf-8')
+    except (ValueError, LookupError): # e.g. invalid JSON, UnicodeDecodeError or an unknown charset
+      koa_context.throw("malformed request body", 400)
+
+  @asyncio.coroutine
+  def body_parser(koa_context, next):
+    request = koa_context.request
+    # typically POST, PUT have a payload, but it's valid for other requests like GET also.
+    # The body might have been parsed already, e.g. by form_parser
+    if 'CONTENT-TYPE' in request.headers and request.body == None:
+      if lazy:
+        request.body = koa.core.KoaLazyBody(lambda: read_and_decode_body(koa_context))
+      else:
+        request.body = yield from read_and_decode_body(koa_context)
+
+    yield from next
+
+  return body_parser
+
+# body_parser with the default max_size, usage: app.use(koa.common.body_parser)
+body_parser = create_body_parser()
+
+# body_parser decoding the payload on demand, usage: app.use(koa.common.lazy_body_parser),
+# then body = yield from koa_context.request.json() in handlers
+lazy_body_parser = create_body_parser(lazy=True)
+
+# matches the params of headers like Content-Type & Content-Disposition, e.g. 
+# '; name="file"; filename="a.txt"'
+_HEADER_PARAM_PATTERN = re.compile(r';\s*([^\s=;]+)\s*=\s*("(?:[^"\\]|\\.)*"|[^;]*)')
+
+# returns the dict of lowercase param names to values of a header value like
+# 'form-data; name="file"; filename="a.txt"'
+def parse_header_params(value):
+  params = {}
+  for (name, param_value) in _HEADER_PARAM_PATTERN.findall(value):
+    param_value = param_value.strip()
+    if param_value.startswith('"'):
+      param_value = re.sub(r'\\(.)', r'\1', param_value[1:-1])
+    name = name.lower()
+    if name.endswith('*'): # RFC 5987, e.g. filename*=UTF-8''na%C3%AFve.txt
+      (charset, _, encoded) = param_value.partition("''")
+      name = name[:-1]
+      param_value = urllib.parse.unquote(encoded, encoding=charset or 'utf-8')
+    params[name] = param_value
+  return params
+
+# A file field of a multipart/form-data upload as parsed by form_parser. Small files are 
+# kept in memory, larger ones get spooled to an anonymous temporary file, so the memory
+# an upload takes is bounded regardless of the file size.
+class UploadedFile:
+
+  def __init__(self, name, filename, content_type):
+    self.name = name               # the form field name
+    self.filename = filename       # as sent by the client, don't use it as a path without sanitizing it
+    self.content_type = content_type
+    self.size = 0
+    self.file = io.BytesIO()       # file-like object to read the content from, positioned at the start
+    self.is_spooled = False        # True if the content is on disk
+
+  def close(self):
+    self.file.close()
+
+# Parses a multipart/form-data body incrementally from request.stream, without buffering
+# more than a chunk of it, for handlers that want to process uploads on the fly:
+#   reader = koa.common.MultipartReader.from_request(koa_context.request)
+#   while True:
+#     part = yield from reader.next_part()
+#     if part == None:
+#       break
+#     chunk = yield from part.read_chunk() # b'' at the end of the part
+# Malformed bodies raise a KoaException with status 400, which koa answers as such.
+class MultipartReader:
+
+  MAX_HEADERS_SIZE = 16 * 1024
+
+  # param stream is the aiohttp stream reader, e.g. request.stream
+  # param boundary is the boundary param of the Content-Type header
+  # param max_size: max number of body bytes to read, None for unlimited, 413 if exceeded
+  def __init__(self, stream, boundary, max_size=None):
+    self._stream = stream
+    self._delimiter = b'\r\n--' + boundary.encode('latin-1')
+    self._buffer = bytearray(b'\r\n') # so that the 1st boundary looks like all others
+    self._size = 0
+    self._max_size = max_size
+    self._part = None          # the MultipartPart being read
+    self._is_eof = False       # True once the close delimiter was read
+
+  @staticmethod
+  def from_request(request, max_size=None):
+    if request.type != 'multipart/form-data':
+      raise koa.core.KoaException("expected multipart/form-data", 415)
+    boundary = parse_header_params(request.headers.get('CONTENT-TYPE')).get('boundary')
+    if not boundary:
+      raise koa.core.KoaException("multipart boundary missing", 400)
+    return MultipartReader(request.stream, boundary, max_size)
+
+  # reads the next chunk of the body into the buffer
+  @asyncio.coroutine
+  def _fill(self):
+    chunk = yield from self._stream.readany()
+    if len(chunk) == 0:
+      raise koa.core.KoaException("unexpected end of multipart body", 400)
+    self._size += len(chunk)
+    if self._max_size != None and self._size > self._max_size:
+      raise koa.core.KoaException("request body too large", 413)
+    self._buffer.extend(chunk)
+
+  # returns the next MultipartPart, or None after the last one. Skips whatever is left
+  # of the previous part.
+  @asyncio.coroutine
+  def next_part(self):
+    if self._part != None:
+      while len((yield from self._part.read_chunk())) > 0:
+        pass
+    if self._is_eof:
+      return None
+    # the buffer starts with the delimiter now (after the preamble for the 1st part)
+    while True:
+      index = self._buffer.find(self._delimiter)
+      if index >= 0 and len(self._buffer) >= index + len(self._delimiter) + 2:
+        break
+      if index < 0 and len(self._buffer) > len(self._delimiter):
+        del self._buffer[:len(self._buffer) - len(self._delimiter)] # preamble
+      yield from self._fill()
+    del self._buffer[:index + len(self._delimiter)]
+    if self._buffer.startswith(b'--'):
+      self._is_eof = True # close delimiter, whatever follows is the epilogue
+      self._part = None
+      return None
+    while True:
+      end_of_headers = self._buffer.find(b'\r\n\r\n')
+      if end_of_headers >= 0:
+        break
+      if len(self._buffer) > self.MAX_HEADERS_SIZE:
+        raise koa.core.KoaException("multipart headers too large", 400)
+      yield from self._fill()
+    # the delimiter line ends with (optional whitespace and) a CRLF, the headers follow
+    header_lines = self._buffer[:end_of_headers].decode('utf-8', 'replace').split('\r\n')[1:]
+    del self._buffer[:end_of_headers + 4]
+    headers = {}
+    for line in header_lines:
+      (name, _, value) = line.partition(':')
+      headers[name.strip().upper()] = value.strip()
+    self._part = MultipartPart(self, headers)
+    return self._part
+
+  # returns the next chunk of the current part's content, b'' at its end
+  @asyncio.coroutine
+  def _read_part_chunk(self):
+    while True:
+      index = self._buffer.find(self._delimiter)
+      if index >= 0:
+        # the part ends right before the delimiter, leave that for next_part()
+        chunk = bytes(self._buffer[:index])
+        del self._buffer[:index]
+        return chunk
+      # everything except a potential delimiter prefix at the end is content
+      available = len(self._buffer) - len(self._delimiter) + 1
+      if available > 0:
+        chunk = bytes(self._buffer[:available])
+        del self._buffer[:available]
+        return chunk
+      yield from self._fill()
+
+# A part of a multipart/form-data body, see MultipartReader
+class MultipartPart:
+
+  def __init__(self, reader, headers):
+    self._reader = reader
+    self._is_done = False
+    self.headers = headers # upper-case header names, like request.headers
+    disposition = parse_header_params(headers.get('CONTENT-DISPOSITION', ''))
+    self.name = disposition.get('name')
+    self.filename = disposition.get('filename')  # None for plain form fields
+    self.content_type = headers.get('CONTENT-TYPE', 'text/plain' if self.filename == None else 'application/octet-stream')
+
+  # returns the next chunk of the part's content, b'' at its end
+  @asyncio.coroutine
+  def read_chunk(self):
+    if self._is_done:
+      return b''
+    chunk = b''
+    while len(chunk) == 0:
+      chunk = yield from self._reader._read_part_chunk()
+      if len(chunk) == 0 and self._reader._buffer.startswith(self._reader._delimiter):
+        self._is_done = True
+        break
+    return chunk
+
+  # returns the whole content, 413 if it exceeds max_size bytes
+  @asyncio.coroutine
+  def read(self, max_size=None):
+    chunks = []
+    size = 0
+    while True:
+      chunk = yield from self.read_chunk()
+      if len(chunk) == 0:
+        return b''.join(chunks)
+      size += len(chunk)
+      if max_size != None and size > max_size:
+        raise koa.core.KoaException("form field too large", 413)
+      chunks.append(chunk)
+
+# middleware parsing multipart/form-data and application/x-www-form-urlencoded bodies
+# into request.body, a dict of field names to values: strs for plain fields and
+# UploadedFile instances for files (or lists of these for repeated field names).
+# A request's files are kept in memory up to spool_threshold bytes in total, beyond that
+# they get spooled to temp files (written in the executor). All files are closed once the
+# downstream middleware is done with the request.
+# Requests with other content types are left alone, so this combines with body_parser
+# (use form_parser first).
+# param max_field_size: max bytes per plain form field (and for urlencoded bodies) 
+# param max_fields_size: max bytes of all plain form fields of a multipart body together
+# param max_parts: max number of fields & files in a multipart body
+# param max_size: max total bytes of a multipart body, None for unlimited
+# param executor: a concurrent.futures.Executor for the file IO, None for the loop's default one
+# Exceeding a limit yields a 413, undecodable fields a 400. So the memory a request can
+# take is bounded by spool_threshold + max_fields_size, whatever max_size is.
+# Usage: app.use(koa.common.create_form_parser(spool_threshold=1024*1024, max_size=10*1024**3))
+def create_form_parser(spool_threshold=1024*1024, max_field_size=1024*1024, max_fields_size=2*1024*1024, max_parts=1000, max_size=None, executor=None):
+
+  def add_field(fields, name, value):
+    if name in fields:
+      existing = fields[name]
+      if not isinstance(existing, list):
+        fields[name] = existing = [existing]
+      existing.append(value)
+    else:
+      fields[name] = value
+
+  def spool(uploaded_file):
+    spooled = tempfile.TemporaryFile()
+    spooled.write(uploaded_file.file.getvalue())
+    return spooled
+
+  # reads the part into uploaded_file, spooling it once it exceeds memory_budget bytes
+  @asyncio.coroutine
+  def read_file(part, uploaded_file, memory_budget):
+    loop = asyncio.get_event_loop()
+    while True:
+      chunk = yield from part.read_chunk()
+      if len(chunk) == 0:
+        break
+      uploaded_file.size += len(chunk)
+      if uploaded_file.is_spooled:
+        yield from loop.run_in_executor(executor, uploaded_file.file.write, chunk)
+      else:
+        uploaded_file.file.write(chunk)
+        if uploaded_file.size > memory_budget:
+          spooled = yield from loop.run_in_executor(executor, spool, uploaded_file)
+          uploaded_file.file.close()
+          uploaded_file.file = spooled
+          uploaded_file.is_spooled = True
+    if uploaded_file.is_spooled:
+      yield from loop.run_in_executor(executor, uploaded_file.file.seek, 0)
+    else:
+      uploaded_file.file.seek(0)
+
+  @asyncio.coroutine
+  def parse_multipart(request, files):
+    fields = {}
+    reader = MultipartReader.from_request(request, max_size)
+    (part_count, fields_size, files_in_memory_size) = (0, 0, 0)
+    while True:
+      part = yield from reader.next_part()
+      if part == None:
+        return fields
+      part_count += 1
+      if part_count > max_parts:
+        raise koa.core.KoaException("too many form fields", 413)
+      if part.filename == None:
+        value = yield from part.read(max_field_size)
+        fields_size += len(value)
+        if fields_size > max_fields_size:
+          raise koa.core.KoaException("form fields too large", 413)
+        try:
+          add_field(fields, part.name, value.decode(parse_header_params(part.content_type).get('charset', 'utf-8')))
+        except (ValueError, LookupError): # UnicodeDecodeError or an unknown charset
+          raise koa.core.KoaException("malformed form field", 400)
+      else:
+        uploaded_file = UploadedFile(part.name, part.filename, part.content_type)
+        files.append(uploaded_file)
+        yield from read_file(part, uploaded_file, spool_threshold - files_in_memory_size)
+        if not uploaded_file.is_spooled:
+          files_in_memory_size += uploaded_file.size
+        add_field(fields, part.name, uploaded_file)
+
+  @asyncio.coroutine
+  def parse_urlencoded(request):
+    length = request.length
+    if length != None and length > max_field_size:
+      raise koa.core.KoaException("request body too large", 413)
+    chunks = []
+    size = 0
+    while True:
+      chunk = yield from request.stream.readany()
+      if len(chunk) == 0:
+        break
+      size += len(chunk)
+      if size > max_field_size:
+        raise koa.core.KoaException("request body too large", 413)
+      chunks.append(chunk)
+    try:
+      text = b''.join(chunks).decode(request.charset or 'utf-8')
+    except (ValueError, LookupError): # UnicodeDecodeError or an unknown charset
+      raise koa.core.KoaException("malformed request body", 400)
+    fields = {}
+    for (name, value) in urllib.parse.parse_qsl(text, keep_blank_values=True):
+      add_field(fields, name, value)
+    return fields
+
+  @asyncio.coroutine
+  def form_parser(koa_context, next):
+    request = koa_context.request
+    type = request.type
+    files = [] # the UploadedFiles to close after the request
+    try:
+      if type == 'multipart/form-data':
+        request.body = yield from parse_multipart(request, files)
+      elif type == 'application/x-www-form-urlencoded':
+        request.body = yield from parse_urlencoded(request)
+      yield from next
+    finally:
+      for uploaded_file in files:
+        uploaded_file.close()
+
+  return form_parser
+
+# form_parser with the default limits, usage: app.use(koa.common.form_parser)
+form_parser = create_form_parser()
+
+# matches the mime types worth compressing, e.g. text/html, application/json, image/svg+xml
+# (but not image/png, application/zip and so on which are compressed already)
+COMPRESSIBLE_TYPE_PATTERN = re.compile(r'^(text/.+|application/(json|javascript|x-javascript|xml|ecmascript|msgpack|cbor)|.+[+/](json|xml)|image/svg\+xml)$')
+
+# zlib wbits for the supported content codings: gzip has a gzip header, HTTP's 'deflate' 
+# is the zlib format (RFC 1950), not raw deflate
+_COMPRESSION_WBITS = {'gzip': 16 + zlib.MAX_WBITS, 'deflate': zlib.MAX_WBITS}
+
+def _compress_bytes(data, encoding, level):
+  compressor = zlib.compressobj(level, zlib.DEFLATED, _COMPRESSION_WBITS[encoding])
+  return compressor.compress(data) + compressor.flush()
+
+# compresses a KoaBodyStream chunk by chunk, so streamed bodies stay streamed
+class _CompressedBodyStream(koa.core.KoaBodyStream):
+  __slots__ = ('_compressor',)
+
+  def __init__(self, stream, encoding, level):
+    koa.core.KoaBodyStream.__init__(self, stream)
+    self._compressor = zlib.compressobj(level, zlib.DEFLATED, _COMPRESSION_WBITS[encoding])
+
+  @asyncio.coroutine
+  def read(self):
+    while self._compressor != None:
+      chunk = yield from self._source.read()
+      if len(chunk) == 0:
+        data = self._compressor.flush()
+        self._compressor = None
+        return data
+      data = self._compressor.compress(chunk)
+      if len(data) > 0:
+        return data # otherwise zlib buffered the whole chunk, so keep feeding it
+    return b''
+
+  def close(self):
+    self._source.close()
+
+# middleware similar to https://www.npmjs.org/package/koa-compress: gzip/deflate-compresses
+# response bodies for clients sending a matching Accept-Encoding header. 
+# Usage: app.use(koa.common.compress()) before the middleware producing the responses.
+# param threshold: bodies smaller than this many bytes are sent uncompressed (streamed 
+#       bodies are always compressed, their size isn't known upfront)
+# param level: zlib compression level 1 (fastest) - 9 (smallest)
+# param executor_threshold: bodies at least this large are compressed in a threadpool 
+#       instead of blocking the loop (zlib releases the GIL while compressing)
+# param executor: a concurrent.futures.Executor for that, None for the loop's default one
+# param filter: predicate taking the response mime type, decides if it's worth compressing
+def compress(threshold=1024, level=6, executor_threshold=128*1024, executor=None, filter=None):
+  if filter == None:
+    filter = lambda type: COMPRESSIBLE_TYPE_PATTERN.match(type) != None
+
+  @asyncio.coroutine
+  def compress_filter(koa_context, body):
+    response = koa_context.response
+    if body == None or response.type == None or not filter(response.type.split(';')[0].strip().lower()):
+      return body
+    for (name, value) in response.headers:
+      # some other middleware took care of this already (e.g. serving a precompressed 
+      # file), or the streamed body promises an exact length (or byte range) we'd break
+      if name.lower() in ('content-encoding', 'content-length', 'content-range'):
+        return body
+    is_stream = isinstance(body, koa.core.KoaBodyStream)
+    if not is_stream and len(body) < threshold:
+      return body
+
+    response.headers.append(('Vary', 'Accept-Encoding'))
+    encoding = koa_context.request.accepts_encodings('gzip', 'deflate')
+    if encoding == None:
+      return body
+    response.headers.append(('Content-Encoding', encoding))
+    if is_stream:
+      return _CompressedBodyStream(body, encoding, level)
+    if len(body) >= executor_threshold:
+      return (yield from asyncio.get_event_loop().run_in_executor(executor, _compress_bytes, body, encoding, level))
+    return _compress_bytes(body, encoding, level)
+
+  @asyncio.coroutine
+  def compress_middleware(koa_context, next):
+    koa_context.response.add_filter(compress_filter)
+    yield from next
+
+  return compress_middleware
+
+# In-memory cache of file contents for static(), keyed by file path (plus the accepted
+# encodings for static(..., precompressed=...) without an index). Entries are evicted
+# least recently used first once there are more than max_entries of them or they take 
+# more than max_bytes. Files larger than max_file_size aren't cached at all.
+# Cached files are revalidated (via os.stat() comparing mtime & size) when they were last
+# validated more than revalidate_interval seconds ago, with immutable=True they never are
+# (for fingerprinted assets that never change while the server is up).
+# Usage: static('mydir', cache=koa.common.StaticFileCache(max_bytes=64*1024*1024))
+class StaticFileCache:
+
+  class Entry:
+    __slots__ = ('content', 'mtime', 'size', 'validated_at', 'etag', 'encoding')
+
+    def __init__(self, content, file_stat, validated_at, encoding=None):
+      self.content = content
+      self.mtime = file_stat.st_mtime
+      self.size = file_stat.st_size
+      self.validated_at = validated_at
+      self.etag = '"{}"'.format(hashlib.sha1(content).hexdigest()) # content hash, see static()
+      self.encoding = encoding # content coding of a precompressed variant, see static()
+
+    # True if the file as of file_stat (with the given content coding) still has the cached content
+    def matches(self, file_stat, encoding=None):
+      return self.mtime == file_stat.st_mtime and self.size == file_stat.st_size and self.encoding == encoding
+
+  def __init__(self, max_bytes=64*1024*1024, max_entries=10000, max_file_size=1024*1024, revalidate_interval=1.0, immutable=False):
+    self.max_bytes = max_bytes
+    self.max_entries = max_entries
+    self.max_file_size = max_file_size
+    self.revalidate_interval = revalidate_interval
+    self.immutable = immutable
+    self._entries = collections.OrderedDict() # path -> Entry, least recently used first
+    self.size = 0 # total bytes of cached content
+    self.hits = 0
+    self.misses = 0
+
+  # returns the cached Entry for path if it doesn't need revalidation, None otherwise
+  def get(self, path):
+    entry = self._entries.get(path)
+    if entry == None:
+      return None
+    if not self.immutable and time.monotonic() - entry.validated_at >= self.revalidate_interval:
+      return None
+    self._entries.move_to_end(path)
+    self.hits += 1
+    return entry
+
+  # returns the cached Entry for path even if it needs revalidation, without counting
+  # this as a hit or miss
+  def peek(self, path):
+    return self._entries.get(path)
+
+  # returns the cached Entry for path if it's still valid according to the file_stat 
+  # from os.stat(path), None (dropping the entry) if the file changed or isn't cached
+  def validate(self, path, file_stat, encoding=None):
+    entry = self._entries.get(path)
+    if entry != None and entry.matches(file_stat, encoding):
+      entry.validated_at = time.monotonic()
+      self._entries.move_to_end(path)
+      self.hits += 1
+      return entry
+    self.discard(path)
+    self.misses += 1
+    return None
+
+  # caches the content of path as of file_stat (unless it's too large)
+  # returns the new Entry, or None if content is too large to be cached
+  def put(self, path, content, file_stat, encoding=None):
+    self.discard(path)
+    if len(content) > self.max_file_size or len(content) > self.max_bytes:
+      return None
+    entry = self._entries[path] = StaticFileCache.Entry(content, file_stat, time.monotonic(), encoding)
+    self.size += len(content)
+    while len(self._entries) > self.max_entries or self.size > self.max_bytes:
+      (_, evicted) = self._entries.popitem(last=False)
+      self.size -= len(evicted.content)
+    return entry
+
+  def discard(self, path):
+    entry = self._entries.pop(path, None)
+    if entry != None:
+      self.size -= len(entry.content)
+
+  def __len__(self):
+    return len(self._entries)
+
+# ETag for a file derived from its size & mtime (like nginx does), so computing it 
+# doesn't require reading the file
+def make_etag(size, mtime):
+  return '"{:x}-{:x}"'.format(size, int(mtime * 1000))
+
+# True if the conditional request headers If-None-Match or If-Modified-Since say the
+# client's copy of a resource with the given ETags (any of which are valid for its 
+# current content) and mtime is still current, so that it can be answered with a 304.
+def is_not_modified(request, etags, mtime):
+  if_none_match = request.headers.get('IF-NONE-MATCH')
+  if if_none_match != None: # takes precedence over If-Modified-Since, see RFC 7232
+    for etag in if_none_match.split(','):
+      etag = etag.strip()
+      if etag.startswith('W/'):
+        etag = etag[2:] # weak comparison
+      if etag == '*' or etag in etags:
+        return True
+    return False
+  if_modified_since = request.headers.get('IF-MODIFIED-SINCE')
+  if if_modified_since != None:
+    date = email.utils.parsedate_tz(if_modified_since)
+    if date != None:
+      return int(mtime) <= email.utils.mktime_tz(date)
+  return False
+
+# Cache of open file descriptors for static(), so that requests for hot files don't pay
+# for an open() & close() each. Entries are reference counted: an evicted (or replaced,
+# since the file changed on disk) descriptor is only closed once the last response 
+# using it is done. Thread-safe, since static() does its file I/O in an executor.
+# Usage: static('mydir', fd_cache=koa.common.FileDescriptorCache(max_entries=256))
+class FileDescriptorCache:
+
+  class Entry:
+    __slots__ = ('fd', 'identity', 'refcount', 'is_cached')
+
+    def __init__(self, fd, identity):
+      self.fd = fd
+      self.identity = identity # (st_dev, st_ino, st_size, st_mtime) of the file when opened
+      self.refcount = 0
+      self.is_cached = True
+
+  def __init__(self, max_entries=128):
+    self.max_entries = max_entries
+    self._entries = collections.OrderedDict() # path -> Entry, least recently used first
+    self._lock = threading.Lock()
+    self.hits = 0
+    self.misses = 0
+
+  # returns a FileHandle for path, opening the file unless there's a cached descriptor
+  # for the file described by file_stat (from os.stat(path)). Blocking I/O.
+  def acquire(self, path, file_stat):
+    identity = (file_stat.st_dev, file_stat.st_ino, file_stat.st_size, file_stat.st_mtime)
+    with self._lock:
+      entry = self._entries.get(path)
+      if entry != None and entry.identity == identity:
+        self._entries.move_to_end(path)
+        entry.refcount += 1
+        self.hits += 1
+        return FileHandle(self, entry)
+      self.misses += 1
+    fd = os.open(path, os.O_RDONLY)
+    entry = FileDescriptorCache.Entry(fd, identity)
+    entry.refcount = 1
+    to_close = []
+    with self._lock:
+      replaced = self._entries.pop(path, None)
+      if replaced != None:
+        to_close.extend(self._uncache(replaced))
+      self._entries[path] = entry
+      while len(self._entries) > self.max_entries:
+        (_, evicted) = self._entries.popitem(last=False)
+        to_close.extend(self._uncache(evicted))
+    for fd_to_close in to_close:
+      os.close(fd_to_close)
+    return FileHandle(self, entry)
+
+  # returns the fds that can be closed right away
+  def _uncache(self, entry):
+    entry.is_cached = False
+    return [entry.fd] if entry.refcount == 0 else []
+
+  def release(self, entry):
+    with self._lock:
+      entry.refcount -= 1
+      is_closable = entry.refcount == 0 and not entry.is_cached
+    if is_closable:
+      os.close(entry.fd)
+
+  # closes all cached descriptors that aren't in use
+  def clear(self):
+    to_close = []
+    with self._lock:
+      for entry in self._entries.values():
+        to_close.extend(self._uncache(entry))
+      self._entries.clear()
+    for fd in to_close:
+      os.close(fd)
+
+  def __len__(self):
+    return len(self._entries)
+
+# A read-only file object for a FileDescriptorCache descriptor, with its own file position
+# (reads are positioned reads, so concurrent responses sharing the descriptor don't 
+# interfere). close() releases the descriptor back to the cache.
+class FileHandle(io.RawIOBase):
+
+  def __init__(self, fd_cache, entry):
+    io.RawIOBase.__init__(self)
+    self._fd_cache = fd_cache
+    self._entry = entry
+    self._position = 0
+
+  def fileno(self):
+    return self._entry.fd
+
+  def readable(self):
+    return True
+
+  def seekable(self):
+    return True
+
+  def seek(self, offset, whence=io.SEEK_SET):
+    if whence == io.SEEK_CUR:
+      offset += self._position
+    elif whence == io.SEEK_END:
+      offset += os.fstat(self._entry.fd).st_size
+    self._position = offset
+    return offset
+
+  def tell(self):
+    return self._position
+
+  def readinto(self, buffer):
+    data = koa.core.read_file_at(self, self._position, len(buffer))
+    buffer[:len(data)] = data
+    self._position += len(data)
+    return len(data)
+
+  def close(self):
+    if not self.closed:
+      self._fd_cache.release(self._entry)
+    io.RawIOBase.close(self)
+
+# the default number of threads for static()'s file I/O, see get_file_io_executor()
+FILE_IO_MAX_WORKERS = 8
+_file_io_executor = None
+
+# returns the thread pool static() uses for file I/O by default. It's separate from the
+# loop's default executor, so that bursts of static traffic don't starve other 
+# run_in_executor() users (and vice versa).
+def get_file_io_executor():
+  global _file_io_executor
+  if _file_io_executor == None:
+    _file_io_executor = concurrent.futures.ThreadPoolExecutor(max_workers=FILE_IO_MAX_WORKERS)
+  return _file_io_executor
+
+# Parses a Range header like 'bytes=0-499, 1000-, -500' for a resource of size bytes.
+# Returns the list of (first, last) byte positions (inclusive, clipped to size), an
+# empty list if none of the ranges is satisfiable, or None if the header is malformed 
+# (which per RFC 7233 means ignoring it and sending the whole resource).
+def parse_range_header(value, size):
+  (unit, _, ranges_spec) = value.partition('=')
+  if unit.strip().lower() != 'bytes':
+    return None
+  ranges = []
+  for spec in ranges_spec.split(','):
+    (first, dash, last) = spec.strip().partition('-')
+    try:
+      if dash == '':
+        return None
+      if first == '': # suffix range, e.g. '-500' for the last 500 bytes
+        suffix_length = int(last)
+        if suffix_length > 0 and size > 0:
+          ranges.append( (max(0, size - suffix_length), size - 1) )
+        continue
+      (first, last) = (int(first), int(last) if last != '' else None)
+    except ValueError:
+      return None
+    if first < 0 or (last != None and last < first):
+      return None
+    if last == None:
+      last = size - 1
+    if first < size:
+      ranges.append( (first, min(last, size - 1)) )
+  return ranges
+
+# True if the If-Range header (if any) still matches the resource, i.e. its range 
+# request can be answered with the requested range instead of the whole resource
+def is_range_current(request, etags, mtime):
+  if_range = request.headers.get('IF-RANGE')
+  if if_range == None:
+    return True
+  if_range = if_range.strip()
+  if if_range.startswith('"'):
+    return if_range in etags # strong comparison, so weak W/ ETags never match
+  date = email.utils.parsedate_tz(if_range)
+  return date != None and int(mtime) == email.utils.mktime_tz(date)
+
+# returns the segments of a multipart/byteranges body: bytes for the part headers & 
+# delimiters and (offset, count) tuples for the content ranges
+def get_byteranges_segments(ranges, size, type, boundary):
+  segments = []
+  for (first, last) in ranges:
+    segments.append('\r\n--{}\r\nContent-Type: {}\r\nContent-Range: bytes {}-{}/{}\r\n\r\n'.format(
+      boundary, type, first, last, size).encode('latin-1'))
+    segments.append( (first, last - first + 1) )
+  segments.append('\r\n--{}--\r\n'.format(boundary).encode('latin-1'))
+  return segments
+
+# multipart/byteranges body read piecewise from a file via positioned reads (so never
+# loading more than a chunk of it into memory), for a multi-range request to static()
+class _ByteRangesStream(koa.core.KoaBodyStream):
+  __slots__ = ('_segments',)
+
+  def __init__(self, file, segments, executor=None):
+    koa.core.KoaBodyStream.__init__(self, file, executor=executor)
+    self._segments = collections.deque(segments)
+
+  @asyncio.coroutine
+  def read(self):
+    if len(self._segments) == 0:
+      return b''
+    segment = self._segments.popleft()
+    if isinstance(segment, bytes):
+      return segment
+    (offset, count) = segment
+    size = min(count, self._chunk_size)
+    chunk = yield from asyncio.get_event_loop().run_in_executor(self._executor, koa.core.read_file_at, self._source, offset, size)
+    if len(chunk) == 0:
+      raise Exception("file shrank while sending it") # too late for an error response, aborts the connection
+    if len(chunk) < count:
+      self._segments.appendleft( (offset + len(chunk), count - len(chunk)) )
+    return chunk
+
+# returns the Content-Type for a file name, None if unknown. The first few are what 
+# static() always served, the rest comes from the mimetypes module.
+_legacy_content_types = {'.htm': 'text/html', '.html': 'text/html', '.txt': 'text/html', '.css': 'text/css', '.js': 'application/javascript'}
+def get_content_type(file_name):
+  extension = os.path.splitext(file_name)[1].lower()
+  type = _legacy_content_types.get(extension)
+  if type != None:
+    return type
+  (type, encoding) = mimetypes.guess_type(file_name, strict=False)
+  return type if encoding == None else None # e.g. foo.js.gz isn't JavaScript
+
+# file name suffixes of the precompressed variants static() serves, by content coding.
+# See koa.precompress for writing them.
+PRECOMPRESSED_SUFFIXES = collections.OrderedDict([('br', '.br'), ('gzip', '.gz')])
+
+# In-memory manifest of the regular files below a dir, for static(..., index=...): maps
+# URL paths like 'foo/bar.txt' to the file's name, os.stat() result & content type, so that
+# requests are resolved with a single dict lookup instead of validating path components &
+# stat'ing the file. Paths that aren't in the manifest (including any containing '..') 
+# simply don't match. Meant for immutable deployments, since changes on disk only become 
+# visible after the next scan: with rescan_interval (seconds) the dir gets rescanned in
+# the background once a request comes in and the last scan is older than that, or call
+# rescan() e.g. from a deploy hook.
+# Usage: static('mydir', index=koa.common.StaticIndex('mydir', rescan_interval=60))
+class StaticIndex:
+
+  class Entry:
+    __slots__ = ('file_name', 'file_stat', 'type', 'variants')
+
+    def __init__(self, file_name, file_stat, type):
+      self.file_name = file_name
+      self.file_stat = file_stat
+      self.type = type
+      self.variants = None # content coding -> Entry of the precompressed sibling, if any
+
+  # scans dir_path right away (blocking), so create this at startup
+  def __init__(self, dir_path, rescan_interval=None, executor=None):
+    self.dir_path = dir_path
+    self.rescan_interval = rescan_interval
+    self.executor = executor
+    self._entries = self.scan()
+    self.scanned_at = time.monotonic()
+    self._pending_scan = None # future of a running background scan
+
+  # walks the dir, returns the new manifest. Blocking I/O.
+  def scan(self):
+    entries = {}
+    for (dir_path, dir_names, file_names) in os.walk(self.dir_path):
+      for file_name in file_names:
+        path = os.path.join(dir_path, file_name)
+        try:
+          file_stat = os.stat(path)
+        except OSError:
+          continue # deleted while scanning
+        if stat.S_ISREG(file_stat.st_mode):
+          url_path = os.path.relpath(path, self.dir_path).replace(os.sep, '/')
+          entries[url_path] = StaticIndex.Entry(path, file_stat, get_content_type(file_name))
+    for (url_path, entry) in entries.items():
+      for (encoding, suffix) in PRECOMPRESSED_SUFFIXES.items():
+        original = entries.get(url_path[:-len(suffix)]) if url_path.endswith(suffix) else None
+        if original != None:
+          original.variants = original.variants or {}
+          original.variants[encoding] = entry
+    return entries
+
+  # rescans the dir in the executor, the new manifest replaces the old one once complete
+  @asyncio.coroutine
+  def rescan(self):
+    yield from asyncio.shield(self._start_scan())
+
+  # returns the future of the running background scan, starting one if needed
+  def _start_scan(self):
+    if self._pending_scan == None:
+      self._pending_scan = asyncio.get_event_loop().run_in_executor(self.executor or get_file_io_executor(), self.scan)
+      self._pending_scan.add_done_callback(self._on_scanned)
+    return self._pending_scan
+
+  def _on_scanned(self, future):
+    self._pending_scan = None
+    self.scanned_at = time.monotonic()
+    if future.exception() == None:
+      self._entries = future.result()
+
+  # returns the Entry for url_path (without leading slash), None if there's no such file.
+  # Triggers a background rescan if one is due.
+  def get(self, url_path):
+    if self.rescan_interval != None and time.monotonic() - self.scanned_at >= self.rescan_interval:
+      self._start_scan()
+    return self._entries.get(url_path)
+
+  def __len__(self):
+    return len(self._entries)
 
 # Like https://www.npmjs.org/package/koa-static, so this can serve individual files
 # or whole directory trees.
@@ -74,8 +962,30 @@ def body_parser(koa_context, next):
 #    mydir/xyz.dat
 # then static('mydir') will serve HTTP GET requests with paths '/foo/bar.txt' and '/xyz.dat'.
 # Usually you'll use mount() to mount this middleware under a parent path.
+# param cache: optional StaticFileCache keeping hot files in memory
+# param sendfile_threshold: files larger than this many bytes aren't read into memory,
+#       they're sent via sendfile (see koa.core.KoaFileBody)
+# param cache_control: value of the Cache-Control header, e.g. 'public, max-age=86400'
+# param max_ranges: range requests for more ranges than this get the whole file instead
+# param executor: a concurrent.futures.Executor for the file I/O, by default a pool 
+#       dedicated to file I/O (see get_file_io_executor())
+# param fd_cache: optional FileDescriptorCache keeping hot files open
+# param index: True or a StaticIndex to resolve requests via a manifest of the dir built 
+#       at startup, instead of stat'ing files per request. Files added, changed or 
+#       removed afterwards are only picked up by a rescan, see StaticIndex.
+# param precompressed: True (or a list of content codings like ['gzip']) to serve 
+#       precompressed siblings like foo.js.br & foo.js.gz (see PRECOMPRESSED_SUFFIXES)
+#       instead of foo.js to clients accepting their encoding. Best combined with index,
+#       which knows which siblings exist, otherwise each is stat'ed per request.
+# Responses carry ETag & Last-Modified headers, so that clients can revalidate their 
+# copies via If-None-Match & If-Modified-Since, which are answered with a 304 Not Modified
+# without reading the file. ETags are based on size & mtime, or on the content's hash for
+# files served from the cache.
+# GET requests with a Range header (and matching If-Range, if any) get a 206 Partial
+# Content, as multipart/byteranges for several ranges. Ranges of uncached files are read
+# via sendfile or positioned reads, never loading the whole file.
 # Also remember you may serve static content faster via reverse proxies like nginx.
-def static(file_or_dir_path):
+def static(file_or_dir_path, cache=None, sendfile_threshold=256*1024, cache_control=None, max_ranges=16, executor=None, fd_cache=None, index=None, precompressed=None):
 
   def split_path(p):
     a,b = os.path.split(p)
@@ -104,19 +1014,111 @@ def static(file_or_dir_path):
     #   return asyncio.async(asyncio.coroutine(func)())
     # since it blocks the loop while executing the func.
     # This here does work, but WARNING: if you have a lot of parallel slow I/O
-    # tasks then the threadpool will still become a bottle neck!
+    # tasks then the threadpool will still become a bottle neck, which is why all the 
+    # I/O for a request happens in a single call to load_file().
     # Someone please impl true (nodejs-style) async file io for Python :)
-    return asyncio.get_event_loop().run_in_executor(None, func)
+    return asyncio.get_event_loop().run_in_executor(executor, func)
 
   if os.path.isfile(file_or_dir_path):
     raise Exception("static() does not support serving individual files atm, only dirs: " + file_or_dir_path)
   if not os.path.isdir(file_or_dir_path):
     raise Exception("static() dir {} does not exist".format(file_or_dir_path))
+  if executor == None:
+    executor = get_file_io_executor() # also for the body streams' reads, not just run_async()
+  if index == True:
+    index = StaticIndex(file_or_dir_path, executor=executor)
+  if precompressed == True:
+    precompressed = list(PRECOMPRESSED_SUFFIXES)
+
+  # returns the os.stat() result for regular files, None if there's no such file
+  def stat_file(file_name):
+    try:
+      file_stat = os.stat(file_name)
+    except OSError:
+      return None
+    return file_stat if stat.S_ISREG(file_stat.st_mode) else None
+
+  # returns a file object for the file described by file_stat
+  def open_file(file_name, file_stat):
+    if fd_cache != None:
+      return fd_cache.acquire(file_name, file_stat)
+    return open(file_name, 'rb')
+
+  # Does all the blocking I/O for a request in one go (so in one executor round trip):
+  # stats the file (unless file_stat is known from the index) and, if 
+  # should_load(file_stat) says the content is needed, reads files up to 
+  # sendfile_threshold bytes or opens larger ones (for sendfile).
+  # Returns (file_stat, content or None, file object or None), file_stat is None if 
+  # there's no such file.
+  def load_file(file_name, should_load, file_stat=None):
+    if file_stat == None:
+      file_stat = stat_file(file_name)
+    if file_stat == None or not should_load(file_stat):
+      return (file_stat, None, None)
+    try:
+      file = open_file(file_name, file_stat)
+    except OSError:
+      return (None, None, None) # removed since the index was built
+    if file_stat.st_size > sendfile_threshold:
+      return (file_stat, None, file)
+    try:
+      # The disk I/O could be slow. To verify that slow file IO really does not block 
+      # your event loop try this:
+      #    time.sleep(5)
+      return (file_stat, koa.core.read_file_at(file, 0, file_stat.st_size), None)
+    finally:
+      file.close()
+
+  # load_file() for the first existing file of the candidates, a list of (file name, 
+  # file_stat or None, content coding). Returns (file name, content coding, file_stat,
+  # content, file), file_stat is None if none of the files exist.
+  def load_first_file(candidates, should_load):
+    for (file_name, file_stat, encoding) in candidates:
+      (file_stat, content, file) = load_file(file_name, lambda file_stat: should_load(file_stat, encoding), file_stat)
+      if file_stat != None:
+        return (file_name, encoding, file_stat, content, file)
+    return (None, None, None, None, None)
+
+  # returns the precompressed encodings acceptable to the client, best first
+  def get_accepted_encodings(request):
+    (accepted, remaining) = ([], list(precompressed or ()))
+    while len(remaining) > 0:
+      encoding = request.accepts_encodings(*remaining)
+      if encoding == None:
+        break
+      accepted.append(encoding)
+      remaining.remove(encoding)
+    return accepted
+
+  # sends a 206 Partial Content with the given (first, last) byte ranges of the file, taken
+  # from content if it was read already, from file otherwise
+  def serve_ranges(koa_context, content, file, size, ranges, etag, type):
+    response = koa_context.response
+    if len(ranges) == 0:
+      if file != None:
+        file.close()
+      response.headers.append(('Content-Range', 'bytes */{}'.format(size)))
+      koa_context.throw("range not satisfiable", 416)
+    response.headers.append(('ETag', etag))
+    response.status = 206
+    if len(ranges) == 1:
+      (first, last) = ranges[0]
+      response.headers.append(('Content-Range', 'bytes {}-{}/{}'.format(first, last, size)))
+      response.type = type or 'application/octet-stream'
+      response.body = content[first:last + 1] if file == None else koa.core.KoaFileBody(file, first, last - first + 1, executor=executor)
+      return
+    boundary = binascii.hexlify(os.urandom(12)).decode('ascii')
+    segments = get_byteranges_segments(ranges, size, type or 'application/octet-stream', boundary)
+    response.type = 'multipart/byteranges; boundary=' + boundary
+    if file == None:
+      response.body = b''.join(segment if isinstance(segment, bytes) else content[segment[0]:segment[0] + segment[1]] for segment in segments)
+    else:
+      response.body = _ByteRangesStream(file, segments, executor)
 
   # This here is the koa middleware that does the actual file reading
   @asyncio.coroutine
   def static_middleware(koa_context, next):
-    # There's nothing fancy like caching addressed in this impl, it's minimalist. TODO?
+    # Caching is optional (see StaticFileCache), otherwise this impl is minimalist.
     # Also note how nodejs makes it difficult to accidentally call sync I/O methods in
     # coroutines (or anywhere) since the nodejs file IO is async alrdy (with the exception
     # of the explicitly name *sync methods like http://nodejs.org/api/fs.html#fs_fs_readfilesync_filename_options)
@@ -124,33 +1126,96 @@ def static(file_or_dir_path):
     # accidentally turn you C10k server into a C10 one :)
     # See https://docs.python.org/3/library/asyncio-dev.html#handle-blocking-functions-correctly
     # and https://gist.github.com/kunev/f83146d407c81a2d64a6
-    relative_file_name = strip_leading_slash(koa_context.request.path.path)
-    if not is_valid_path(relative_file_name):
-      return # don't even throw an exception so give other middleware a chance to handle it. Though usually you'd mount the static() middleware last in the chain, so should make little difference.
-    requested_file_name = os.path.join(file_or_dir_path, relative_file_name)
-    does_request_file_exist = yield from run_async(lambda: os.path.isfile(requested_file_name))
-    if does_request_file_exist:
-      # TODO: use streaming here instead of reading the file in one large chunk, which
-      # works poorly even for moderately large files
-
-      read_chunk_size_in_bytes = yield from run_async(lambda: os.stat(requested_file_name).st_size)
-      try:   # os.open does not support 'with'? :(
-        request_file_handle = yield from run_async(lambda: os.open(requested_file_name, os.O_RDONLY))
-
-        # The disk I/O could be slow. To verify that slow file IO really does not block 
-        # your event loop try this:
-        #    yield from run_async(lambda: time.sleep(5))
-
-        bytes_read = yield from run_async(lambda: os.read(request_file_handle, read_chunk_size_in_bytes))
-      finally:
-        yield from run_async(lambda: os.close(request_file_handle))
-      koa_context.response.body = bytes_read
-      if relative_file_name.endswith('.htm') or relative_file_name.endswith('.html') or relative_file_name.endswith('.txt'):
-        koa_context.response.type = 'text/html'
-      if relative_file_name.endswith('.css'):
-        koa_context.response.type = 'text/css'
-      if relative_file_name.endswith('.js'):
-        koa_context.response.type = 'application/javascript'
+    request = koa_context.request
+    response = koa_context.response
+    relative_file_name = strip_leading_slash(request.path.path)
+    encodings = get_accepted_encodings(request) if precompressed else ()
+    # the files that could answer the request, as (file name, file_stat, content coding),
+    # precompressed variants first
+    if index != None:
+      index_entry = index.get(relative_file_name)
+      if index_entry == None:
+        return # not a file in the dir, including all paths with '..'
+      type = index_entry.type
+      has_variants = precompressed and index_entry.variants != None
+      variants = [(index_entry.variants[encoding], encoding) for encoding in encodings if has_variants and encoding in index_entry.variants]
+      (index_entry, encoding) = variants[0] if len(variants) > 0 else (index_entry, None)
+      candidates = [(index_entry.file_name, index_entry.file_stat, encoding)]
+      cache_key = index_entry.file_name
+    else:
+      if not is_valid_path(relative_file_name):
+        return # don't even throw an exception so give other middleware a chance to handle it. Though usually you'd mount the static() middleware last in the chain, so should make little difference.
+      type = get_content_type(relative_file_name)
+      has_variants = bool(precompressed)
+      file_name = os.path.join(file_or_dir_path, relative_file_name)
+      candidates = [(file_name + PRECOMPRESSED_SUFFIXES[encoding], None, encoding) for encoding in encodings] + [(file_name, None, None)]
+      # which variant gets served depends on the encodings the client accepts, so that's
+      # part of the cache key (the entry knows the variant's encoding)
+      cache_key = (file_name, tuple(encodings)) if precompressed else file_name
+    (requested_file_name, known_stat, encoding) = candidates[0]
+    is_conditional = request.method in ('GET', 'HEAD')
+    (content, file) = (None, None)
+    entry = cache.get(cache_key) if cache != None else None
+    if entry == None:
+      stale_entry = cache.peek(cache_key) if cache != None else None
+
+      # runs in the executor, so must not touch the cache
+      def should_load(file_stat, encoding):
+        if stale_entry != None and stale_entry.matches(file_stat, encoding):
+          return False # revalidated, no need to read the file again
+        etag = make_etag(file_stat.st_size, file_stat.st_mtime)
+        return not (is_conditional and is_not_modified(request, (etag,), file_stat.st_mtime))
+
+      if known_stat != None and not should_load(known_stat, encoding):
+        (file_stat, content, file) = (known_stat, None, None) # no I/O needed at all
+      else:
+        (requested_file_name, encoding, file_stat, content, file) = yield from run_async(lambda: load_first_file(candidates, should_load))
+      if file_stat == None:
+        if cache != None:
+          cache.discard(cache_key)
+        return
+      entry = cache.validate(cache_key, file_stat, encoding) if cache != None else None
+      if entry == None and content == None and file == None and stale_entry != None and stale_entry.matches(file_stat, encoding):
+        content = stale_entry.content # revalidated, but a concurrent request evicted the entry meanwhile
+      if content != None and cache != None:
+        entry = cache.put(cache_key, content, file_stat, encoding)
+    else:
+      file_stat = None # cache hit without touching the disk
+      encoding = entry.encoding
+
+    # the size & mtime based ETag stays valid for cached files, since the content hash 
+    # based one only gets known once the file was read
+    (size, mtime) = (entry.size, entry.mtime) if entry != None else (file_stat.st_size, file_stat.st_mtime)
+    etags = (make_etag(size, mtime),) if entry == None else (entry.etag, make_etag(size, mtime))
+    response.headers.append(('Last-Modified', format_date_time(mtime)))
+    if cache_control != None:
+      response.headers.append(('Cache-Control', cache_control))
+    if has_variants:
+      response.headers.append(('Vary', 'Accept-Encoding'))
+    if is_conditional and is_not_modified(request, etags, mtime):
+      if file != None:
+        file.close()
+      response.headers.append(('ETag', etags[0]))
+      response.status = 304
+      return
+
+    if entry != None:
+      content = entry.content
+    if encoding != None:
+      response.headers.append(('Content-Encoding', encoding))
+    response.headers.append(('Accept-Ranges', 'bytes'))
+    range_header = request.headers.get('RANGE')
+    if range_header != None and request.method == 'GET' and is_range_current(request, etags, mtime):
+      ranges = parse_range_header(range_header, size)
+      if ranges != None and len(ranges) <= max_ranges:
+        serve_ranges(koa_context, content, file, size, ranges, etags[0], type)
+        return
+
+    response.headers.append(('ETag', etags[0]))
+    # large files are sent from the page cache, without ever reading them into memory
+    response.body = content if content != None else koa.core.KoaFileBody(file, 0, size, executor=executor)
+    if type != None:
+      response.type = type
 
   return static_middleware
 
@@ -160,6 +1225,8 @@ def static(file_or_dir_path):
 # /data/stuff/foo/bar.txt
 # It's OK to pass parent_path='/', which allows you to mount several middleware under
 # the same root.
+# Consecutive mounts in an app are fused into a single middleware (see fuse_mounts()), 
+# so an app with dozens of mounted sub-apps doesn't try each prefix in turn.
 # Note how router() could be composed of mount() plus a request method matcher.
 # Usage: app.use(koa.common.mount('/foo', middleware))
 def mount(parent_path, middleware):
@@ -184,45 +1251,92 @@ def mount(parent_path, middleware):
 
   @asyncio.coroutine
   def mount_middleware(koa_context, next):
-    orig_path = koa_context.request.path
-    remaining_path_suffix = get_remaining_path_suffix(orig_path.path)
+    remaining_path_suffix = get_remaining_path_suffix(koa_context.request.path.path)
+    if remaining_path_suffix != None:   # otherwise the prefix doesn't match, just call next handler then
+      yield from enter_mount(koa_context, parent_path, middleware)
+    yield from next
 
-    @asyncio.coroutine
-    def nop():
-      pass
+  mount_middleware.mount_path = parent_path
+  mount_middleware.mounted_middleware = middleware
+  mount_middleware.fuse = fuse_mounts
+  return mount_middleware
 
-    if remaining_path_suffix == orig_path.path:
+# runs middleware mounted at mount_path (which has to match the request path), with
+# request.path stripped of mount_path while it runs
+@asyncio.coroutine
+def enter_mount(koa_context, mount_path, middleware):
 
-      # optional optimization for mounting at '/': just call the middleware without modifying the path
-      #print("DEBUG mount() entering mountee: ", parent_path)
-      yield from middleware(koa_context, nop())
+  @asyncio.coroutine
+  def nop():
+    pass
 
-    elif remaining_path_suffix != None:   # otherwise the prefix doesn't match, just call next handler then
+  if len(mount_path) == 0:
+    # optional optimization for mounting at '/': just call the middleware without modifying the path
+    yield from middleware(koa_context, nop())
+    return
 
-      koa_context.request.path = urllib.parse.ParseResult(orig_path.scheme, orig_path.netloc, remaining_path_suffix, orig_path.params, orig_path.query, orig_path.fragment)
-      try:
-        #print("DEBUG mount() entering mountee: ", parent_path)
-        yield from middleware(koa_context, nop())  # mounted middleware executes with remaining path suffix
-      finally:
-        koa_context.request.path = orig_path
-        #print("DEBUG mount() exiting mountee: ", parent_path)
+  orig_path = koa_context.request.path
+  parsed = getattr(orig_path, '_parsed', orig_path) # the original ParseResult when nesting mounts
+  koa_context.request.path = koa.core.KoaMountedPath(parsed, orig_path.path[len(mount_path):])
+  try:
+    yield from middleware(koa_context, nop())  # mounted middleware executes with remaining path suffix
+  finally:
+    koa_context.request.path = orig_path
+
+# Fuses consecutive mount() middlewares into one middleware with the same behavior: each 
+# mount whose path prefixes the request path runs in order, followed by next. The mount 
+# paths are indexed by prefix, so finding the matching ones costs a dict lookup per 
+# request path component, regardless of the number of mounts.
+# Called via koa.core.fuse_middlewares() when an app compiles its middleware chain.
+def fuse_mounts(mount_middlewares):
+  mounts_by_path = {} # mount_path -> [(index, mounted middleware)]
+  for (index, mount_middleware) in enumerate(mount_middlewares):
+    mounts_by_path.setdefault(mount_middleware.mount_path, []).append( (index, mount_middleware.mounted_middleware) )
+
+  # returns the (mount_path, middleware) pairs matching path, in order of mount() calls
+  def find_mounts(path):
+    matches = []
+    prefix_end = path.find('/', 1) # mount paths are never '/'-terminated, so only look up prefixes ending before a '/'
+    while True:
+      prefix = path[:prefix_end] if prefix_end >= 0 else path
+      for (index, middleware) in (mounts_by_path.get(prefix, ()) if len(prefix) > 0 else ()):
+        matches.append( (index, prefix, middleware) )
+      if prefix_end < 0:
+        break
+      prefix_end = path.find('/', prefix_end + 1)
+    for (index, middleware) in mounts_by_path.get('', ()):
+      matches.append( (index, '', middleware) )
+    matches.sort(key = lambda match: match[0])
+    return [(prefix, middleware) for (index, prefix, middleware) in matches]
 
+  @asyncio.coroutine
+  def fused_mount_middleware(koa_context, next):
+    for (mount_path, middleware) in find_mounts(koa_context.request.path.path):
+      yield from enter_mount(koa_context, mount_path, middleware)
     yield from next
 
-  return mount_middleware
+  return fused_mount_middleware
 
 # c'tor func returning a KoaRouter instance (Crockford-style private classes and funcs).
 # On KoaRouter you register HTTP routes (matching request paths) together with HTTP request
 # method names (POST, GET, PUT, ...) and map them to your request handler. That allows
 # you to supply individual handlers for each kind of route in your REST API.
-def router():
+# param cache_size is the max number of recently requested (method, path) pairs whose
+# matching routes are cached, 0 disables the cache. Paths of routes without params
+# are always resolved via a dict, regardless of cache_size.
+def router(cache_size=1024):
 
   # some middleware doesn't want to explicitly do a 'yield from next', so let's auto-yield
   # to the next middleware, draining the generator.
   @asyncio.coroutine
-  def ensure_we_yield_to_next(middleware, next):
+  def ensure_we_yield_to_next(context, route, middleware, next):
     assert middleware != None, "middleware generator is None, maybe you forgot a @asyncio.coroutine decorator on middleware?"
-    yield from middleware
+    outer_middleware = context.active_middleware
+    context.active_middleware = route.handler # e.g. for koa.common.watchdog()
+    try:
+      yield from middleware
+    finally:
+      context.active_middleware = outer_middleware
     yield from next # if the middleware did 'yield from next' then this here is a NOP
 
   # like the specs for https://github.com/alexmingoia/koa-router, so represent routes like '/users/:id'
@@ -232,6 +1346,8 @@ def router():
       self.path_components = route.split('/')
       if len(self.path_components)==0 or self.path_components[0] != '':
         raise Exception("routes must start with a '/'")
+      # [(index of path component, param name)] e.g. [(2, 'id')] for '/users/:id'
+      self.params = [(i, component[1:]) for (i, component) in enumerate(self.path_components) if component.startswith(':')]
   
     # ExpressJsStyleRoute('/users/:id').matches('/users/123') should return {id: 123}
     # ExpressJsStyleRoute('/users').matches('/users') should return {}
@@ -256,6 +1372,10 @@ def router():
         else:
           return None # mismatch
       return params
+
+    # the params for path components already matched by a RouteTree
+    def get_params(self, path_components):
+      return {name: path_components[i] for (i, name) in self.params}
   
   # represents a route added via KoaRouter.get, so the URL path matcher,
   # the HTTP method (GET vs POST vs ...) and the coroutine for handling
@@ -264,11 +1384,53 @@ def router():
     # param HTTP method like "GET"
     # param path like "/config"
     # param handler is koajs middleware (so a coroutine taking KoaContext and next)
-    def __init__(self, method, path, handler):
+    # param timeout is the number of seconds matching requests may take, or None
+    def __init__(self, method, path, handler, timeout=None):
       koa.core.verify_is_middleware(handler)
       self.method = method
       self.path = ExpressJsStyleRoute(path)
       self.handler = handler
+      self.timeout = timeout
+
+  # A trie of the routes for one HTTP method, with one level per path component. So
+  # finding the routes for a request path costs O(path components) instead of O(routes).
+  # Static path components take precedence over ':params', so with routes '/users/me'
+  # and '/users/:id' a request for '/users/me' only matches the former.
+  class RouteTree:
+    __slots__ = ('children', 'param_child', 'routes')
+
+    def __init__(self):
+      self.children = {}      # path component -> RouteTree
+      self.param_child = None # RouteTree for ':param' components, whatever their param name
+      self.routes = []        # KoaRoutes ending here, in order of registration
+
+    def add(self, route):
+      node = self
+      for component in route.path.path_components[1:]:
+        if component.startswith(':'):
+          if node.param_child == None:
+            node.param_child = RouteTree()
+          node = node.param_child
+        else:
+          child = node.children.get(component)
+          if child == None:
+            child = node.children[component] = RouteTree()
+          node = child
+      node.routes.append(route)
+
+    # returns the list of KoaRoutes matching the path components (empty list on mismatch),
+    # param index is the index of the path component to match against this node
+    def find(self, path_components, index):
+      if index == len(path_components):
+        return self.routes
+      child = self.children.get(path_components[index])
+      if child != None:
+        routes = child.find(path_components, index + 1)
+        if len(routes) > 0:
+          return routes
+      if self.param_child != None:
+        return self.param_child.find(path_components, index + 1)
+      return []
 
   # Mimics https://www.npmjs.org/package/koa-router, so does express.js-style
   # routing of HTTP requests via router.get('/users/:id', handle_get_users_byid)
@@ -278,24 +1440,86 @@ def router():
   
     def __init__(self):
       self._routes = []  # list of KoaRoute instances
+      self._trees = None # HTTP method -> RouteTree, built from _routes on the 1st request
+      self._static_matches = {} # (method, path) -> [(route, params)] for routes without params
+      self._cached_matches = collections.OrderedDict() # LRU of (method, path) -> [(route, params)]
+      self.cache_hits = 0
+      self.cache_misses = 0
+
+    def _add_route(self, route):
+      self._routes.append(route)
+      self._trees = None # rebuilt on the next request
 
     # param handler is a coroutine to handle the HTTP GET request.
     # Your coroutine gets the same args as any other koa-style middleware:
     # a KoaContext and the 'next' middleware.
-    def get(self, path, handler):
-      self._routes.append( KoaRoute("GET", path, handler) )
+    # param timeout: optional deadline in seconds for matching requests, after which
+    #       they're cancelled and answered with a 504 (see KoaContext.set_timeout())
+    def get(self, path, handler, timeout=None):
+      self._add_route( KoaRoute("GET", path, handler, timeout) )
 
     # Same as get(), but matches HTTP POST requests.
-    def post(self, path, handler):
-      self._routes.append( KoaRoute("POST", path, handler) )
+    def post(self, path, handler, timeout=None):
+      self._add_route( KoaRoute("POST", path, handler, timeout) )
 
     # Same as get(), but matches HTTP PUT requests.
-    def put(self, path, handler):
-      self._routes.append( KoaRoute("PUT", path, handler) )
+    def put(self, path, handler, timeout=None):
+      self._add_route( KoaRoute("PUT", path, handler, timeout) )
 
     # Same as get(), but matches HTTP DELETE requests.
-    def delete(self, path, handler):
-      self._routes.append( KoaRoute("DELETE", path, handler) )
+    def delete(self, path, handler, timeout=None):
+      self._add_route( KoaRoute("DELETE", path, handler, timeout) )
+
+    # freezes the routes registered so far into one RouteTree per HTTP method
+    def compile(self):
+      trees = {}
+      for route in self._routes:
+        tree = trees.get(route.method)
+        if tree == None:
+          tree = trees[route.method] = RouteTree()
+        tree.add(route)
+      self._trees = trees
+      self._static_matches = {}
+      self._cached_matches.clear()
+      for route in self._routes:
+        if len(route.path.params) == 0:
+          key = (route.method, route.path.path)
+          if key not in self._static_matches:
+            self._static_matches[key] = [(route, {}) for route in self.find_routes(route.method, route.path.path)]
+      return trees
+
+    # returns the list of KoaRoutes matching the request, in order of registration
+    def find_routes(self, method, path):
+      trees = self._trees if self._trees != None else self.compile()
+      tree = trees.get(method)
+      if tree == None:
+        return []
+      if len(path) == 0:
+        path = '/' # since we force routes to start with a '/'
+      return tree.find(path.split('/'), 1)
+
+    # returns the list of (KoaRoute, params) matching the request, in order of registration.
+    # Same as find_routes(), but served from the static routes dict or the LRU cache if possible.
+    def match(self, method, path):
+      if self._trees == None:
+        self.compile()
+      key = (method, path)
+      matches = self._static_matches.get(key)
+      if matches != None:
+        return matches
+      matches = self._cached_matches.get(key)
+      if matches != None:
+        self.cache_hits += 1
+        self._cached_matches.move_to_end(key)
+        return matches
+      self.cache_misses += 1
+      path_components = path.split('/') if len(path) > 0 else ['', '']
+      matches = [(route, route.path.get_params(path_components)) for route in self.find_routes(method, path)]
+      if cache_size > 0:
+        self._cached_matches[key] = matches
+        if len(self._cached_matches) > cache_size:
+          self._cached_matches.popitem(last=False) # evict the least recently used
+      return matches
 
     # this func returns koajs middleware (so it returns a coroutine func),
     # which is epxected to be passed to KoaApp.use()
@@ -303,47 +1527,158 @@ def router():
       @asyncio.coroutine
       def inner(context, next):
         # Execute handlers in order in which they're registered (only makes a difference
-        # if a path matches several different handlers, which should be avoided).
+        # if a path matches several different handlers with the same static path 
+        # components, which should be avoided).
         # Note that this execution loop here is very similar to KoaHttpRequestHandler.handle_request,
-        # with the difference being an extra filter/predicate that determines if the route
-        # matches or not.
-        for i in reversed(range(len(self._routes))):
-          route = self._routes[i]
-          if route.method == context.request.method:
-            matched_path = context.request.path.path
-            if len(matched_path) == 0:
-              matched_path = '/' # since we force routes to start with a '/'
-            params = route.path.matches(matched_path)
-            does_route_match = params != None
-            #print("DEBUG: router() {} {} match={}".format(route.method, matched_path, does_route_match))
-            if does_route_match:
-              context.request.params = params
-              middleware = route.handler(context, next)
-              assert middleware != None, "did you forget @asyncio.coroutine on the handler for route {} {}?".format(route.method, route.path.path)
-              next = ensure_we_yield_to_next(middleware, next)
+        # with the difference being the route lookup that determines which handlers run.
+        for (route, params) in reversed(self.match(context.request.method, context.request.path.path)):
+          context.request.params = dict(params) # copied since the matches are cached
+          if route.timeout != None:
+            context.set_timeout(route.timeout)
+          middleware = route.handler(context, next)
+          assert middleware != None, "did you forget @asyncio.coroutine on the handler for route {} {}?".format(route.method, route.path.path)
+          next = ensure_we_yield_to_next(context, route, middleware, next)
         yield from next
       return inner
 
   return KoaRouter()
 
-def basic_auth(credential_validator):
+# Cache of credential_validator results for basic_auth(), for validators that are slow 
+# (e.g. bcrypt plus a user store lookup). Keyed by an HMAC of the Authorization header 
+# with a random per-process key, so the cache holds neither passwords nor hashes that 
+# could be attacked offline. Successful validations are cached for ttl seconds, failed 
+# ones for negative_ttl seconds (so repeating a wrong password doesn't cost a validator
+# call), least recently used entries are evicted beyond max_entries. Concurrent requests
+# with the same credentials share a single validator call.
+# To slow down password guessing, failed attempts are counted per client: after 
+# max_failures of them the client is rejected with a 429 (without calling the validator)
+# for failure_backoff seconds, doubling with each further failure up to max_backoff.
+# A successful login, or max_backoff seconds without failures, reset the count.
+# Note that a changed or revoked password may still be accepted for up to ttl seconds,
+# call clear() to avoid that.
+# Usage: app.use(koa.common.basic_auth(validator, cache=koa.common.CredentialCache(ttl=300)))
+class CredentialCache:
+
+  def __init__(self, ttl=60, negative_ttl=5, max_entries=10000, max_failures=5, failure_backoff=1, max_backoff=300):
+    self.ttl = ttl
+    self.negative_ttl = negative_ttl
+    self.max_entries = max_entries
+    self.max_failures = max_failures
+    self.failure_backoff = failure_backoff
+    self.max_backoff = max_backoff
+    self._key = os.urandom(32)
+    self._entries = collections.OrderedDict() # HMAC -> (is_authenticated, expiry time), least recently used first
+    self._failures = collections.OrderedDict() # client -> (failed attempts, time.monotonic() of the last one)
+    self._pending = {} # HMAC -> future of the validation in flight
+    self.hits = 0
+    self.misses = 0
+
+  # returns the cached result for auth_header, or the result of the validate coroutine 
+  # func (which gets cached). The validation runs in its own task, so that cancelling
+  # the request which started it doesn't fail the concurrent requests awaiting it too.
+  @asyncio.coroutine
+  def validate(self, auth_header, validate):
+    key = hmac.new(self._key, auth_header.encode('utf8'), hashlib.sha256).digest()
+    cached = self._entries.get(key)
+    if cached != None:
+      (is_authenticated, expires_at) = cached
+      if time.monotonic() < expires_at:
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return is_authenticated
+      del self._entries[key]
+    pending = self._pending.get(key)
+    if pending != None:
+      self.hits += 1
+    else:
+      self.misses += 1
+      pending = self._pending[key] = asyncio.ensure_future(self._validate(key, validate))
+    return (yield from asyncio.shield(pending))
+
+  @asyncio.coroutine
+  def _validate(self, key, validate):
+    try:
+      is_authenticated = bool((yield from validate()))
+    finally:
+      del self._pending[key]
+    self._entries[key] = (is_authenticated, time.monotonic() + (self.ttl if is_authenticated else self.negative_ttl))
+    while len(self._entries) > self.max_entries:
+      self._entries.popitem(last=False)
+    return is_authenticated
+
+  # returns the number of seconds the client has to wait before its next login attempt,
+  # 0 if it may try right away
+  def get_retry_after(self, client):
+    failures = self._failures.get(client)
+    if failures == None:
+      return 0
+    (count, failed_at) = failures
+    elapsed = time.monotonic() - failed_at
+    if elapsed >= self.max_backoff:
+      del self._failures[client]
+      return 0
+    if count < self.max_failures:
+      return 0
+    backoff = min(self.max_backoff, self.failure_backoff * 2 ** (count - self.max_failures))
+    return max(0, backoff - elapsed)
+
+  def record_failure(self, client):
+    self.get_retry_after(client) # forgets failures older than max_backoff
+    (count, _) = self._failures.pop(client, (0, None))
+    self._failures[client] = (count + 1, time.monotonic())
+    while len(self._failures) > self.max_entries:
+      self._failures.popitem(last=False)
+
+  def record_success(self, client):
+    self._failures.pop(client, None)
+
+  def clear(self):
+    self._entries.clear()
+
+  def __len__(self):
+    return len(self._entries)
+
+def basic_auth(credential_validator, cache=None, client_key=None):
   """ 
   :param credential_validator: is a coroutine that takes (username, password) strings and is supposed to 
          return True if the user is authenticated.
+  :param cache: optional CredentialCache, so that credential_validator isn't called on each request,
+         which also throttles clients failing to log in repeatedly
+  :param client_key: func taking the koa_context and returning the client to count failed logins 
+         for, by default the client's IP
   """
+  if client_key == None:
+    client_key = lambda koa_context: koa_context.request.ip
+
+  # deal with Authorization headers like 'Basic ...'
+  @asyncio.coroutine
+  def validate_header(auth_header):
+    (auth_type, auth_payload) = auth_header.split(' ')
+    if auth_type.lower() != 'basic':
+      return False
+    decodedPayload = base64.b64decode(auth_payload).decode('utf8')
+    (user, password) = decodedPayload.split(':')
+    return (yield from credential_validator(user, password))
 
   @asyncio.coroutine
   def basic_auth_middleware(koa_context, next):
 
-    # deal with koa_context.request.headers.get('AUTHORIZATION') == 'Basic ...'
     is_authenticated = False
     auth_header = koa_context.request.headers.get('AUTHORIZATION')
     if auth_header != None:
-      (auth_type, auth_payload) = auth_header.split(' ')
-      if auth_type.lower() == 'basic':
-        decodedPayload = base64.b64decode(auth_payload).decode('utf8')
-        (user, password) = decodedPayload.split(':')
-        is_authenticated = yield from credential_validator(user, password)
+      if cache != None:
+        client = client_key(koa_context)
+        retry_after = cache.get_retry_after(client)
+        if retry_after > 0:
+          koa_context.response.headers.append(('Retry-After', str(math.ceil(retry_after))))
+          koa_context.throw("too many failed login attempts", 429)
+        is_authenticated = yield from cache.validate(auth_header, lambda: validate_header(auth_header))
+        if is_authenticated:
+          cache.record_success(client)
+        else:
+          cache.record_failure(client)
+      else:
+        is_authenticated = yield from validate_header(auth_header)
 
     if is_authenticated:
       yield from next
@@ -352,3 +1687,86 @@ def basic_auth(credential_validator):
       koa_context.throw("unauthorized", 401) # if we'd just set response.status = 401 then 'yield from next' would still kick in due to ensure_we_yield_to_next()
 
   return basic_auth_middleware
+
+# In-memory token buckets for rate_limit(), keyed by anything hashable (e.g. a client IP).
+# Each bucket holds up to burst tokens and refills at rate tokens per second. Buckets are
+# spread across shards, and one shard at a time gets swept for buckets idle for longer 
+# than idle_timeout (by default the time an empty bucket takes to refill, after which it's
+# indistinguishable from a new one). So memory is bounded by the number of recently active 
+# keys, and no single sweep blocks the loop scanning millions of them.
+class TokenBuckets:
+
+  def __init__(self, rate, burst, shards=64, idle_timeout=None):
+    if not rate > 0:
+      raise ValueError("rate must be > 0 requests per second, got {}".format(rate))
+    if not burst >= 1:
+      raise ValueError("burst must be >= 1 request, got {}".format(burst))
+    if shards < 1:
+      raise ValueError("shards must be >= 1, got {}".format(shards))
+    self.rate = rate
+    self.burst = burst
+    self.idle_timeout = idle_timeout if idle_timeout != None else burst / rate
+    self._shards = [{} for i in range(shards)] # key -> (tokens, time.monotonic() of the last update)
+    self._next_sweep_at = time.monotonic() + self.idle_timeout / shards
+    self._next_shard_to_sweep = 0
+
+  # takes cost tokens from the bucket for key if it holds that many. Returns (is_allowed,
+  # remaining tokens, seconds until cost tokens are available, seconds until the bucket is full)
+  def take(self, key, cost=1):
+    now = time.monotonic()
+    if now >= self._next_sweep_at:
+      self._sweep(now)
+    shard = self._shards[hash(key) % len(self._shards)]
+    bucket = shard.get(key)
+    tokens = self.burst if bucket == None else min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+    is_allowed = tokens >= cost
+    if is_allowed:
+      tokens -= cost
+    shard[key] = (tokens, now)
+    retry_after = 0 if is_allowed else (cost - tokens) / self.rate
+    return (is_allowed, tokens, retry_after, (self.burst - tokens) / self.rate)
+
+  def _sweep(self, now):
+    shard = self._shards[self._next_shard_to_sweep]
+    expired = [key for (key, (tokens, updated_at)) in shard.items() if now - updated_at >= self.idle_timeout]
+    for key in expired:
+      del shard[key]
+    self._next_shard_to_sweep = (self._next_shard_to_sweep + 1) % len(self._shards)
+    self._next_sweep_at = now + self.idle_timeout / len(self._shards)
+
+  def __len__(self):
+    return sum(len(shard) for shard in self._shards)
+
+# Throttles requests per key via token buckets (see TokenBuckets): a key may make burst
+# requests at once and rate requests per second on average. Requests over the limit get 
+# a 429 Too Many Requests with a Retry-After header before any downstream middleware runs.
+# All responses carry RateLimit-Limit, RateLimit-Remaining & RateLimit-Reset headers.
+# param key is a func taking the koa_context and returning the key to throttle by, by 
+#       default the client's IP. Requests for which it returns None aren't throttled.
+#       E.g. key=lambda koa_context: koa_context.request.headers.get('AUTHORIZATION')
+# Usage: app.use(koa.common.mount('/search', koa.common.rate_limit(rate=5, burst=20)))
+def rate_limit(rate, burst=None, key=None, shards=64):
+  if burst == None:
+    burst = max(1, rate)
+  if key == None:
+    key = lambda koa_context: koa_context.request.ip
+  buckets = TokenBuckets(rate, burst, shards) # raises ValueError for a rate <= 0 or burst < 1
+
+  @asyncio.coroutine
+  def rate_limit_middleware(koa_context, next):
+    bucket_key = key(koa_context)
+    if bucket_key == None:
+      yield from next
+      return
+    (is_allowed, remaining, retry_after, reset) = buckets.take(bucket_key)
+    headers = koa_context.response.headers
+    headers.append(('RateLimit-Limit', str(burst)))
+    headers.append(('RateLimit-Remaining', str(int(remaining))))
+    headers.append(('RateLimit-Reset', str(math.ceil(reset))))
+    if not is_allowed:
+      headers.append(('Retry-After', str(math.ceil(retry_after))))
+      koa_context.throw("too many requests", 429)
+    yield from next
+
+  rate_limit_middleware.buckets = buckets
+  return rate_limit_middleware
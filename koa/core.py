@@ -6,65 +6,691 @@ import json
 import pdb
 import inspect
 import types
+import io
+import os
+import time
+import http.server
+import collections.abc
+from wsgiref.handlers import format_date_time
+try:
+  import orjson # optional: fast JSON encoder emitting bytes directly
+except ImportError:
+  orjson = None
+try:
+  import msgpack # optional: MessagePack for internal clients
+except ImportError:
+  msgpack = None
+try:
+  import cbor2 # optional: CBOR for internal clients
+except ImportError:
+  cbor2 = None
+
+# request.path while inside a mount(): a view of the original urllib.parse.ParseResult
+# with a shorter path, so mounting doesn't need to rebuild the ParseResult. Supports
+# the same attributes as ParseResult (path, query, netloc, ...).
+class KoaMountedPath:
+  __slots__ = ('_parsed', 'path')
+
+  # param parsed is the request's original urllib.parse.ParseResult
+  # param path is the remaining path suffix, e.g. '/bar' for '/foo/bar' mounted at '/foo'
+  def __init__(self, parsed, path):
+    self._parsed = parsed
+    self.path = path
+
+  def __getattr__(self, name):
+    return getattr(self._parsed, name)
+
+  # the ParseResult this stands in for, with the mounted path
+  def _as_parse_result(self):
+    return self._parsed._replace(path=self.path)
+
+  # like ParseResult._replace(), relative to the mounted path, e.g. for path._replace(query='')
+  def _replace(self, **kwargs):
+    return self._as_parse_result()._replace(**kwargs)
+
+  # ParseResult is a namedtuple, so support indexing & unpacking too
+  def __iter__(self):
+    return iter(self._as_parse_result())
+
+  def __getitem__(self, index):
+    return self._as_parse_result()[index]
+
+  def __len__(self):
+    return len(self._parsed)
+
+  def __eq__(self, other):
+    return self._as_parse_result() == other
+
+  def __hash__(self):
+    return hash(self._as_parse_result())
+
+  def geturl(self):
+    return self._as_parse_result().geturl()
+
+  def __repr__(self):
+    return 'KoaMountedPath({!r})'.format(self._as_parse_result())
+
+class KoaRequest:
+  # these props attempt to stick closely to koajs request. Since a lot of requests
+  # only ever look at a few of these the URL & header-derived props are parsed lazily
+  # on first access and cached in the underscore slots.
+  __slots__ = ('method', 'headers', 'payload', 'body', 'params', 'ip',
+               '_message', '_original_path', '_path', '_query', '_content_type', '_accept',
+               '_accept_encoding')
+
+  # param message is the message passed to aiohttp.server.ServerHttpProtocol.handle_request()
+  def __init__(self, message):
+    self.method = message.method
+    self.headers = message.headers
+    self.payload = None # aiohttp.streams.FlowControlStreamReader, set by KoaHttpRequestHandler
+    self.body = None    # set by koa.common.body_parser
+    self.params = None  # set by koa.common.router, e.g. {'id': '123'} for route '/users/:id'
+    self.ip = None      # the client's address, e.g. '127.0.0.1', set by KoaHttpRequestHandler
+    self._message = message   # not part of koajs, just in case some middleware needs it
+    self._original_path = None
+    self._path = None
+    self._query = None
+    self._content_type = None
+    self._accept = None
+    self._accept_encoding = None
+
+  # koa.js lists an 'originalUrl' member, which stays the same even during chains of mount(), 
+  # whereas path will shrink for each mount() level
+  @property
+  def original_path(self):
+    if self._original_path is None:
+      self._original_path = urllib.parse.urlparse(self._message.path)
+    return self._original_path
+
+  # a urllib.parse.ParseResult, so use request.path.path for the path string
+  @property
+  def path(self):
+    if self._path is None:
+      self._path = self.original_path
+    return self._path
+
+  @path.setter
+  def path(self, value):
+    self._path = value
+
+  @property
+  def querystring(self):
+    return self.original_path.query
+
+  # e.g. {'start_id': ['2']} for /users?start_id=2
+  @property
+  def query(self):
+    if self._query is None:
+      self._query = urllib.parse.parse_qs(self.querystring)
+    return self._query
+
+  # mime type of the request payload without params, e.g. 'application/json', or None
+  @property
+  def type(self):
+    return self._get_content_type()[0]
+
+  # charset param of the Content-Type header, e.g. 'utf-8', or None
+  @property
+  def charset(self):
+    return self._get_content_type()[1]
+
+  # parsed Content-Length header, or None if there is none. Raises a KoaException with
+  # status 400 for malformed headers.
+  @property
+  def length(self):
+    length = self.headers.get('CONTENT-LENGTH')
+    if length is None:
+      return None
+    if not length.strip().isdigit():
+      raise KoaException("invalid Content-Length header", 400)
+    return int(length)
+
+  # the raw request body, for middleware that consumes it incrementally instead of via
+  # koa.common.body_parser, e.g. chunk = yield from request.stream.readany()
+  @property
+  def stream(self):
+    return self.payload
+
+  # coroutine returning the decoded body, for both koa.common.body_parser (which decodes
+  # eagerly) and koa.common.lazy_body_parser (which decodes on first access), so for
+  # application/json a dict or list: body = yield from koa_context.request.json()
+  @asyncio.coroutine
+  def json(self):
+    body = self.body
+    if isinstance(body, KoaLazyBody):
+      body = yield from body
+    return body
+
+  # like koa.js request.accepts(): returns the best of the given mime types according
+  # to the Accept header (types[0] if there's no Accept header), or None if none of them
+  # is acceptable. E.g. request.accepts('application/json', 'text/html')
+  def accepts(self, *types):
+    if self._accept is None:
+      self._accept = parse_accept_header(self.headers.get('ACCEPT'))
+    return negotiate(self._accept, types, '*/*')
+
+  # like koa.js request.acceptsEncodings(): returns the best of the given content codings
+  # (e.g. 'gzip', 'deflate') according to the Accept-Encoding header, or None if the
+  # client only accepts the identity encoding (which includes sending no header at all)
+  def accepts_encodings(self, *encodings):
+    if self._accept_encoding is None:
+      self._accept_encoding = parse_accept_header(self.headers.get('ACCEPT-ENCODING'))
+    if len(self._accept_encoding) == 0:
+      return None
+    return negotiate(self._accept_encoding, encodings, '*')
+
+  def _get_content_type(self):
+    if self._content_type is None:
+      header = self.headers.get('CONTENT-TYPE')
+      mime_type = None
+      charset = None
+      if header is not None:
+        params = header.split(';')
+        mime_type = params[0].strip().lower()
+        for param in params[1:]:
+          (name, _, value) = param.partition('=')
+          if name.strip().lower() == 'charset':
+            charset = value.strip().strip('"').lower()
+      self._content_type = (mime_type, charset)
+    return self._content_type
+
+class KoaResponse:
+  __slots__ = ('status', '_body', 'type', 'headers', 'writer', 'filters', 'headers_sent', 'keep_alive')
+
+  def __init__(self):
+    self.status = None # 200, 404, ...
+    self._body = None # {}, string, ...
+    self.type = None  # will be inferred from body unless you set it explicitly
+    self.headers = [] # e.g. add tuples like ('Location', 'http://example.com/index.html')
+    self.writer = None # set by KoaHttpRequestHandler
+    self.filters = None # see add_filter()
+    self.headers_sent = False # like koa.js ctx.headerSent, set once the response started going out
+    self.keep_alive = False # set by koa_write_response if the connection may be reused afterwards
+
+  @property
+  def body(self):
+    return self._body
+
+  # replacing a KoaBodyStream body (e.g. a KoaFileBody) closes it, unless the new body
+  # wraps it
+  @body.setter
+  def body(self, value):
+    previous = self._body
+    if isinstance(previous, KoaBodyStream) and previous is not value and getattr(value, '_source', None) is not previous:
+      previous.close()
+    self._body = value
+
+  # Registers a coroutine func taking (koa_context, body) that transforms the body right
+  # before it's written, returning the new body. Since the response is written by the 
+  # innermost next, middleware can't post-process the encoded body after 'yield from next', 
+  # so middleware like koa.common.compress() registers a filter before yielding instead.
+  # Filters see the body already converted to bytes (or a KoaBodyStream), with 
+  # response.type and response.status filled in, and they may append headers.
+  def add_filter(self, filter):
+    if self.filters == None:
+      self.filters = []
+    self.filters.append(filter)
+
+class KoaException(Exception):
+  def __init__(self, message, status):
+    self.message = message
+    self.status = status
+
+class KoaContext:
+  __slots__ = ('app', 'request', 'response', 'deadline', 'active_middleware', '_state', '_task', '_deadline_timer', '_is_expired')
+
+  # param message is the message passed to aiohttp.server.ServerHttpProtocol.handle_request()
+  # param app is the KoaApp serving the request (the outermost one if apps are mount()ed)
+  def __init__(self, message, app=None):
+    self.app = app
+    self.request = KoaRequest(message)
+    self.response = KoaResponse()  # to be filled out by the middleware handlers
+    self.deadline = None # loop.time() by which the request must complete, see set_timeout()
+    self.active_middleware = None # the middleware the request is currently in, e.g. for koa.common.watchdog()
+    self._state = None
+    self._task = None # the asyncio.Task executing the middleware chain
+    self._deadline_timer = None
+    self._is_expired = False
+
+  # like ctx.state at http://koajs.com/, the recommended namespace for passing
+  # info between middlewares (the context itself doesn't accept new attributes)
+  @property
+  def state(self):
+    if self._state is None:
+      self._state = {}
+    return self._state
+
+  # Gives the request at most this many seconds (from now) to complete, an earlier
+  # deadline that's tighter already wins. Once the deadline passes the middleware chain 
+  # gets cancelled and a 504 is sent. Apps set this via app.server_settings.request_timeout,
+  # routes via router.get(path, handler, timeout=seconds).
+  def set_timeout(self, seconds):
+    loop = asyncio.get_event_loop()
+    deadline = loop.time() + seconds
+    if self.deadline != None and self.deadline <= deadline:
+      return
+    self.deadline = deadline
+    if self._deadline_timer != None:
+      self._deadline_timer.cancel()
+    if self._task != None:
+      self._deadline_timer = loop.call_at(deadline, self._expire)
+
+  # seconds left until the deadline (0 once it passed) or None if there is none. Use this
+  # to budget timeouts of downstream calls, e.g. asyncio.wait_for(fetch(), ctx.time_remaining())
+  def time_remaining(self):
+    if self.deadline == None:
+      return None
+    return max(0.0, self.deadline - asyncio.get_event_loop().time())
+
+  # True once the deadline passed & the middleware chain got cancelled because of that
+  def is_expired(self):
+    return self._is_expired
+
+  def _expire(self):
+    self._is_expired = True
+    self._task.cancel()
+
+  # like ctx.throw() at http://koajs.com/
+  def throw(self, message, status):
+    raise KoaException(message, status)
+
+  def redirect(self, relative_url):
+    """ like koa.js context.redirect(), e.g. context.redirect('index.html')
+    """
+    # this here is kinda tricky when koa.common.mount is in effect: here we know 
+    # we want a relative redirect from / to /index.html, but when we send the 301 
+    # response we need the absolute location we are redirecting to.
+    # So here we should try to avoid knowing under which abs path we're mounted
+    base_path = self.request.original_path.path
+    if not base_path.endswith('/'):
+      base_path = base_path + '/'
+    loc =  base_path + relative_url
+    response = self.response
+    response.status = 301
+    response.headers.append( ['Location', loc] )
+    response.body = 'redirect to <a href="{}">{}</a>'.format(loc, loc)
+
+# Parses Accept-style headers like 'text/html;q=0.8, application/json' into a dict
+# mapping each (lowercased) value to its quality, e.g. {'text/html': 0.8, 'application/json': 1.0}
+def parse_accept_header(header):
+  accepted = {}
+  if header == None:
+    return accepted
+  for item in header.split(','):
+    params = item.split(';')
+    value = params[0].strip().lower()
+    if len(value) == 0:
+      continue
+    quality = 1.0
+    for param in params[1:]:
+      (name, _, q) = param.partition('=')
+      if name.strip().lower() == 'q':
+        try:
+          quality = float(q)
+        except ValueError:
+          quality = 0.0
+    accepted[value] = quality
+  return accepted
+
+# returns the candidate with the highest quality in the parsed accept header (first 
+# candidate wins ties), candidates[0] if the header was absent, or None if nothing matches
+# param wildcard is '*/*' for Accept and '*' for Accept-Encoding
+def negotiate(accepted, candidates, wildcard):
+  if len(accepted) == 0:
+    return candidates[0] if len(candidates) > 0 else None
+  best = None
+  best_quality = 0.0
+  for candidate in candidates:
+    quality = accepted.get(candidate)
+    if quality == None and wildcard == '*/*':
+      quality = accepted.get(candidate.split('/')[0] + '/*')
+    if quality == None:
+      quality = accepted.get(wildcard, 0.0)
+    if quality > best_quality:
+      best = candidate
+      best_quality = quality
+  return best
+
+def encode_json(body):
+  if orjson != None:
+    try:
+      return orjson.dumps(body, option=orjson.OPT_NON_STR_KEYS)
+    except TypeError:
+      pass # e.g. ints exceeding 64 bits, let the stdlib json module have a go
+  return json.dumps(body).encode('utf-8')
+
+def decode_json(data, charset):
+  if orjson != None and charset in (None, 'utf-8', 'utf8'):
+    return orjson.loads(data)
+  return json.loads(data.decode(charset or 'utf-8'))
+
+# Registry of encoders for response bodies and decoders for request payloads, every
+# KoaApp has one as app.serializers. Encoders are picked by the python type of 
+# response.body and negotiated against the request's Accept header, decoders are 
+# picked by the request's Content-Type (see koa.common.body_parser).
+# JSON is always registered, MessagePack & CBOR if the msgpack/cbor2 modules are 
+# installed. Since JSON is registered first it stays the default for clients that 
+# don't explicitly prefer another format.
+class KoaSerializers:
+
+  def __init__(self):
+    self._encoders = [] # list of (media_type, encode, body_types) in order of preference
+    self._encoders_by_type = {} # cache: python type -> list of (media_type, encode)
+    self._decoders = {} # media_type -> decode
+    self.add_encoder('application/json', encode_json)
+    self.add_decoder('application/json', decode_json)
+    if msgpack != None:
+      self.add_encoder('application/msgpack', lambda body: msgpack.packb(body, use_bin_type=True))
+      self.add_decoder('application/msgpack', lambda data, charset: msgpack.unpackb(data, raw=False))
+    if cbor2 != None:
+      self.add_encoder('application/cbor', cbor2.dumps)
+      self.add_decoder('application/cbor', lambda data, charset: cbor2.loads(data))
+
+  # param media_type like 'application/json'
+  # param encode is a func taking the body and returning its encoding as bytes
+  # param body_types is a tuple of python types this encoder is used for
+  def add_encoder(self, media_type, encode, body_types=(dict, list)):
+    self._encoders = [encoder for encoder in self._encoders if encoder[0] != media_type]
+    self._encoders.append((media_type, encode, tuple(body_types)))
+    self._encoders_by_type = {}
+
+  # param decode is a func taking the payload bytes and the charset of the request
+  # (or None) and returning the decoded body
+  def add_decoder(self, media_type, decode):
+    self._decoders[media_type] = decode
+
+  def get_decoder(self, media_type):
+    return self._decoders.get(media_type)
+
+  # returns the list of (media_type, encode) applicable to body, most preferred first
+  def _get_encoders(self, body):
+    encoders = self._encoders_by_type.get(body.__class__)
+    if encoders == None:
+      encoders = [(encoder[0], encoder[1]) for encoder in self._encoders if isinstance(body, encoder[2])]
+      self._encoders_by_type[body.__class__] = encoders
+    return encoders
+
+  # True if the encoding of body depends on the Accept header, so responses need a 
+  # 'Vary: Accept' header
+  def is_negotiated(self, body):
+    return len(self._get_encoders(body)) > 1
+
+  # returns (bytes, media_type), or None if there's no encoder for the type of body
+  # param request is the KoaRequest whose Accept header is negotiated, optional
+  def encode(self, body, request=None):
+    encoders = self._get_encoders(body)
+    if len(encoders) == 0:
+      return None
+    (media_type, encode) = encoders[0]
+    if len(encoders) > 1 and request != None:
+      preferred = request.accepts(*[encoder[0] for encoder in encoders])
+      for encoder in encoders:
+        if encoder[0] == preferred:
+          (media_type, encode) = encoder
+          break
+    return (encode(body), media_type)
+
+# request.body as set by koa.common.lazy_body_parser: reads & decodes the payload only 
+# once middleware yields from (or awaits) it, e.g. body = yield from request.body, and
+# caches the result (or the exception, e.g. the 413 for a body exceeding max_size).
+class KoaLazyBody:
+  __slots__ = ('_load', '_future')
+
+  # param load is a coroutine func returning the decoded body
+  def __init__(self, load):
+    self._load = load
+    self._future = None
+
+  @asyncio.coroutine
+  def _get(self):
+    if self._future != None:
+      return (yield from self._future) # loaded already, or still loading for someone else
+    self._future = asyncio.Future()
+    try:
+      body = yield from self._load()
+    except Exception as e:
+      self._future.set_exception(e)
+      self._future.exception() # retrieved, since it's also raised right here
+      raise
+    self._future.set_result(body)
+    return body
+
+  def __iter__(self):
+    return self._get()
+
+  __await__ = __iter__
+
+# Adapts the streaming variants of response.body to a single coroutine-based reader,
+# so that koa_write_response() doesn't need to care where the chunks come from.
+# Supported sources are file-like objects (anything with a read() method), generators
+# and other iterators of bytes, and (for python >= 3.5) async iterators of bytes.
+# Middleware may also assign a KoaBodyStream to response.body directly.
+class KoaBodyStream:
+  __slots__ = ('_source', '_chunk_size', '_is_blocking', '_executor')
+
+  # param executor: a concurrent.futures.Executor for blocking reads, None for the loop's default one
+  def __init__(self, source, chunk_size=64*1024, executor=None):
+    self._source = source
+    self._chunk_size = chunk_size
+    self._executor = executor
+    # reading from real files is blocking I/O, so these reads are run in the threadpool
+    self._is_blocking = hasattr(source, 'read') and not isinstance(source, io.BytesIO)
+
+  # returns the next chunk of bytes, or b'' once the stream is exhausted
+  @asyncio.coroutine
+  def read(self):
+    source = self._source
+    if hasattr(source, 'read'):
+      if self._is_blocking:
+        chunk = yield from asyncio.get_event_loop().run_in_executor(self._executor, source.read, self._chunk_size)
+      else:
+        chunk = source.read(self._chunk_size)
+    elif hasattr(source, '__anext__'):
+      try:
+        chunk = yield from _await(source.__anext__())
+      except StopAsyncIteration: # only reachable on python >= 3.5, which has async iterators
+        return b''
+    else:
+      chunk = next(source, b'')
+    if isinstance(chunk, str):
+      chunk = chunk.encode('utf-8')
+    return chunk
+
+  def close(self):
+    close = getattr(self._source, 'close', None)
+    if close != None:
+      close()
+
+# response.body for sending (a range of) a file: koa_write_response() hands these to
+# loop.sendfile() (python >= 3.7), which uses os.sendfile() to send the file straight from
+# the page cache to the socket, so the memory a response takes doesn't depend on the
+# file size. Where that's not possible (e.g. TLS, or older pythons) the file is read and
+# sent chunk by chunk like any other KoaBodyStream.
+# param file is a file object opened in binary mode, it's closed after the response
+# param count is the number of bytes to send, by default all from offset to the file's end
+class KoaFileBody(KoaBodyStream):
+  __slots__ = ('offset', 'count', '_position')
+
+  def __init__(self, file, offset=0, count=None, chunk_size=64*1024, executor=None):
+    KoaBodyStream.__init__(self, file, chunk_size, executor)
+    if count == None:
+      count = os.fstat(file.fileno()).st_size - offset
+    self.offset = offset
+    self.count = count
+    self._position = offset
+
+  @asyncio.coroutine
+  def read(self):
+    size = min(self._chunk_size, self.offset + self.count - self._position)
+    if size <= 0:
+      return b''
+    chunk = yield from asyncio.get_event_loop().run_in_executor(self._executor, read_file_at, self._source, self._position, size)
+    self._position += len(chunk)
+    return chunk
+
+# reads up to size bytes at the given offset of the file, which is blocking I/O
+def read_file_at(file, offset, size):
+  if hasattr(os, 'pread'):
+    return os.pread(file.fileno(), size, offset) # doesn't move the file position, so no seek() needed
+  file.seek(offset)
+  return file.read(size)
+
+# Sends a KoaFileBody after the response headers were written to writer, via sendfile
+# where possible. Closes the connection if the file turned out to be shorter than 
+# the Content-Length promised to the client.
+@asyncio.coroutine
+def send_file_body(writer, body):
+  loop = asyncio.get_event_loop()
+  transport = writer.transport
+  sent = None
+  if body.count > 0 and hasattr(loop, 'sendfile'):
+    try:
+      # this waits for the headers to be flushed, and falls back to reading chunks itself
+      # for transports that don't support os.sendfile()
+      sent = yield from _await(loop.sendfile(transport, body._source, body.offset, body.count))
+    except RuntimeError:
+      if transport.is_closing():
+        raise ConnectionResetError("connection lost while sending file")
+      sent = None # e.g. a transport without sendfile support
+  if sent == None:
+    sent = 0
+    while True:
+      chunk = yield from body.read()
+      if len(chunk) == 0:
+        break
+      writer.write(chunk)
+      sent += len(chunk)
+      yield from writer.drain()
+  if sent < body.count:
+    transport.close()
+
+def is_streaming_body(body):
+  return (isinstance(body, KoaBodyStream) or hasattr(body, 'read') or 
+          hasattr(body, '__anext__') or isinstance(body, collections.abc.Iterator))
+
+# closes a response body holding resources (like a file) that might not have been sent,
+# e.g. because the request got cancelled. Closing a body twice is harmless.
+def close_body(body):
+  if isinstance(body, KoaBodyStream):
+    body.close()
+  elif body != None and is_streaming_body(body) and hasattr(body, 'close'):
+    body.close()
+
+# asyncio.Task.current_task() got deprecated in favor of asyncio.current_task() in python 3.7
+current_task = getattr(asyncio, 'current_task', None) or asyncio.Task.current_task
+
+# yield from for awaitables returned by native (python >= 3.5) coroutines & async iterators
+def _await(awaitable):
+  if hasattr(awaitable, '__await__'):
+    return awaitable.__await__()
+  return awaitable # already a generator-based coroutine or future
+
+# Settings for the connections & requests handled by KoaHttpRequestHandler. Every KoaApp 
+# has one as app.server_settings, change them before starting the server, e.g.
+#   app.server_settings.max_requests_in_flight = 500
+class KoaServerSettings:
+
+  def __init__(self, keep_alive=75, max_connections=None, max_requests_in_flight=None,
+               header_timeout=15, body_timeout=None, request_timeout=None, retry_after=1, debug=True):
+    # seconds an idle keep-alive connection stays open, None to close connections after each response
+    self.keep_alive = keep_alive
+    # connections beyond this many are answered with a 503 and closed, None for no limit
+    self.max_connections = max_connections
+    # the high-water mark: requests arriving while this many middleware chains are still 
+    # executing get a fast 503 instead of piling even more coroutines onto the loop
+    self.max_requests_in_flight = max_requests_in_flight
+    # seconds a client has for sending the request line & headers
+    self.header_timeout = header_timeout
+    # seconds a client has for sending the request payload, reading it fails with a 408 afterwards
+    self.body_timeout = body_timeout
+    # seconds a request's middleware chain may take before it's cancelled & answered 
+    # with a 504, see KoaContext.set_timeout()
+    self.request_timeout = request_timeout
+    # seconds in the Retry-After header of 503s
+    self.retry_after = retry_after
+    # if True then 500s include the traceback
+    self.debug = debug
+
+# the canned response for shedding load, sent without running any middleware
+# param http_version is the request's, e.g. (1, 0)
+def get_overload_response(retry_after, http_version=(1, 1)):
+  body = b'server overloaded, retry later'
+  headers = get_status_line(http_version, 503) + 'Content-Type: text/plain\r\nContent-Length: {}\r\nRetry-After: {}\r\nConnection: close\r\n\r\n'.format(len(body), retry_after)
+  return headers.encode('ascii') + body
+
+# The Date header only changes once per second, so format it once per second
+_http_date = (None, None) # (int(time.time()), formatted date)
+def get_http_date():
+  global _http_date
+  now = int(time.time())
+  if _http_date[0] != now:
+    _http_date = (now, format_date_time(now))
+  return _http_date[1]
+
+# 'HTTP/1.1 200 OK\r\n' & co, cached per (http_version, status)
+_status_lines = {}
+def get_status_line(http_version, status):
+  status_line = _status_lines.get((http_version, status))
+  if status_line == None:
+    reason = http.server.BaseHTTPRequestHandler.responses.get(status, (str(status),))[0]
+    status_line = 'HTTP/{}.{} {} {}\r\n'.format(http_version[0], http_version[1], status, reason)
+    _status_lines[(http_version, status)] = status_line
+  return status_line
+
+# headers set by the writer itself (or not applicable to buffered responses)
+_hop_headers = frozenset(name.lower() for name in aiohttp.Response.HOP_HEADERS)
+
+# Bodies up to this size are copied into the same buffer as the headers, larger ones
+# are passed to the transport as a 2nd buffer (saving the copy).
+BUFFERED_BODY_COPY_LIMIT = 16 * 1024
+
+# Writes a complete response (status line, headers & body) to the StreamWriter with a
+# single write() for small bodies, which is what aiohttp.Response would take several
+# transport writes for. Only for bodies of known length, streams still use aiohttp.Response.
+# param body is bytes or None
+# param debug enables validation of the headers, which is skipped in production
+# param content_length: for writing just the headers of a body sent separately (body=None)
+# returns True if the connection can be kept alive
+def write_buffered_response(writer, status, http_version, close, headers, type, body, debug=True, content_length=None):
+  keep_alive = not close and http_version >= (1, 1)
+  lines = [get_status_line(http_version, status)]
+  for header in headers:
+    if debug:
+      assert len(header) == 2, header
+      assert isinstance(header[0], str) and isinstance(header[1], str), header
+      assert '\n' not in header[0] and '\n' not in header[1], header
+    (name, value) = header
+    lower_name = name.lower()
+    if lower_name in _hop_headers:
+      if lower_name == 'connection' and 'close' in value.lower():
+        keep_alive = False
+      continue # same as aiohttp.Response: the writer owns these
+    lines.append('{}: {}\r\n'.format(name, value))
+  if body != None:
+    content_length = len(body)
+  if content_length != None:
+    lines.append('Content-Type: {}\r\n'.format(type or 'application/octet-stream'))
+    lines.append('Content-Length: {}\r\n'.format(content_length))
+  elif status not in (204, 304) and status >= 200:
+    lines.append('Content-Length: 0\r\n')
+  lines.append('Date: {}\r\nServer: {}\r\nConnection: {}\r\n\r\n'.format(
+    get_http_date(), aiohttp.Response.SERVER_SOFTWARE, 'keep-alive' if keep_alive else 'close'))
+  head = ''.join(lines).encode('utf-8')
+  if body == None or len(body) == 0:
+    writer.write(head)
+  elif len(body) <= BUFFERED_BODY_COPY_LIMIT:
+    writer.write(head + body)
+  else:
+    writer.writelines((head, body))
+  return keep_alive
 
 # Creates koa app. Call app.use() to connect middleware coroutines.
 def app():
 
-  class KoaRequest:
-    # param message is the message passed to aiohttp.server.ServerHttpProtocol.handle_request()
-    def __init__(self, message):
-      # these props attemp to stick closely to koajs request
-      self.method = message.method
-      self.headers = message.headers
-      self.path = urllib.parse.urlparse(message.path)
-      self.original_path = self.path   # koa.js lists an 'originalUrl' member, which stays the same even during chains of mount(), whereas path() will shrink for each mount() level
-      self.querystring = self.path.query
-      self.query = urllib.parse.parse_qs(self.querystring)
-    
-      self._message = message   # not part of koajs, just in case some middleware needs it
-
-  class KoaResponse:
-    def __init__(self):
-      self.status = None # 200, 404, ...
-      self.body = None # {}, string, ...
-      self.type = None  # will be inferred from body unless you set it explicitly
-      self.headers = [] # e.g. add tuples like ('Location', 'http://example.com/index.html')
-
-  class KoaException(Exception):
-    def __init__(self, message, status):
-      self.message = message
-      self.status = status
-
-  class KoaContext:
-    # param message is the message passed to aiohttp.server.ServerHttpProtocol.handle_request()
-    def __init__(self, message):
-      self.request = KoaRequest(message)
-      self.response = KoaResponse()  # to be filled out by the middleware handlers
-
-    # like ctx.throw() at http://koajs.com/
-    def throw(self, message, status):
-      raise KoaException(message, status)
-
-    def redirect(self, relative_url):
-      """ like koa.js context.redirect(), e.g. context.redirect('index.html')
-      """
-      # this here is kinda tricky when koa.common.mount is in effect: here we know 
-      # we want a relative redirect from / to /index.html, but when we send the 301 
-      # response we need the absolute location we are redirecting to.
-      # So here we should try to avoid knowing under which abs path we're mounted
-      base_path = self.request.original_path.path
-      if not base_path.endswith('/'):
-        base_path = base_path + '/'
-      loc =  base_path + relative_url
-      response = self.response
-      response.status = 301
-      response.headers.append( ['Location', loc] )
-      response.body = 'redirect to <a href="{}">{}</a>'.format(loc, loc)
-
-  def process_json_response(body, type, status):
-    jso = body
-    body = json.dumps(jso).encode('utf-8')
-    type = type or 'application/json'
+  # param encoded is the (bytes, media_type) tuple returned by KoaSerializers.encode()
+  def process_encoded_response(encoded, type, status):
+    (body, media_type) = encoded
+    type = type or media_type
     status = status or 200
     return (body, type, status)
     
@@ -80,6 +706,13 @@ def app():
     status = status or 200
     return (body, type, status)
 
+  def process_stream_response(body, type, status):
+    if not isinstance(body, KoaBodyStream):
+      body = KoaBodyStream(body)
+    type = type or 'application/octet-stream'
+    status = status or 200
+    return (body, type, status)
+
   @asyncio.coroutine
   def koa_write_response(koa_context):
     request = koa_context.request
@@ -91,60 +724,168 @@ def app():
     writer = response.writer
 
     # transform all variants of body to bytes
-    if isinstance(body, dict) or isinstance(body, list):
-      (body, type, status) = process_json_response(body, type, status)
-    elif isinstance(body, str):
+    if isinstance(body, str):
       (body, type, status) = process_text_response(body, type, status)
     elif isinstance(body, bytes):
       (body, type, status) = process_bytes_response(body, type, status)
+    elif body != None and is_streaming_body(body):
+      (body, type, status) = process_stream_response(body, type, status)
     elif body != None:
-      msg = "unknown response type: {}".format(body.__class__.__name__)
-      (body, type, status) = process_text_response(msg, 'text/html', 500)
+      # dict & list for JSON, plus whatever else was registered via app.serializers.add_encoder()
+      serializers = koa_context.app.serializers if koa_context.app != None else None
+      encoded = serializers.encode(body, request) if serializers != None else None
+      if encoded != None:
+        if serializers.is_negotiated(body):
+          response.headers.append(('Vary', 'Accept')) # so caches don't serve e.g. msgpack to JSON clients
+        (body, type, status) = process_encoded_response(encoded, type, status)
+      else:
+        msg = "unknown response type: {}".format(body.__class__.__name__)
+        (body, type, status) = process_text_response(msg, 'text/html', 500)
     elif body == None and status != None:
       pass
     else:
       msg = "no response for method={} path={}".format(request.method, request.path.path)
       (body, type, status) = process_text_response(msg, 'text/html', 404)
-    assert body == None or isinstance(body, bytes)
+    if response.filters != None:
+      response.type = type
+      response.status = status
+      for filter in response.filters:
+        body = yield from filter(koa_context, body)
+      type = response.type
+      status = response.status
+    assert body == None or isinstance(body, bytes) or isinstance(body, KoaBodyStream)
     assert type == None or isinstance(type, str)
     assert isinstance(status, int)
 
-    http_response = aiohttp.Response(writer, status, http_version = request._message.version)
+    # keep the connection alive unless the client (or the server settings) say otherwise
+    app = koa_context.app
+    close = request._message.should_close or app == None or app.is_shutting_down or not app.server_settings.keep_alive
+    response.headers_sent = True
+    debug = app == None or app.server_settings.debug
+    if not isinstance(body, KoaBodyStream):
+      response.keep_alive = write_buffered_response(writer, status, request._message.version, close, headers, type, body, debug)
+      yield from writer.drain()
+      return
+    if isinstance(body, KoaFileBody):
+      # the length is known upfront, so no chunked encoding needed
+      try:
+        response.keep_alive = write_buffered_response(writer, status, request._message.version, close, headers, type, None, debug, body.count)
+        yield from send_file_body(writer, body)
+      finally:
+        body.close()
+      return
+
+    http_response = aiohttp.Response(writer, status, http_version = request._message.version, close = close)
     for header in headers:
       assert len(header) == 2
       http_response.add_header(header[0], header[1])
       # e.g. http_response.add_header('WWW-Authenticate', 'Basic realm="Authorization Required"')
-    if body != None:
-      assert isinstance(body, bytes)
-      http_response.add_header('Content-Type', type or 'application/octet-stream')
-      http_response.add_header('Content-Length', str(len(body))) # len encoded bytes
+    # no Content-Length here, so aiohttp picks 'Transfer-Encoding: chunked' for HTTP/1.1
+    # clients (and falls back to closing the connection after the body for HTTP/1.0)
+    http_response.add_header('Content-Type', type)
     http_response.send_headers()
-    if body != None:
-      yield from http_response.write(body)
+    try:
+      while True:
+        chunk = yield from body.read()
+        if len(chunk) == 0:
+          break
+        yield from http_response.write(chunk) # returns the writer's drain() every 64kB, which applies backpressure
+    finally:
+      body.close()
     yield from http_response.write_eof()
-
-  # some middleware doesn't want to explicitly do a 'yield from next', so let's auto-yield
-  # to the next middleware, draining the generator.
-  @asyncio.coroutine
-  def ensure_we_yield_to_next(middleware, next):
-    yield from middleware
-    yield from next # if the middleware did 'yield from next' then this here is a NOP
+    response.keep_alive = http_response.keep_alive()
 
   # one of these will be instantiated per http request
   class KoaHttpRequestHandler(aiohttp.server.ServerHttpProtocol):
 
     # param middleware is a coroutine for handling the request, typically KoaApp().middleware()
-    def __init__(self, middleware):
-      aiohttp.server.ServerHttpProtocol.__init__(self, debug=True, keep_alive=75)
+    # param app is the KoaApp, exposed to middleware as koa_context.app
+    def __init__(self, middleware, app):
+      settings = app.server_settings
+      aiohttp.server.ServerHttpProtocol.__init__(self, debug=settings.debug, 
+        keep_alive=settings.keep_alive, timeout=settings.header_timeout)
       self.middleware = middleware
+      self.app = app
+      self.settings = settings
+      self._is_shed = False # True if this connection exceeded max_connections
+      self.peer_ip = None
+
+    def connection_made(self, transport):
+      aiohttp.server.ServerHttpProtocol.connection_made(self, transport)
+      peername = transport.get_extra_info('peername')
+      self.peer_ip = peername[0] if isinstance(peername, tuple) else None # not for unix sockets
+      max_connections = self.settings.max_connections
+      if max_connections != None and len(self.app.connections) >= max_connections:
+        # still parse the request line & headers (so the client gets to read our 503 
+        # instead of a connection reset), but don't count or serve the connection
+        self._is_shed = True
+      else:
+        self.app.connections.add(self)
+
+    def connection_lost(self, exc):
+      self.app.connections.discard(self)
+      aiohttp.server.ServerHttpProtocol.connection_lost(self, exc)
 
     # this here is the request router
     @asyncio.coroutine
     def handle_request(self, message, payload):
-      context = KoaContext(message)
+      app = self.app
+      settings = self.settings
+      if self._is_shed or (settings.max_requests_in_flight != None and app.requests_in_flight >= settings.max_requests_in_flight):
+        # shedding load: answering right away is far cheaper than queueing yet another chain
+        self.writer.write(get_overload_response(settings.retry_after, message.version))
+        self.keep_alive(False)
+        return
+
+      context = KoaContext(message, app)
       context.response.writer = self.writer
+      context.request.ip = self.peer_ip
       context.request.payload = payload # is a aiohttp.streams.FlowControlStreamReader, use middleware.body_parser() to parse this as JSON
-    
+      context._task = current_task(self._loop)
+      if settings.request_timeout != None:
+        context.set_timeout(settings.request_timeout)
+      body_timer = None
+      if settings.body_timeout != None and not payload.is_eof():
+        body_timer = self._loop.call_later(settings.body_timeout, self.cancel_slow_payload, payload)
+      app.requests_in_flight += 1
+      try:
+        yield from self.handle_koa_request(context)
+      except asyncio.CancelledError:
+        if not context.is_expired():
+          raise # e.g. the client disconnected or the server is shutting down
+        yield from self.handle_expired_request(context)
+      finally:
+        close_body(context.response.body) # in case it never got sent
+        app.requests_in_flight -= 1
+        if body_timer != None:
+          body_timer.cancel()
+        if context._deadline_timer != None:
+          context._deadline_timer.cancel()
+        if app.requests_in_flight == 0 and app._drain_waiter != None and not app._drain_waiter.done():
+          app._drain_waiter.set_result(None) # see KoaApp.shutdown()
+      self.keep_alive(context.response.keep_alive)
+
+    # sends a 504 for a request whose middleware chain got cancelled by its deadline
+    @asyncio.coroutine
+    def handle_expired_request(self, context):
+      if context.response.headers_sent:
+        self.transport.close() # too late for a 504, at least don't leave the client hanging
+        return
+      close_body(context.response.body)
+      context.response = KoaResponse() # discard whatever the cancelled middleware prepared
+      context.response.writer = self.writer
+      context.response.status = 504
+      context.response.body = "request timed out"
+      yield from koa_write_response(context)
+
+    # makes pending & future reads of a payload that didn't arrive within body_timeout
+    # fail, which aiohttp answers with a 408 (unless a middleware catches the exception)
+    def cancel_slow_payload(self, payload):
+      if not payload.is_eof():
+        payload.set_exception(aiohttp.errors.HttpErrorException(408, 'Request Timeout'))
+
+    @asyncio.coroutine
+    def handle_koa_request(self, context):
       # now process the chain of middlewares in order. Each middleware gets passed
       # its successor aka next as a coroutine, allowing nesting middleware, not just
       # plain sequential chaining.
@@ -168,6 +909,13 @@ def app():
    
     def __init__(self):
       self.middlewares = []  # coroutine funcs
+      self._dispatch = None  # compiled middleware chain, see compile_middleware_chain()
+      self.serializers = KoaSerializers() # encoders for response bodies, decoders for request payloads
+      self.server_settings = KoaServerSettings()
+      self.connections = set() # KoaHttpRequestHandlers of the currently open connections
+      self.requests_in_flight = 0 # number of middleware chains currently executing
+      self.is_shutting_down = False # see shutdown()
+      self._drain_waiter = None
 
     # wires up koa.js-style middleware
     # param middleware is a coroutine that will receive params (request, next)
@@ -176,6 +924,13 @@ def app():
       #assert len(inspect.getargspec(middleware).args) == 2, "middleware is supposed to be a coroutine function taking 2 args KoaContext and next"
       # TODO: assert that the func takes 2 params: koa_context and next
       self.middlewares += [middleware]
+      self._dispatch = None # recompiled on the next request
+
+    # freezes the current list of middlewares into a prebuilt composition, this
+    # is done once when the server starts (or lazily after use() was called again)
+    def compile(self):
+      self._dispatch = compile_middleware_chain(self.middlewares)
+      return self._dispatch
 
     # returns middleware that can be use()'ed in a different koa app, allowing
     # for app composition, usually via mount()
@@ -183,24 +938,93 @@ def app():
 
       @asyncio.coroutine
       def inner(context, next):
-        # now process the chain of middlewares in order. Each middleware gets passed
-        # its successor aka next as a coroutine, allowing nesting middleware, not just
-        # plain sequential chaining.
-        # This is the same mechanism koa.js uses for chaining & nesting middleware, I wonder
-        # there's a more straightforward way to achieve the same.
-        for i in reversed(range(len(self.middlewares))):
-          middleware = self.middlewares[i](context, next)
-          next = ensure_we_yield_to_next(middleware, next)
-        yield from next
+        dispatch = self._dispatch or self.compile()
+        yield from dispatch(context, 0, next)
 
       return inner
 
+    # Coroutine for shutting down gracefully, so that deploys & restarts don't cut off
+    # requests: stops accepting new connections, closes idle keep-alive connections,
+    # answers requests that are still in flight with 'Connection: close', waits up to 
+    # timeout seconds for their middleware chains to finish and cancels whatever is left.
+    # param server is the asyncio server returned by loop.create_server(), optional
+    @asyncio.coroutine
+    def shutdown(self, server=None, timeout=10):
+      loop = asyncio.get_event_loop()
+      if server != None:
+        server.close()
+      self.is_shutting_down = True
+      for connection in list(self.connections):
+        connection.closing() # closes connections right away unless they're in the middle of a request
+      if self.requests_in_flight > 0:
+        self._drain_waiter = asyncio.Future(loop=loop)
+        try:
+          yield from asyncio.wait_for(self._drain_waiter, timeout)
+        except asyncio.TimeoutError:
+          pass
+      for connection in list(self.connections):
+        connection.cancel_slow_request() # cancels the request handler & closes the connection
+      yield from asyncio.sleep(0) # let cancelled handlers unwind
+
     # This is to be passed to loop.create_server()
     def get_http_request_handler(self):
-      return KoaHttpRequestHandler(self.middleware())
+      if self._dispatch is None:
+        self.compile()
+      return KoaHttpRequestHandler(self.middleware(), self)
 
   return KoaApp()
 
+def compile_middleware_chain(middlewares):
+  """ compiles a list of koa-style middlewares into a dispatch coroutine func taking
+      (koa_context, index, next). Each middleware gets passed its successor aka next
+      as a coroutine, allowing nesting middleware, not just plain sequential chaining.
+      This is the same mechanism koa.js uses for chaining & nesting middleware (see
+      https://github.com/koajs/compose), but successors are only instantiated for the
+      middlewares a request actually enters. Works for both @asyncio.coroutine and
+      native 'async def' middleware, since 'await next' works as well as 'yield from next'.
+  """
+  middlewares = tuple(fuse_middlewares(middlewares))
+  count = len(middlewares)
+
+  @asyncio.coroutine
+  def dispatch(context, index, tail):
+    if index == count:
+      yield from tail
+      return
+    # creating the generator for the successor is cheap, it doesn't execute (or even
+    # instantiate) any of the downstream middleware until somebody yields from it
+    next = dispatch(context, index + 1, tail) if index + 1 < count else tail
+    middleware = middlewares[index]
+    outer_middleware = context.active_middleware
+    context.active_middleware = middleware
+    try:
+      yield from middleware(context, next)
+    finally:
+      context.active_middleware = outer_middleware # also after exceptions & cancellation
+    # some middleware doesn't want to explicitly do a 'yield from next', so let's auto-yield
+    # to the next middleware, draining the generator.
+    yield from next # if the middleware did 'yield from next' then this here is a NOP
+
+  return dispatch
+
+def fuse_middlewares(middlewares):
+  """ replaces runs of consecutive middlewares that have the same 'fuse' attribute by
+      the single middleware that fuse(list_of_middlewares) returns. E.g. koa.common.mount()
+      uses this to look up sibling mounts in a prefix index instead of trying them one by one.
+  """
+  fused = []
+  run = []
+  for middleware in list(middlewares) + [None]:
+    fuse = getattr(middleware, 'fuse', None)
+    if len(run) > 0 and (fuse == None or fuse != run[0].fuse):
+      fused.extend([run[0].fuse(run)] if len(run) > 1 else run)
+      run = []
+    if fuse != None:
+      run.append(middleware)
+    elif middleware != None:
+      fused.append(middleware)
+  return fused
+
 def verify_is_middleware(candidate):
   """ functiom that verifies that the given param meets the requirements for being koa-style middleware:
       mostly asyncio.iscoroutinefunction() taking 2 params (koa_context, next). Throws
@@ -0,0 +1,103 @@
+# Precompresses the static assets in a dir tree, writing foo.js.gz (and foo.js.br if the
+# optional brotli module is installed) next to each compressible file, for
+# koa.common.static(..., precompressed=True) to serve. Compresses with maximum ratio,
+# in parallel on all cores, skipping files whose siblings are up to date already.
+# Usage: python -m koa.precompress mydir [--workers 4] [--min-size 1024]
+
+import argparse
+import concurrent.futures
+import os
+import shutil
+import sys
+import tempfile
+try:
+  import brotli # optional: for the .br variants
+except ImportError:
+  brotli = None
+import koa.common
+
+def compress_gzip(data):
+  return koa.common._compress_bytes(data, 'gzip', 9)
+
+def compress_brotli(data):
+  return brotli.compress(data, quality=11)
+
+# the encodings to produce, see koa.common.PRECOMPRESSED_SUFFIXES
+def get_compressors():
+  compressors = {'gzip': compress_gzip}
+  if brotli != None:
+    compressors['br'] = compress_brotli
+  return compressors
+
+# returns the files below dir_path worth compressing: of a compressible content type,
+# at least min_size bytes large, and not precompressed variants themselves
+def find_files(dir_path, min_size):
+  suffixes = tuple(koa.common.PRECOMPRESSED_SUFFIXES.values())
+  for (parent, dir_names, file_names) in os.walk(dir_path):
+    for file_name in file_names:
+      path = os.path.join(parent, file_name)
+      type = koa.common.get_content_type(file_name)
+      if file_name.endswith(suffixes) or type == None or koa.common.COMPRESSIBLE_TYPE_PATTERN.match(type) == None:
+        continue
+      if os.path.isfile(path) and os.path.getsize(path) >= min_size:
+        yield path
+
+# writes the precompressed variants of the file at path that are missing or older than
+# the file, returns the list of files written. Variants that wouldn't be smaller than
+# the file aren't written (and stale ones get removed).
+def precompress_file(path, encodings):
+  compressors = get_compressors()
+  source_mtime = os.stat(path).st_mtime
+  data = None
+  written = []
+  for encoding in encodings:
+    target = path + koa.common.PRECOMPRESSED_SUFFIXES[encoding]
+    if os.path.exists(target) and os.stat(target).st_mtime >= source_mtime:
+      continue
+    if data == None:
+      with open(path, 'rb') as f:
+        data = f.read()
+    compressed = compressors[encoding](data)
+    if len(compressed) >= len(data):
+      if os.path.exists(target):
+        os.remove(target)
+      continue
+    # a unique temp file, so concurrent runs don't write to the same one
+    with tempfile.NamedTemporaryFile(dir=os.path.dirname(target), prefix=os.path.basename(target) + '.', suffix='.tmp', delete=False) as f:
+      try:
+        f.write(compressed)
+      except:
+        os.remove(f.name)
+        raise
+    shutil.copymode(path, f.name) # temp files are 0600, the server may run as a different user
+    os.replace(f.name, target) # so static() never serves a partially written file
+    written.append(target)
+  return written
+
+# precompresses all files below dir_path with a pool of worker processes, returns the
+# list of files written
+def precompress(dir_path, workers=None, min_size=1024, encodings=None):
+  if encodings == None:
+    encodings = list(get_compressors())
+  written = []
+  with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+    futures = [executor.submit(precompress_file, path, encodings) for path in find_files(dir_path, min_size)]
+    for future in concurrent.futures.as_completed(futures):
+      written.extend(future.result())
+  return written
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(prog='python -m koa.precompress', description='Writes .gz (and .br) variants of the compressible files in a dir tree, for koa.common.static(..., precompressed=True).')
+  parser.add_argument('dir', help='the dir tree to precompress')
+  parser.add_argument('--workers', type=int, default=None, help='number of worker processes, defaults to the number of cores')
+  parser.add_argument('--min-size', type=int, default=1024, help='files smaller than this many bytes are skipped')
+  args = parser.parse_args(argv)
+  if not os.path.isdir(args.dir):
+    parser.error('no such dir: ' + args.dir)
+  if brotli == None:
+    print('brotli module not installed, only writing .gz files', file=sys.stderr)
+  written = precompress(args.dir, args.workers, args.min_size)
+  print('wrote {} precompressed files'.format(len(written)))
+
+if __name__ == '__main__':
+  main()
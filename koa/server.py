@@ -0,0 +1,183 @@
+# Serves a koa app on all cores, similar to what nodejs' cluster module does for express.js
+# and koa.js apps: with workers > 1 the master process binds the port, forks the worker
+# processes (which inherit the composed app) and supervises them, restarting workers that
+# crash. Each worker runs its own asyncio loop.
+# The workers share the listening port: with reuse_port each worker binds its own
+# SO_REUSEPORT socket and the kernel balances incoming connections across them, otherwise
+# they all accept() on the socket inherited from the master.
+# Usage: koa.serve(app, port=8480, workers=4)
+
+import asyncio
+import collections
+import logging
+import os
+import signal
+import socket
+import sys
+import time
+import traceback
+
+logger = logging.getLogger('koa.server')
+
+# param app is a KoaApp, e.g. koa.core.app()
+# param workers is the number of worker processes, typically os.cpu_count(). With
+#       workers=1 the app is served in the calling process, without forking.
+# param reuse_port: use SO_REUSEPORT, defaults to True if the platform supports it
+# param shutdown_timeout: seconds in-flight requests get to finish on SIGINT/SIGTERM, see KoaApp.shutdown()
+# param max_quick_failures: give up (stopping all workers & exiting with status 1) once
+#       workers died this many times in a row within a second of being started, e.g. 
+#       because they fail to bind the port
+def serve(app, host='0.0.0.0', port=8480, workers=1, reuse_port=None, backlog=100, shutdown_timeout=10, max_quick_failures=5):
+  if reuse_port == None:
+    reuse_port = hasattr(socket, 'SO_REUSEPORT')
+  if workers <= 1:
+    run_worker(app, create_listening_socket(host, port, backlog, False), shutdown_timeout)
+    return
+  if not hasattr(os, 'fork'):
+    raise Exception("serve() with workers > 1 requires os.fork(), which this platform lacks")
+
+  # with SO_REUSEPORT every worker binds its own socket, see run_worker_process()
+  sock = None if reuse_port else create_listening_socket(host, port, backlog, False)
+  exit_code = WorkerSupervisor(app, workers, lambda: sock or create_listening_socket(host, port, backlog, True), shutdown_timeout, max_quick_failures).run()
+  if exit_code != 0:
+    sys.exit(exit_code)
+
+def create_listening_socket(host, port, backlog, reuse_port):
+  sock = socket.socket(socket.AF_INET6 if ':' in host else socket.AF_INET, socket.SOCK_STREAM)
+  sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+  if reuse_port:
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+  sock.bind((host, port))
+  sock.listen(backlog)
+  sock.setblocking(False)
+  return sock
+
+# serves the app on the given listening socket until SIGINT or SIGTERM, then shuts down
+# gracefully: in-flight requests get up to shutdown_timeout seconds to finish
+def run_worker(app, sock, shutdown_timeout=10):
+  loop = asyncio.new_event_loop()
+  asyncio.set_event_loop(loop)
+  server = loop.run_until_complete(loop.create_server(app.get_http_request_handler, sock=sock))
+  logger.info('process %s serving on %s', os.getpid(), sock.getsockname())
+  try:
+    for signum in (signal.SIGINT, signal.SIGTERM):
+      loop.add_signal_handler(signum, loop.stop)
+  except NotImplementedError:
+    pass # e.g. on Windows, where Ctrl-C still raises KeyboardInterrupt
+  try:
+    loop.run_forever()
+  except KeyboardInterrupt:
+    pass
+  finally:
+    loop.run_until_complete(app.shutdown(server, shutdown_timeout))
+    loop.run_until_complete(server.wait_closed())
+    loop.close()
+
+# describes a status as returned by os.waitpid(), e.g. 'exited with status 1'
+def describe_wait_status(status):
+  if os.WIFSIGNALED(status):
+    return 'was killed by signal {}'.format(os.WTERMSIG(status))
+  if os.WIFEXITED(status):
+    return 'exited with status {}'.format(os.WEXITSTATUS(status))
+  return 'exited with wait status {}'.format(status)
+
+# Forks & supervises the worker processes of serve()
+class WorkerSupervisor:
+
+  # param create_socket is a func returning the listening socket for a worker
+  def __init__(self, app, workers, create_socket, shutdown_timeout, max_quick_failures=5):
+    self.app = app
+    self.workers = workers
+    self.create_socket = create_socket
+    self.shutdown_timeout = shutdown_timeout
+    self.max_quick_failures = max_quick_failures
+    self.quick_failures = 0 # workers that died right after starting, in a row
+    self.start_times = {} # pid -> time.monotonic() when the worker was forked
+    self.exited = collections.deque() # (pid, status, uptime) of workers reaped while backing off
+    self.is_stopping = False
+    self.exit_code = 0
+
+  # returns the exit code for the master process once all workers exited
+  def run(self):
+    signal.signal(signal.SIGINT, self.stop)
+    signal.signal(signal.SIGTERM, self.stop)
+    for i in range(self.workers):
+      self.spawn_worker()
+    while len(self.start_times) > 0 or len(self.exited) > 0:
+      if len(self.exited) > 0:
+        (pid, status, uptime) = self.exited.popleft()
+      else:
+        try:
+          (pid, status) = os.waitpid(-1, 0)
+        except InterruptedError:
+          continue # python < 3.5 doesn't retry after our signal handler ran
+        except ChildProcessError:
+          break
+        uptime = self.get_uptime(pid)
+      if uptime == None or self.is_stopping:
+        continue
+      self.quick_failures = self.quick_failures + 1 if uptime < 1 else 0
+      if self.quick_failures >= self.max_quick_failures:
+        logger.error('worker %s %s, giving up since workers keep dying right after starting', pid, describe_wait_status(status))
+        self.exit_code = 1
+        self.stop(None, None)
+        continue
+      logger.warning('worker %s %s, restarting it', pid, describe_wait_status(status))
+      if self.quick_failures > 0:
+        self.back_off(1) # don't fork like crazy if workers die right after starting, e.g. due to a bad config
+      if not self.is_stopping:
+        self.spawn_worker()
+    return self.exit_code
+
+  # returns the seconds since the worker with the given pid was forked (forgetting it),
+  # None if it isn't one of ours
+  def get_uptime(self, pid):
+    started = self.start_times.pop(pid, None)
+    return time.monotonic() - started if started != None else None
+
+  # sleeps for the given seconds, meanwhile reaping workers as they exit, so that their
+  # uptime doesn't include the time spent sleeping
+  def back_off(self, seconds):
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline and not self.is_stopping:
+      time.sleep(min(0.05, max(0, deadline - time.monotonic())))
+      while len(self.start_times) > 0:
+        try:
+          (pid, status) = os.waitpid(-1, os.WNOHANG)
+        except InterruptedError:
+          continue
+        except ChildProcessError:
+          return
+        if pid == 0:
+          break # all workers are still alive
+        self.exited.append((pid, status, self.get_uptime(pid)))
+
+  def spawn_worker(self):
+    pid = os.fork()
+    if pid == 0:
+      self.run_worker_process() # never returns
+    self.start_times[pid] = time.monotonic()
+
+  def run_worker_process(self):
+    exit_code = 0
+    try:
+      signal.signal(signal.SIGINT, signal.SIG_DFL)
+      signal.signal(signal.SIGTERM, signal.SIG_DFL)
+      run_worker(self.app, self.create_socket(), self.shutdown_timeout)
+    except:
+      traceback.print_exc()
+      exit_code = 1
+    finally:
+      sys.stdout.flush()
+      sys.stderr.flush()
+      os._exit(exit_code) # skip the master's cleanup handlers (atexit & co)
+
+  # signal handler: stops all workers (which finish their in-flight requests first), 
+  # run() returns once they all exited
+  def stop(self, signum, frame):
+    self.is_stopping = True
+    for pid in list(self.start_times):
+      try:
+        os.kill(pid, signal.SIGTERM)
+      except ProcessLookupError:
+        pass
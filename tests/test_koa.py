@@ -1,9 +1,22 @@
 import unittest
 import asyncio
+import sys
+import os
+import signal
+import subprocess
+import tempfile
+import threading
+import concurrent.futures
+import textwrap
+import time
+import urllib.request
+import urllib.parse
 import aiohttp
 import json
 import koa.core
 import koa.common
+import koa.precompress
+import koa.server
 import pdb
 
 # spawns a temporary local test server, executes HTTP requests against it
@@ -22,10 +35,15 @@ class KoaTestSession:
     @asyncio.coroutine
     def coro():
       srv = yield from loop.create_server(self.app.get_http_request_handler, '0.0.0.0', self.port)
+      self.server = srv
       try:
         yield from test
       finally:
         yield srv.close()
+        # close the keep-alive connections lingering after the test
+        for connection in list(self.app.connections):
+          connection.closing()
+        yield from asyncio.sleep(0.01)
 
     loop.run_until_complete(coro())
     loop.close()
@@ -74,6 +92,88 @@ class KoaAppTestCase(unittest.TestCase):
     test_session = KoaTestSession(app)
     test_session.run_async_test(test())
 
+  def test_middleware_chain_nests_in_order(self):
+    calls = []
+
+    def create_middleware(name):
+      @asyncio.coroutine
+      def middleware(koa_context, next):
+        calls.append(name + ' enter')
+        yield from next
+        calls.append(name + ' exit')
+      return middleware
+
+    @asyncio.coroutine
+    def handler(koa_context, next):
+      calls.append('handler')
+      koa_context.response.body = "hi" # no explicit 'yield from next'
+
+    app = koa.core.app()
+    app.use(create_middleware('a'))
+    app.use(create_middleware('b'))
+    app.use(handler)
+
+    @asyncio.coroutine
+    def test():
+      response = yield from test_session.request('get', '/foo')
+      response_text = yield from response.text()
+      self.assertEqual(response.status, 200)
+      self.assertEqual(response_text, "hi")
+      self.assertEqual(calls, ['a enter', 'b enter', 'handler', 'b exit', 'a exit'])
+
+    test_session = KoaTestSession(app)
+    test_session.run_async_test(test())
+
+  def test_use_after_server_start_recompiles_chain(self):
+
+    @asyncio.coroutine
+    def handler(koa_context, next):
+      koa_context.response.body = "late"
+
+    app = koa.core.app()
+
+    @asyncio.coroutine
+    def test():
+      response = yield from test_session.request('get', '/foo')
+      self.assertEqual(response.status, 404)
+      app.use(handler)
+      response = yield from test_session.request('get', '/foo')
+      response_text = yield from response.text()
+      self.assertEqual(response.status, 200)
+      self.assertEqual(response_text, "late")
+
+    test_session = KoaTestSession(app)
+    test_session.run_async_test(test())
+
+  @unittest.skipIf(sys.version_info < (3, 5), "native coroutines require python 3.5")
+  def test_native_coroutine_middleware(self):
+    # exec'd so this module still compiles on python 3.4
+    calls = []
+    namespace = {'calls': calls}
+    exec(textwrap.dedent("""
+      async def outer(koa_context, next):
+        await next
+        calls.append('outer exit')
+
+      async def handler(koa_context, next):
+        koa_context.response.body = "native"
+    """), namespace)
+
+    app = koa.core.app()
+    app.use(namespace['outer'])
+    app.use(namespace['handler'])
+
+    @asyncio.coroutine
+    def test():
+      response = yield from test_session.request('get', '/foo')
+      response_text = yield from response.text()
+      self.assertEqual(response.status, 200)
+      self.assertEqual(response_text, "native")
+      self.assertEqual(calls, ['outer exit'])
+
+    test_session = KoaTestSession(app)
+    test_session.run_async_test(test())
+
   def test_koa_router_http_get_json(self):
 
     @asyncio.coroutine
@@ -92,11 +192,42 @@ class KoaAppTestCase(unittest.TestCase):
       response_json = yield from response.json()
       self.assertEqual(response.status, 200)
       self.assertEqual(response.headers['CONTENT-TYPE'], 'application/json')
+      self.assertEqual('VARY' in response.headers, app.serializers.is_negotiated({})) # only with msgpack or cbor2 installed
       self.assertEqual(response_json, {"foo": "bar", "bla": 7})
 
     test_session = KoaTestSession(app)
     test_session.run_async_test(test())
 
+  def test_serializers_negotiate_accept_header(self):
+
+    @asyncio.coroutine
+    def handle_get(koa_context, next):
+      koa_context.response.body = [['a', 1], ['b', 2]]
+
+    app = koa.core.app()
+    app.serializers.add_encoder('text/csv', lambda rows: "\n".join(",".join(str(cell) for cell in row) for row in rows).encode('utf8'), body_types=(list,))
+    router = koa.common.router()
+    router.get("/baz", handle_get)
+    app.use(router.middleware())
+
+    @asyncio.coroutine
+    def test():
+      # JSON stays the default
+      response = yield from test_session.request('get', '/baz', headers = {'accept': 'text/html, */*;q=0.1'})
+      response_json = yield from response.json()
+      self.assertEqual(response.headers['CONTENT-TYPE'], 'application/json')
+      self.assertEqual(response.headers['VARY'], 'Accept')
+      self.assertEqual(response_json, [['a', 1], ['b', 2]])
+
+      response = yield from test_session.request('get', '/baz', headers = {'accept': 'text/csv, application/json;q=0.5'})
+      response_text = yield from response.text()
+      self.assertEqual(response.headers['CONTENT-TYPE'], 'text/csv')
+      self.assertEqual(response.headers['VARY'], 'Accept')
+      self.assertEqual(response_text, "a,1\nb,2")
+
+    test_session = KoaTestSession(app)
+    test_session.run_async_test(test())
+
   def test_koa_router_http_get_text(self):
 
     @asyncio.coroutine
@@ -141,6 +272,82 @@ class KoaAppTestCase(unittest.TestCase):
     test_session = KoaTestSession(app)
     test_session.run_async_test(test())
 
+  def test_streaming_generator_body_is_chunked(self):
+
+    @asyncio.coroutine
+    def handle_get(koa_context, next):
+      koa_context.response.body = ("chunk{} ".format(i).encode('utf8') for i in range(3))
+
+    app = koa.core.app()
+    router = koa.common.router()
+    router.get("/baz", handle_get)
+    app.use(router.middleware())
+
+    @asyncio.coroutine
+    def test():
+      response = yield from test_session.request('get', '/baz')
+      response_bytes = yield from response.read()
+      self.assertEqual(response.status, 200)
+      self.assertEqual(response.headers['TRANSFER-ENCODING'], 'chunked')
+      self.assertNotIn('CONTENT-LENGTH', response.headers)
+      self.assertEqual(response_bytes, b"chunk0 chunk1 chunk2 ")
+
+    test_session = KoaTestSession(app)
+    test_session.run_async_test(test())
+
+  def test_streaming_file_body(self):
+
+    @asyncio.coroutine
+    def handle_get(koa_context, next):
+      koa_context.response.body = open('./testdata/xyz.dat', 'rb') # closed by koa after streaming
+      koa_context.response.type = 'text/plain'
+
+    app = koa.core.app()
+    router = koa.common.router()
+    router.get("/baz", handle_get)
+    app.use(router.middleware())
+
+    @asyncio.coroutine
+    def test():
+      response = yield from test_session.request('get', '/baz')
+      response_bytes = yield from response.read()
+      self.assertEqual(response.status, 200)
+      self.assertEqual(response.headers['CONTENT-TYPE'], 'text/plain')
+      self.assertEqual(response_bytes, "content of xyz.dat".encode('utf8'))
+
+    test_session = KoaTestSession(app)
+    test_session.run_async_test(test())
+
+  @unittest.skipIf(sys.version_info < (3, 6), "async generators require python 3.6")
+  def test_streaming_async_generator_body(self):
+    # exec'd so this module still compiles on python 3.4
+    namespace = {'asyncio': asyncio}
+    exec(textwrap.dedent("""
+      async def chunks():
+        for i in range(3):
+          await asyncio.sleep(0)
+          yield "async{} ".format(i)
+    """), namespace)
+
+    @asyncio.coroutine
+    def handle_get(koa_context, next):
+      koa_context.response.body = namespace['chunks']()
+
+    app = koa.core.app()
+    router = koa.common.router()
+    router.get("/baz", handle_get)
+    app.use(router.middleware())
+
+    @asyncio.coroutine
+    def test():
+      response = yield from test_session.request('get', '/baz')
+      response_bytes = yield from response.read()
+      self.assertEqual(response.status, 200)
+      self.assertEqual(response_bytes, b"async0 async1 async2 ")
+
+    test_session = KoaTestSession(app)
+    test_session.run_async_test(test())
+
   def test_koa_router_http_post(self):
 
     @asyncio.coroutine
@@ -189,6 +396,34 @@ class KoaAppTestCase(unittest.TestCase):
     test_session = KoaTestSession(app)
     test_session.run_async_test(test())
 
+  def test_request_and_context_are_shared_types(self):
+    # KoaRequest/KoaContext live at module level, so isinstance() works across apps
+    contexts = []
+
+    @asyncio.coroutine
+    def middleware(koa_context, next):
+      contexts.append(koa_context)
+      koa_context.state['user'] = 'foo'
+      koa_context.response.body = koa_context.request.path.path + '?' + koa_context.request.querystring
+
+    app = koa.core.app()
+    app.use(middleware)
+
+    @asyncio.coroutine
+    def test():
+      response = yield from test_session.request('get', '/foo?a=1')
+      response_text = yield from response.text()
+      self.assertEqual(response_text, "/foo?a=1")
+      self.assertIsInstance(contexts[0], koa.core.KoaContext)
+      self.assertIsInstance(contexts[0].request, koa.core.KoaRequest)
+      self.assertEqual(contexts[0].request.query, {'a': ['1']})
+      self.assertEqual(contexts[0].state, {'user': 'foo'})
+      with self.assertRaises(AttributeError):
+        contexts[0].some_undeclared_attribute = 1
+
+    test_session = KoaTestSession(app)
+    test_session.run_async_test(test())
+
   def test_koa_router_http_get_with_route_params(self):
 
     @asyncio.coroutine
@@ -253,6 +488,69 @@ class KoaAppTestCase(unittest.TestCase):
     test_session = KoaTestSession(app)
     test_session.run_async_test(test())
 
+  def test_koa_router_prefers_static_over_param_routes(self):
+
+    def create_handler(name):
+      @asyncio.coroutine
+      def handle_get(koa_context, next):
+        koa_context.response.body = "{} {}".format(name, koa_context.request.params)
+      return handle_get
+
+    app = koa.core.app()
+    router = koa.common.router()
+    for i in range(100):
+      router.get("/items{}/:id".format(i), create_handler("item"))
+    router.get("/users/:id/name", create_handler("user_name"))
+    router.get("/users/:id", create_handler("user"))
+    router.get("/users/me", create_handler("me"))
+    router.post("/users/:id", create_handler("post"))
+    app.use(router.middleware())
+
+    @asyncio.coroutine
+    def test():
+      for (path, expected) in [
+          ('/users/me', "me {}"),
+          ('/users/123', "user {'id': '123'}"),
+          ('/users/me/name', "user_name {'id': 'me'}"),
+          ('/items99/7', "item {'id': '7'}")]:
+        response = yield from test_session.request('get', path)
+        response_text = yield from response.text()
+        self.assertEqual(response.status, 200)
+        self.assertEqual(response_text, expected)
+
+    test_session = KoaTestSession(app)
+    test_session.run_async_test(test())
+
+  def test_koa_router_caches_matches(self):
+
+    @asyncio.coroutine
+    def handle_get(koa_context, next):
+      pass
+
+    router = koa.common.router(cache_size=2)
+    router.get("/admin/version", handle_get)
+    router.get("/users/:id", handle_get)
+
+    for i in range(3):
+      [(route, params)] = router.match('GET', '/admin/version')
+      self.assertEqual(route.path.path, '/admin/version')
+      self.assertEqual(params, {})
+    self.assertEqual((router.cache_hits, router.cache_misses), (0, 0)) # served by the static routes dict
+
+    self.assertEqual(router.match('GET', '/users/1')[0][1], {'id': '1'})
+    self.assertEqual(router.match('GET', '/users/1')[0][1], {'id': '1'})
+    self.assertEqual((router.cache_hits, router.cache_misses), (1, 1))
+
+    self.assertEqual(router.match('GET', '/users/2')[0][1], {'id': '2'})
+    self.assertEqual(router.match('GET', '/users/3')[0][1], {'id': '3'}) # evicts '/users/1'
+    self.assertEqual(router.match('GET', '/users/1')[0][1], {'id': '1'})
+    self.assertEqual((router.cache_hits, router.cache_misses), (1, 4))
+    self.assertEqual(router.match('POST', '/users/1'), [])
+
+    router.get("/users/me", handle_get) # invalidates the cache
+    [(route, params)] = router.match('GET', '/users/me')
+    self.assertEqual(route.path.path, '/users/me')
+
   def test_koa_mount_composition(self):
 
     @asyncio.coroutine
@@ -284,6 +582,58 @@ class KoaAppTestCase(unittest.TestCase):
     test_session = KoaTestSession(app)
     test_session.run_async_test(test())
 
+  def test_mounted_path_behaves_like_parse_result(self):
+    parsed = urllib.parse.urlparse('/foo/bar?x=1')
+    mounted = koa.core.KoaMountedPath(parsed, '/bar')
+    expected = urllib.parse.urlparse('/bar?x=1')
+    self.assertEqual(mounted, expected)
+    self.assertEqual(hash(mounted), hash(expected))
+    self.assertEqual({mounted: 1}[expected], 1)
+    self.assertEqual(mounted._replace(query=''), urllib.parse.urlparse('/bar'))
+    self.assertEqual(tuple(mounted), tuple(expected))
+    self.assertEqual(mounted[2], '/bar')
+    self.assertEqual((mounted.query, mounted.geturl()), ('x=1', '/bar?x=1'))
+
+  def test_koa_sibling_mounts_are_fused(self):
+    visited = []
+
+    def create_mounted_middleware(name):
+      @asyncio.coroutine
+      def mounted_middleware(koa_context, next):
+        request = koa_context.request
+        visited.append( (name, request.path.path, request.path.query, request.original_path.path) )
+      return mounted_middleware
+
+    app = koa.core.app()
+    for i in range(40):
+      app.use(koa.common.mount('/app{}'.format(i), create_mounted_middleware(i)))
+    app.use(koa.common.mount('/', create_mounted_middleware('root')))
+    app.use(koa.common.mount('/app3/nested/', create_mounted_middleware('nested')))
+    self.assertEqual(len(koa.core.fuse_middlewares(app.middlewares)), 1)
+
+    @asyncio.coroutine
+    def test():
+      response = yield from test_session.request('get', '/app3/nested/foo?x=1')
+      self.assertEqual(response.status, 404)
+      yield from response.read()
+      self.assertEqual(visited, [
+        (3, '/nested/foo', 'x=1', '/app3/nested/foo'), 
+        ('root', '/app3/nested/foo', 'x=1', '/app3/nested/foo'), 
+        ('nested', '/foo', 'x=1', '/app3/nested/foo')])
+
+      del visited[:]
+      response = yield from test_session.request('get', '/app30')
+      yield from response.read()
+      response = yield from test_session.request('get', '/app300/foo')
+      yield from response.read()
+      self.assertEqual(visited, [
+        (30, '', '', '/app30'), 
+        ('root', '/app30', '', '/app30'), 
+        ('root', '/app300/foo', '', '/app300/foo')])
+
+    test_session = KoaTestSession(app)
+    test_session.run_async_test(test())
+
   def test_koa_body_parser_http_post_json(self):
 
     @asyncio.coroutine
@@ -312,93 +662,1462 @@ class KoaAppTestCase(unittest.TestCase):
     test_session = KoaTestSession(app)
     test_session.run_async_test(test())
 
-  def test_koa_static_returns_file_content(self):
+  def test_koa_body_parser_reads_large_and_chunked_bodies(self):
+    lines = ['line {}'.format(i) for i in range(10000)] # used to be truncated after 10 lines
+
+    @asyncio.coroutine
+    def handle_post(koa_context, next):
+      koa_context.response.body = str(len(koa_context.request.body.split('\n')))
 
     app = koa.core.app()
-    app.use(koa.common.static('./testdata'))
+    app.use(koa.common.create_body_parser(max_size=100000))
+    router = koa.common.router()
+    router.post("/baz", handle_post)
+    app.use(router.middleware())
+
+    def generate_chunks():
+      for i in range(0, len(lines), 1000):
+        yield ('\n'.join(lines[i:i+1000]) + '\n').encode('utf-8')
 
     @asyncio.coroutine
     def test():
-      response = yield from test_session.request('get', '/foo/bar.txt')
-      response_bytes = yield from response.read()
+      headers = {'content-type': 'text/plain'}
+      response = yield from test_session.request('post', '/baz', data='\n'.join(lines), headers=headers)
+      response_text = yield from response.text()
       self.assertEqual(response.status, 200)
-      self.assertEqual(response.headers['CONTENT-TYPE'], 'text/html')
-      self.assertEqual(response_bytes, "content of bar.txt".encode('utf8'))
+      self.assertEqual(response_text, "10000")
+
+      response = yield from test_session.request('post', '/baz', data=generate_chunks(), headers=headers)
+      response_text = yield from response.text()
+      self.assertEqual(response.status, 200)
+      self.assertEqual(response_text, "10001") # trailing newline
+
+      response = yield from test_session.request('post', '/baz', data='x' * 100001, headers=headers)
+      yield from response.read()
+      self.assertEqual(response.status, 413)
+
+      response = yield from test_session.request('post', '/baz', data=(chunk * 2 for chunk in generate_chunks()), headers=headers)
+      yield from response.read()
+      self.assertEqual(response.status, 413)
 
     test_session = KoaTestSession(app)
     test_session.run_async_test(test())
 
-  def test_mounted_koa_static_returns_file_content(self):
+  def test_koa_lazy_body_parser_decodes_on_demand(self):
+    loads = []
+
+    @asyncio.coroutine
+    def handle_post(koa_context, next):
+      body = yield from koa_context.request.json()
+      self.assertIs((yield from koa_context.request.body), body) # cached
+      koa_context.response.body = body
+
+    @asyncio.coroutine
+    def handle_ignored_post(koa_context, next):
+      self.assertIsInstance(koa_context.request.body, koa.core.KoaLazyBody)
+      koa_context.response.body = "ignored"
 
     app = koa.core.app()
-    app.use(koa.common.mount('/data', koa.common.static('./testdata')))
+    app.serializers.add_decoder('application/json', lambda data, charset: loads.append(data) or json.loads(data.decode('utf-8')))
+    app.use(koa.common.create_body_parser(max_size=100, lazy=True))
+    router = koa.common.router()
+    router.post("/baz", handle_post)
+    router.post("/ignored", handle_ignored_post)
+    app.use(router.middleware())
 
     @asyncio.coroutine
     def test():
-      response = yield from test_session.request('get', '/data/foo/bar.txt')
-      response_bytes = yield from response.read()
+      headers = {'content-type': 'application/json'}
+      response = yield from test_session.request('post', '/baz', data=json.dumps({"foo": 7}), headers=headers)
+      response_json = yield from response.json()
       self.assertEqual(response.status, 200)
-      self.assertEqual(response.headers['CONTENT-TYPE'], 'text/html')
-      self.assertEqual(response_bytes, "content of bar.txt".encode('utf8'))
+      self.assertEqual(response_json, {"foo": 7})
+      self.assertEqual(len(loads), 1)
+
+      response = yield from test_session.request('post', '/ignored', data=json.dumps({"foo": 7}), headers=headers)
+      response_text = yield from response.text()
+      self.assertEqual(response_text, "ignored")
+      self.assertEqual(len(loads), 1)
+
+      response = yield from test_session.request('post', '/baz', data=json.dumps({"foo": 'x' * 100}), headers=headers)
+      yield from response.read()
+      self.assertEqual(response.status, 413)
+      self.assertEqual(len(loads), 1)
 
     test_session = KoaTestSession(app)
     test_session.run_async_test(test())
 
-  def test_koa_logger(self):
+  def test_koa_form_parser_spools_large_files(self):
+    file_content = os.urandom(300 * 1024)
+    body = b''.join([
+      b'preamble\r\n--XyZ\r\n',
+      b'Content-Disposition: form-data; name="title"\r\n\r\n',
+      'h\u00e9llo'.encode('utf-8'),
+      b'\r\n--XyZ\r\n',
+      b'Content-Disposition: form-data; name="tag"\r\n\r\na',
+      b'\r\n--XyZ\r\n',
+      b'Content-Disposition: form-data; name="tag"\r\n\r\nb',
+      b'\r\n--XyZ\r\n',
+      b'Content-Disposition: form-data; name="upload"; filename="a \\"b\\".bin"\r\n',
+      b'Content-Type: application/octet-stream\r\n\r\n',
+      file_content,
+      b'\r\n--XyZ--\r\nepilogue'])
+
+    @asyncio.coroutine
+    def handle_post(koa_context, next):
+      fields = koa_context.request.body
+      upload = fields['upload']
+      self.assertEqual(upload.filename, 'a "b".bin')
+      self.assertEqual(upload.size, len(file_content))
+      self.assertTrue(upload.is_spooled)
+      self.assertEqual(upload.file.read(), file_content)
+      koa_context.response.body = {'title': fields['title'], 'tag': fields['tag']}
+
+    @asyncio.coroutine
+    def handle_post_urlencoded(koa_context, next):
+      koa_context.response.body = koa_context.request.body
+
     app = koa.core.app()
-    app.use(koa.common.logger)
+    app.use(koa.common.create_form_parser(spool_threshold=64*1024, max_field_size=100))
+    app.use(koa.common.body_parser)
+    router = koa.common.router()
+    router.post("/upload", handle_post)
+    router.post("/form", handle_post_urlencoded)
+    app.use(router.middleware())
+
+    def generate_chunks(chunk_size):
+      for i in range(0, len(body), chunk_size):
+        yield body[i:i+chunk_size]
 
     @asyncio.coroutine
     def test():
-      response = yield from test_session.request('get', '/foo')
-      response_text = yield from response.text()
-      self.assertEqual(response.status, 404)
-      # note this test didn't verify anything actually got logged, kinda lame
+      headers = {'content-type': 'multipart/form-data; boundary="XyZ"'}
+      for data in [body, generate_chunks(7), generate_chunks(64*1024)]:
+        response = yield from test_session.request('post', '/upload', data=data, headers=headers)
+        response_json = yield from response.json()
+        self.assertEqual(response.status, 200)
+        self.assertEqual(response_json, {'title': 'h\u00e9llo', 'tag': ['a', 'b']})
+
+      response = yield from test_session.request('post', '/upload', data=body.replace(b'--XyZ--', b''), headers=headers)
+      yield from response.read()
+      self.assertEqual(response.status, 400)
+
+      response = yield from test_session.request('post', '/upload', data=body.replace(b'\r\na\r\n', b'\r\n' + b'a' * 101 + b'\r\n'), headers=headers)
+      yield from response.read()
+      self.assertEqual(response.status, 413)
+
+      response = yield from test_session.request('post', '/form', data='a=1&b=2&b=%C3%A9&c=', 
+        headers={'content-type': 'application/x-www-form-urlencoded'})
+      response_json = yield from response.json()
+      self.assertEqual(response_json, {'a': '1', 'b': ['2', '\u00e9'], 'c': ''})
 
     test_session = KoaTestSession(app)
     test_session.run_async_test(test())
 
-  def test_koa_auth(self):
-    app = koa.core.app()
+  def test_koa_form_parser_bounds_memory_per_request(self):
 
-    # this is not a middleware, it's just a regular coroutine returning a bool
-    @asyncio.coroutine
-    def my_credential_validator(user, password):
-      return user == 'foo' and password == 'secret'
+    def make_body(parts):
+      return b''.join(b'--XyZ\r\n' + part + b'\r\n' for part in parts) + b'--XyZ--\r\n'
 
-    # this is middleware that is supposed to be basic-auth-protected
-    @asyncio.coroutine
-    def my_middleware(koa_context, next):
-      koa_context.response.body = "hi"
+    def make_file(i, size):
+      return 'Content-Disposition: form-data; name="f{0}"; filename="{0}.bin"\r\n\r\n'.format(i).encode('ascii') + b'x' * size
 
-    app.use(koa.common.basic_auth(my_credential_validator))
-    app.use(my_middleware)
+    def make_field(i, value):
+      return 'Content-Disposition: form-data; name="t{}"\r\n\r\n'.format(i).encode('ascii') + value
 
     @asyncio.coroutine
-    def test():
+    def handle_post(koa_context, next):
+      uploads = [value for value in koa_context.request.body.values() if isinstance(value, koa.common.UploadedFile)]
+      in_memory = [upload for upload in uploads if not upload.is_spooled]
+      koa_context.response.body = {'in_memory': len(in_memory), 'spooled': len(uploads) - len(in_memory)}
 
-      # test successful auth
-      response = yield from test_session.request('get', '/foo', auth = aiohttp.helpers.BasicAuth('foo', 'secret', 'utf-8'))
-      responseText = yield from response.text()
-      self.assertEqual(response.status, 200)
-      self.assertEqual(responseText, "hi")
+    app = koa.core.app()
+    app.use(koa.common.create_form_parser(spool_threshold=64*1024, max_field_size=100, max_fields_size=250, max_parts=20))
+    router = koa.common.router()
+    router.post("/upload", handle_post)
+    router.post("/form", handle_post)
+    app.use(router.middleware())
 
-      # test wrong pass
-      response = yield from test_session.request('get', '/foo', auth = aiohttp.helpers.BasicAuth('foo', 'wrong pass', 'utf-8'))
-      self.assertEqual(response.status, 401)
+    @asyncio.coroutine
+    def post(path, data, content_type='multipart/form-data; boundary=XyZ'):
+      response = yield from test_session.request('post', path, data=data, headers={'content-type': content_type})
+      response_text = yield from response.text()
+      return (response.status, json.loads(response_text) if response.status == 200 else None)
 
-      # test missing auth
-      response = yield from test_session.request('get', '/foo')
-      self.assertEqual(response.status, 401)
+    @asyncio.coroutine
+    def test():
+      # 10 files of 10k each, none above spool_threshold on its own
+      (status, counts) = yield from post('/upload', make_body([make_file(i, 10*1024) for i in range(10)]))
+      self.assertEqual(status, 200)
+      self.assertEqual(counts, {'in_memory': 6, 'spooled': 4})
+
+      self.assertEqual((yield from post('/upload', make_body([make_file(i, 1) for i in range(21)])))[0], 413)
+      self.assertEqual((yield from post('/upload', make_body([make_field(i, b'a' * 100) for i in range(3)])))[0], 413)
+      self.assertEqual((yield from post('/upload', make_body([make_field(0, b'\xff\xfe')])))[0], 400)
+      self.assertEqual((yield from post('/form', b'a=\xff\xfe', 'application/x-www-form-urlencoded'))[0], 400)
+      self.assertEqual((yield from post('/form', b'a=1', 'application/x-www-form-urlencoded; charset=no-such-charset'))[0], 400)
 
     test_session = KoaTestSession(app)
     test_session.run_async_test(test())
 
-  def test_verify_is_middleware_passes_for_decorated_coro(self):
-    @asyncio.coroutine
-    def f(context, next):
-      yield from next
-    koa.core.verify_is_middleware(f)
+  def test_koa_body_parser_uses_registered_decoder(self):
+
+    @asyncio.coroutine
+    def handle_post(koa_context, next):
+      koa_context.response.body = koa_context.request.body
+
+    app = koa.core.app()
+    app.serializers.add_decoder('text/csv', lambda data, charset: [line.split(',') for line in data.decode(charset or 'utf8').split('\n')])
+    app.use(koa.common.body_parser)
+    router = koa.common.router()
+    router.post("/baz", handle_post)
+    app.use(router.middleware())
+
+    @asyncio.coroutine
+    def test():
+      response = yield from test_session.request('post', '/baz', 
+        data = "a,1\nb,2",
+        headers = {'content-type': 'text/csv'}
+      )
+      response_json = yield from response.json()
+      self.assertEqual(response.status, 200)
+      self.assertEqual(response_json, [['a', '1'], ['b', '2']])
+
+    test_session = KoaTestSession(app)
+    test_session.run_async_test(test())
+
+  def test_koa_body_parser_honors_charset(self):
+
+    @asyncio.coroutine
+    def handle_post(koa_context, next):
+      self.assertEqual(koa_context.request.type, 'text/plain')
+      self.assertEqual(koa_context.request.charset, 'latin-1')
+      koa_context.response.body = koa_context.request.body
+
+    app = koa.core.app()
+    app.use(koa.common.body_parser)
+    router = koa.common.router()
+    router.post("/baz", handle_post)
+    app.use(router.middleware())
+
+    @asyncio.coroutine
+    def test():
+      response = yield from test_session.request('post', '/baz', 
+        data = "caf\u00e9".encode('latin-1'),
+        headers = {'content-type': 'text/plain; charset=latin-1'}
+      )
+      response_text = yield from response.text()
+      self.assertEqual(response.status, 200)
+      self.assertEqual(response_text, "caf\u00e9")
+
+    test_session = KoaTestSession(app)
+    test_session.run_async_test(test())
+
+  def test_koa_body_parser_rejects_malformed_bodies_with_400(self):
+
+    @asyncio.coroutine
+    def handle_post(koa_context, next):
+      koa_context.response.body = "unreachable"
+
+    app = koa.core.app()
+    app.use(koa.common.body_parser)
+    router = koa.common.router()
+    router.post("/baz", handle_post)
+    app.use(router.middleware())
+
+    @asyncio.coroutine
+    def test():
+      for (data, content_type) in ((b'{"a": ', 'application/json'), (b'\xff\xfe', 'text/plain'), (b'hi', 'text/plain; charset=no-such-charset')):
+        response = yield from test_session.request('post', '/baz', data = data, headers = {'content-type': content_type})
+        yield from response.read()
+        self.assertEqual(response.status, 400)
+
+    test_session = KoaTestSession(app)
+    test_session.run_async_test(test())
+
+  def test_request_length_rejects_malformed_content_length(self):
+    class Message:
+      method = 'POST'
+      path = '/'
+      def __init__(self, content_length):
+        self.headers = {'CONTENT-LENGTH': content_length}
+
+    self.assertEqual(koa.core.KoaRequest(Message('12')).length, 12)
+    for content_length in ('abc', '-1', '1e3', ''):
+      with self.assertRaises(koa.core.KoaException) as raised:
+        koa.core.KoaRequest(Message(content_length)).length
+      self.assertEqual(raised.exception.status, 400)
+
+  def test_koa_compress(self):
+    big_text = "hello world " * 1000
+
+    @asyncio.coroutine
+    def handle_get_big(koa_context, next):
+      koa_context.response.body = big_text
+
+    @asyncio.coroutine
+    def handle_get_small(koa_context, next):
+      koa_context.response.body = "hello"
+
+    @asyncio.coroutine
+    def handle_get_png(koa_context, next):
+      koa_context.response.body = big_text.encode('utf8')
+      koa_context.response.type = 'image/png'
+
+    @asyncio.coroutine
+    def handle_get_stream(koa_context, next):
+      koa_context.response.body = (big_text.encode('utf8') for i in range(3))
+      koa_context.response.type = 'text/plain'
+
+    app = koa.core.app()
+    app.use(koa.common.compress(executor_threshold=4096))
+    router = koa.common.router()
+    router.get("/big", handle_get_big)
+    router.get("/small", handle_get_small)
+    router.get("/png", handle_get_png)
+    router.get("/stream", handle_get_stream)
+    app.use(router.middleware())
+
+    @asyncio.coroutine
+    def test():
+      # aiohttp's client sends 'Accept-Encoding: gzip, deflate' and transparently decompresses
+      response = yield from test_session.request('get', '/big')
+      response_text = yield from response.text()
+      self.assertEqual(response.status, 200)
+      self.assertEqual(response.headers['CONTENT-ENCODING'], 'gzip')
+      self.assertEqual(response.headers['VARY'], 'Accept-Encoding')
+      self.assertTrue(int(response.headers['CONTENT-LENGTH']) < len(big_text))
+      self.assertEqual(response_text, big_text)
+
+      response = yield from test_session.request('get', '/big', headers = {'accept-encoding': 'identity'})
+      response_text = yield from response.text()
+      self.assertNotIn('CONTENT-ENCODING', response.headers)
+      self.assertEqual(response_text, big_text)
+
+      response = yield from test_session.request('get', '/small')
+      response_text = yield from response.text()
+      self.assertNotIn('CONTENT-ENCODING', response.headers)
+      self.assertEqual(response_text, "hello")
+
+      response = yield from test_session.request('get', '/png')
+      response_bytes = yield from response.read()
+      self.assertNotIn('CONTENT-ENCODING', response.headers)
+      self.assertEqual(response_bytes, big_text.encode('utf8'))
+
+      response = yield from test_session.request('get', '/stream')
+      response_text = yield from response.text()
+      self.assertEqual(response.headers['CONTENT-ENCODING'], 'gzip')
+      self.assertEqual(response.headers['TRANSFER-ENCODING'], 'chunked')
+      self.assertEqual(response_text, big_text * 3)
+
+    test_session = KoaTestSession(app)
+    test_session.run_async_test(test())
+
+  def test_koa_static_returns_file_content(self):
+
+    app = koa.core.app()
+    app.use(koa.common.static('./testdata'))
+
+    @asyncio.coroutine
+    def test():
+      response = yield from test_session.request('get', '/foo/bar.txt')
+      response_bytes = yield from response.read()
+      self.assertEqual(response.status, 200)
+      self.assertEqual(response.headers['CONTENT-TYPE'], 'text/html')
+      self.assertEqual(response_bytes, "content of bar.txt".encode('utf8'))
+
+    test_session = KoaTestSession(app)
+    test_session.run_async_test(test())
+
+  def test_koa_static_cache(self):
+    temp_dir = tempfile.TemporaryDirectory()
+    self.addCleanup(temp_dir.cleanup)
+    for name in ('a.txt', 'b.txt', 'c.txt'):
+      with open(os.path.join(temp_dir.name, name), 'w') as f:
+        f.write("content of " + name)
+
+    cache = koa.common.StaticFileCache(max_entries=2, revalidate_interval=0)
+    app = koa.core.app()
+    app.use(koa.common.static(temp_dir.name, cache=cache))
+
+    @asyncio.coroutine
+    def get(path):
+      response = yield from test_session.request('get', path)
+      response_bytes = yield from response.read()
+      return (response.status, response_bytes.decode('utf8'))
+
+    @asyncio.coroutine
+    def test():
+      self.assertEqual((yield from get('/a.txt')), (200, "content of a.txt"))
+      self.assertEqual((yield from get('/a.txt')), (200, "content of a.txt"))
+      self.assertEqual((cache.hits, cache.misses, len(cache)), (1, 1, 1))
+
+      # a changed size (or mtime) invalidates the entry
+      with open(os.path.join(temp_dir.name, 'a.txt'), 'w') as f:
+        f.write("new content of a.txt")
+      self.assertEqual((yield from get('/a.txt')), (200, "new content of a.txt"))
+      self.assertEqual((cache.hits, cache.misses), (1, 2))
+      self.assertEqual(cache.size, len("new content of a.txt"))
+
+      # evicts the least recently used entry
+      yield from get('/b.txt')
+      yield from get('/c.txt')
+      self.assertEqual(len(cache), 2)
+      self.assertEqual(cache.get(os.path.join(temp_dir.name, 'a.txt')), None)
+
+      os.remove(os.path.join(temp_dir.name, 'c.txt'))
+      self.assertEqual((yield from get('/c.txt'))[0], 404)
+      self.assertEqual(len(cache), 1)
+
+      # immutable caches don't even stat the files
+      cache.immutable = True
+      os.remove(os.path.join(temp_dir.name, 'b.txt'))
+      self.assertEqual((yield from get('/b.txt')), (200, "content of b.txt"))
+
+    test_session = KoaTestSession(app)
+    test_session.run_async_test(test())
+
+  def test_koa_static_conditional_get(self):
+    temp_dir = tempfile.TemporaryDirectory()
+    self.addCleanup(temp_dir.cleanup)
+    with open(os.path.join(temp_dir.name, 'a.txt'), 'w') as f:
+      f.write("content of a.txt")
+
+    app = koa.core.app()
+    app.use(koa.common.mount('/cached', koa.common.static(temp_dir.name, cache=koa.common.StaticFileCache(), cache_control='public, max-age=60')))
+    app.use(koa.common.mount('/uncached', koa.common.static(temp_dir.name)))
+
+    @asyncio.coroutine
+    def get(path, **headers):
+      # aiohttp 0.9's client reads bodiless 304s until EOF, so don't keep the connection alive
+      headers['Connection'] = 'close'
+      response = yield from test_session.request('get', path, headers=headers)
+      response_bytes = yield from response.read()
+      return (response.status, response.headers, response_bytes)
+
+    @asyncio.coroutine
+    def test():
+      for path in ('/uncached/a.txt', '/cached/a.txt'):
+        (status, headers, body) = yield from get(path)
+        self.assertEqual(status, 200)
+        self.assertEqual(body, b"content of a.txt")
+        etag = headers['ETAG']
+        last_modified = headers['LAST-MODIFIED']
+
+        (status, headers, body) = yield from get(path, **{'If-None-Match': 'W/"foo", ' + etag})
+        self.assertEqual(status, 304)
+        self.assertEqual(body, b'')
+        self.assertEqual(headers['LAST-MODIFIED'], last_modified)
+        (status, headers, body) = yield from get(path, **{'If-None-Match': '"foo"', 'If-Modified-Since': last_modified})
+        self.assertEqual(status, 200)
+        (status, headers, body) = yield from get(path, **{'If-Modified-Since': last_modified})
+        self.assertEqual(status, 304)
+        (status, headers, body) = yield from get(path, **{'If-Modified-Since': 'Thu, 01 Jan 1970 00:00:00 GMT'})
+        self.assertEqual(status, 200)
+      self.assertEqual(headers['CACHE-CONTROL'], 'public, max-age=60')
+      self.assertTrue(etag.startswith('"') and '-' not in etag) # content hash
+
+      # the size & mtime ETag sent before the file got cached stays valid
+      (status, headers, body) = yield from get('/uncached/a.txt')
+      (status, headers, body) = yield from get('/cached/a.txt', **{'If-None-Match': headers['ETAG']})
+      self.assertEqual(status, 304)
+
+    test_session = KoaTestSession(app)
+    test_session.run_async_test(test())
+
+  def test_koa_static_range_requests(self):
+    temp_dir = tempfile.TemporaryDirectory()
+    self.addCleanup(temp_dir.cleanup)
+    content = bytes(range(256)) * 1000
+    with open(os.path.join(temp_dir.name, 'a.bin'), 'wb') as f:
+      f.write(content)
+
+    app = koa.core.app()
+    app.use(koa.common.mount('/cached', koa.common.static(temp_dir.name, cache=koa.common.StaticFileCache())))
+    app.use(koa.common.mount('/uncached', koa.common.static(temp_dir.name)))
+
+    @asyncio.coroutine
+    def get(path, **headers):
+      response = yield from test_session.request('get', path, headers=headers)
+      response_bytes = yield from response.read()
+      return (response.status, response.headers, response_bytes)
+
+    @asyncio.coroutine
+    def test():
+      for path in ('/uncached/a.bin', '/cached/a.bin', '/cached/a.bin'):
+        (status, headers, body) = yield from get(path, Range='bytes=10-19')
+        self.assertEqual(status, 206)
+        self.assertEqual(headers['CONTENT-RANGE'], 'bytes 10-19/256000')
+        self.assertEqual(body, content[10:20])
+
+        (status, headers, body) = yield from get(path, Range='bytes=-5')
+        self.assertEqual((status, body), (206, content[-5:]))
+        (status, headers, body) = yield from get(path, Range='bytes=255990-300000')
+        self.assertEqual((status, body), (206, content[255990:]))
+
+        (status, headers, body) = yield from get(path, Range='bytes=0-1,100000-200000')
+        self.assertEqual(status, 206)
+        (type, _, boundary) = headers['CONTENT-TYPE'].partition('; boundary=')
+        self.assertEqual(type, 'multipart/byteranges')
+        parts = body.split(b'\r\n--' + boundary.encode('ascii'))
+        self.assertEqual(parts[0], b'')
+        self.assertEqual(parts[-1], b'--\r\n')
+        self.assertEqual(parts[1], b'\r\nContent-Type: application/octet-stream\r\nContent-Range: bytes 0-1/256000\r\n\r\n' + content[0:2])
+        self.assertTrue(parts[2].endswith(b'Content-Range: bytes 100000-200000/256000\r\n\r\n' + content[100000:200001]))
+
+        (status, headers, body) = yield from get(path, Range='bytes=300000-')
+        self.assertEqual(status, 416)
+        self.assertEqual(headers['CONTENT-RANGE'], 'bytes */256000')
+        (status, headers, body) = yield from get(path, Range='bytes=5-1')
+        self.assertEqual((status, body), (200, content))
+
+        etag = headers['ETAG']
+        (status, headers, body) = yield from get(path, Range='bytes=0-1', **{'If-Range': etag})
+        self.assertEqual((status, body), (206, content[0:2]))
+        (status, headers, body) = yield from get(path, Range='bytes=0-1', **{'If-Range': '"outdated"'})
+        self.assertEqual((status, body), (200, content))
+
+    test_session = KoaTestSession(app)
+    test_session.run_async_test(test())
+
+  def test_koa_static_sends_large_files_via_sendfile(self):
+    temp_dir = tempfile.TemporaryDirectory()
+    self.addCleanup(temp_dir.cleanup)
+    content = os.urandom(1024 * 1024 + 17)
+    with open(os.path.join(temp_dir.name, 'large.bin'), 'wb') as f:
+      f.write(content)
+
+    @asyncio.coroutine
+    def send_range(koa_context, next):
+      if koa_context.request.path.path == '/range':
+        file = open(os.path.join(temp_dir.name, 'large.bin'), 'rb')
+        koa_context.response.body = koa.core.KoaFileBody(file, offset=10, count=100)
+      yield from next
+
+    app = koa.core.app()
+    app.use(send_range)
+    app.use(koa.common.static(temp_dir.name, sendfile_threshold=64*1024))
+
+    @asyncio.coroutine
+    def test():
+      for i in range(2): # twice on the same keep-alive connection
+        response = yield from test_session.request('get', '/large.bin')
+        response_bytes = yield from response.read()
+        self.assertEqual(response.status, 200)
+        self.assertEqual(response.headers['CONTENT-LENGTH'], str(len(content)))
+        self.assertEqual(response.headers['CONTENT-TYPE'], 'application/octet-stream')
+        self.assertEqual(response_bytes, content)
+
+      response = yield from test_session.request('get', '/range')
+      response_bytes = yield from response.read()
+      self.assertEqual(response_bytes, content[10:110])
+
+    test_session = KoaTestSession(app)
+    test_session.run_async_test(test())
+
+  def test_koa_file_body_falls_back_to_reading_chunks(self):
+    content = os.urandom(200 * 1024)
+    with tempfile.TemporaryFile() as file:
+      file.write(content)
+      body = koa.core.KoaFileBody(file, offset=5, count=150 * 1024)
+      chunks = []
+
+      @asyncio.coroutine
+      def read_all():
+        while True:
+          chunk = yield from body.read()
+          if len(chunk) == 0:
+            return
+          chunks.append(chunk)
+
+      loop = asyncio.new_event_loop()
+      asyncio.set_event_loop(loop)
+      loop.run_until_complete(read_all())
+      loop.close()
+      self.assertEqual(b''.join(chunks), content[5:5 + 150 * 1024])
+
+  def test_koa_static_serves_entries_evicted_during_revalidation(self):
+    temp_dir = tempfile.TemporaryDirectory()
+    self.addCleanup(temp_dir.cleanup)
+    for name in ('a.txt', 'b.txt'):
+      with open(os.path.join(temp_dir.name, name), 'w') as f:
+        f.write("content of " + name)
+    cache = koa.common.StaticFileCache(max_entries=1, revalidate_interval=0)
+    gate = threading.Event()
+    self.addCleanup(gate.set)
+
+    # holds back the file I/O submitted while is_gated, e.g. the revalidation of a.txt
+    class GatedExecutor(concurrent.futures.ThreadPoolExecutor):
+      is_gated = False
+      def submit(self, fn, *args, **kwargs):
+        if self.is_gated:
+          return concurrent.futures.ThreadPoolExecutor.submit(self, lambda: gate.wait(1) and fn(*args, **kwargs))
+        return concurrent.futures.ThreadPoolExecutor.submit(self, fn, *args, **kwargs)
+
+    executor = GatedExecutor(max_workers=2)
+    self.addCleanup(executor.shutdown)
+    app = koa.core.app()
+    app.use(koa.common.static(temp_dir.name, cache=cache, executor=executor))
+
+    @asyncio.coroutine
+    def get(path):
+      response = yield from test_session.request('get', path)
+      response_bytes = yield from response.read()
+      return (response.status, response_bytes.decode('utf8'))
+
+    @asyncio.coroutine
+    def test():
+      self.assertEqual((yield from get('/a.txt')), (200, "content of a.txt"))
+      executor.is_gated = True
+      revalidation = asyncio.get_event_loop().create_task(get('/a.txt'))
+      yield from asyncio.sleep(0.05)
+      executor.is_gated = False
+      self.assertEqual((yield from get('/b.txt')), (200, "content of b.txt")) # evicts a.txt
+      gate.set()
+      self.assertEqual((yield from revalidation), (200, "content of a.txt"))
+
+    test_session = KoaTestSession(app)
+    test_session.run_async_test(test())
+
+  def test_koa_static_reads_bodies_on_the_file_io_pool(self):
+    temp_dir = tempfile.TemporaryDirectory()
+    self.addCleanup(temp_dir.cleanup)
+    text = 'hello world ' * 30000
+    with open(os.path.join(temp_dir.name, 'large.txt'), 'w') as f:
+      f.write(text)
+    read_file_at = koa.core.read_file_at
+    reading_threads = set()
+
+    def recording_read_file_at(file, offset, size):
+      reading_threads.add(threading.current_thread())
+      return read_file_at(file, offset, size)
+
+    koa.core.read_file_at = recording_read_file_at
+    self.addCleanup(setattr, koa.core, 'read_file_at', read_file_at)
+
+    app = koa.core.app()
+    app.use(koa.common.compress()) # reads the KoaFileBody chunk by chunk instead of via sendfile
+    app.use(koa.common.static(temp_dir.name, sendfile_threshold=64*1024))
+
+    @asyncio.coroutine
+    def test():
+      response = yield from test_session.request('get', '/large.txt')
+      response_text = yield from response.text()
+      self.assertEqual(response.headers['CONTENT-ENCODING'], 'gzip')
+      self.assertEqual(response_text, text)
+
+      response = yield from test_session.request('get', '/large.txt', headers={'Range': 'bytes=0-4,-5'})
+      response_bytes = yield from response.read()
+      self.assertEqual(response.status, 206)
+      self.assertIn(b'hello', response_bytes)
+
+    test_session = KoaTestSession(app)
+    test_session.run_async_test(test())
+    self.assertGreater(len(reading_threads), 0)
+    file_io_threads = koa.common.get_file_io_executor()._threads
+    for thread in reading_threads:
+      self.assertIn(thread, file_io_threads)
+
+  def test_koa_static_reuses_cached_file_descriptors(self):
+    temp_dir = tempfile.TemporaryDirectory()
+    self.addCleanup(temp_dir.cleanup)
+    small = b'small file'
+    large = os.urandom(300 * 1024)
+    with open(os.path.join(temp_dir.name, 'small.txt'), 'wb') as f:
+      f.write(small)
+    with open(os.path.join(temp_dir.name, 'large.bin'), 'wb') as f:
+      f.write(large)
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=2)
+    self.addCleanup(executor.shutdown)
+    fd_cache = koa.common.FileDescriptorCache(max_entries=1)
+    self.addCleanup(fd_cache.clear)
+
+    app = koa.core.app()
+    app.use(koa.common.static(temp_dir.name, sendfile_threshold=64*1024, executor=executor, fd_cache=fd_cache))
+
+    @asyncio.coroutine
+    def test():
+      for i in range(3):
+        response = yield from test_session.request('get', '/large.bin')
+        response_bytes = yield from response.read()
+        self.assertEqual(response_bytes, large)
+      self.assertEqual((fd_cache.misses, fd_cache.hits), (1, 2))
+
+      response = yield from test_session.request('get', '/large.bin', headers={'Range': 'bytes=10-19,-5'})
+      response_bytes = yield from response.read()
+      self.assertEqual(response.status, 206)
+      self.assertIn(large[10:20], response_bytes)
+      self.assertIn(large[-5:], response_bytes)
+
+      response = yield from test_session.request('get', '/small.txt')
+      response_bytes = yield from response.read()
+      self.assertEqual(response_bytes, small)
+      self.assertEqual(len(fd_cache), 1) # large.bin got evicted
+
+      # a changed file isn't served from its stale descriptor
+      with open(os.path.join(temp_dir.name, 'small.txt'), 'wb') as f:
+        f.write(b'changed')
+      response = yield from test_session.request('get', '/small.txt')
+      response_bytes = yield from response.read()
+      self.assertEqual(response_bytes, b'changed')
+
+    test_session = KoaTestSession(app)
+    test_session.run_async_test(test())
+
+  def test_koa_static_index(self):
+    temp_dir = tempfile.TemporaryDirectory()
+    self.addCleanup(temp_dir.cleanup)
+    os.mkdir(os.path.join(temp_dir.name, 'img'))
+    with open(os.path.join(temp_dir.name, 'img', 'logo.png'), 'wb') as f:
+      f.write(b'png bytes')
+    with open(os.path.join(temp_dir.name, 'index.txt'), 'wb') as f:
+      f.write(b'hello')
+    index = koa.common.StaticIndex(temp_dir.name)
+    self.assertEqual(len(index), 2)
+    self.assertEqual(index.get('img/logo.png').type, 'image/png')
+
+    app = koa.core.app()
+    app.use(koa.common.static(temp_dir.name, index=index))
+
+    @asyncio.coroutine
+    def test():
+      response = yield from test_session.request('get', '/img/logo.png')
+      response_bytes = yield from response.read()
+      self.assertEqual(response.status, 200)
+      self.assertEqual(response.headers['CONTENT-TYPE'], 'image/png')
+      self.assertEqual(response_bytes, b'png bytes')
+
+      response = yield from test_session.request('get', '/index.txt')
+      response_bytes = yield from response.read()
+      self.assertEqual(response.headers['CONTENT-TYPE'], 'text/html')
+      self.assertEqual(response_bytes, b'hello')
+
+      for path in ('/img/../index.txt', '/img', '/new.txt'):
+        response = yield from test_session.request('get', path)
+        yield from response.read()
+        self.assertEqual(response.status, 404)
+
+      # new files are served once the dir got rescanned
+      with open(os.path.join(temp_dir.name, 'new.txt'), 'wb') as f:
+        f.write(b'new')
+      yield from index.rescan()
+      response = yield from test_session.request('get', '/new.txt')
+      response_bytes = yield from response.read()
+      self.assertEqual(response_bytes, b'new')
+
+    test_session = KoaTestSession(app)
+    test_session.run_async_test(test())
+
+  def test_koa_static_serves_precompressed_variants(self):
+    temp_dir = tempfile.TemporaryDirectory()
+    self.addCleanup(temp_dir.cleanup)
+    script = "console.log('hello world');\n" * 100
+    with open(os.path.join(temp_dir.name, 'app.js'), 'w') as f:
+      f.write(script)
+    with open(os.path.join(temp_dir.name, 'style.css'), 'w') as f:
+      f.write('body {}\n' * 200)
+    written = koa.precompress.precompress(temp_dir.name, workers=2, encodings=['gzip'])
+    self.assertEqual(sorted(written), [os.path.join(temp_dir.name, name) for name in ('app.js.gz', 'style.css.gz')])
+    self.assertEqual(koa.precompress.precompress(temp_dir.name, workers=2, encodings=['gzip']), []) # up to date
+    os.remove(os.path.join(temp_dir.name, 'style.css.gz'))
+    with open(os.path.join(temp_dir.name, 'app.js.br'), 'wb') as f:
+      f.write(b'fake brotli')
+
+    app = koa.core.app()
+    app.use(koa.common.mount('/indexed', koa.common.static(temp_dir.name, index=True, precompressed=True)))
+    app.use(koa.common.mount('/plain', koa.common.static(temp_dir.name, precompressed=True)))
+
+    @asyncio.coroutine
+    def test():
+      for prefix in ('/indexed', '/plain'):
+        response = yield from test_session.request('get', prefix + '/app.js', headers = {'accept-encoding': 'gzip, br'})
+        response_bytes = yield from response.read()
+        self.assertEqual(response.headers['CONTENT-ENCODING'], 'br')
+        self.assertEqual(response.headers['CONTENT-TYPE'], 'application/javascript')
+        self.assertEqual(response.headers['VARY'], 'Accept-Encoding')
+        self.assertEqual(response_bytes, b'fake brotli')
+
+        # aiohttp's client sends 'Accept-Encoding: gzip, deflate' and transparently decompresses
+        response = yield from test_session.request('get', prefix + '/app.js')
+        response_text = yield from response.text()
+        self.assertEqual(response.headers['CONTENT-ENCODING'], 'gzip')
+        self.assertTrue(int(response.headers['CONTENT-LENGTH']) < len(script))
+        self.assertEqual(response_text, script)
+
+        response = yield from test_session.request('get', prefix + '/app.js', headers = {'accept-encoding': 'identity'})
+        response_text = yield from response.text()
+        self.assertNotIn('CONTENT-ENCODING', response.headers)
+        self.assertEqual(response.headers['VARY'], 'Accept-Encoding')
+        self.assertEqual(response_text, script)
+
+        response = yield from test_session.request('get', prefix + '/style.css')
+        response_text = yield from response.text()
+        self.assertNotIn('CONTENT-ENCODING', response.headers)
+        self.assertEqual(response_text, 'body {}\n' * 200)
+
+    test_session = KoaTestSession(app)
+    test_session.run_async_test(test())
+
+  def test_koa_static_caches_precompressed_variants(self):
+    temp_dir = tempfile.TemporaryDirectory()
+    self.addCleanup(temp_dir.cleanup)
+    script = "console.log('hello world');\n" * 100
+    with open(os.path.join(temp_dir.name, 'app.js'), 'w') as f:
+      f.write(script)
+    os.chmod(os.path.join(temp_dir.name, 'app.js'), 0o644)
+    koa.precompress.precompress_file(os.path.join(temp_dir.name, 'app.js'), ['gzip'])
+    self.assertEqual(sorted(os.listdir(temp_dir.name)), ['app.js', 'app.js.gz']) # no temp files left behind
+    self.assertEqual(os.stat(os.path.join(temp_dir.name, 'app.js.gz')).st_mode & 0o777, 0o644) # readable like the original
+    cache = koa.common.StaticFileCache(immutable=True)
+    hops = []
+
+    class CountingExecutor(concurrent.futures.ThreadPoolExecutor):
+      def submit(self, *args, **kwargs):
+        hops.append(args)
+        return concurrent.futures.ThreadPoolExecutor.submit(self, *args, **kwargs)
+
+    executor = CountingExecutor(max_workers=1)
+    self.addCleanup(executor.shutdown)
+    app = koa.core.app()
+    app.use(koa.common.static(temp_dir.name, cache=cache, precompressed=True, executor=executor))
+
+    @asyncio.coroutine
+    def test():
+      for i in range(3):
+        # there's no app.js.br, so this gets app.js.gz
+        response = yield from test_session.request('get', '/app.js', headers = {'accept-encoding': 'br, gzip'})
+        response_text = yield from response.text()
+        self.assertEqual(response.headers['CONTENT-ENCODING'], 'gzip')
+        self.assertEqual(response_text, script)
+      for i in range(2):
+        response = yield from test_session.request('get', '/app.js', headers = {'accept-encoding': 'identity'})
+        response_text = yield from response.text()
+        self.assertNotIn('CONTENT-ENCODING', response.headers)
+        self.assertEqual(response_text, script)
+      self.assertEqual(len(hops), 2) # the disk is only touched once per variant
+
+    test_session = KoaTestSession(app)
+    test_session.run_async_test(test())
+
+  def test_mounted_koa_static_returns_file_content(self):
+
+    app = koa.core.app()
+    app.use(koa.common.mount('/data', koa.common.static('./testdata')))
+
+    @asyncio.coroutine
+    def test():
+      response = yield from test_session.request('get', '/data/foo/bar.txt')
+      response_bytes = yield from response.read()
+      self.assertEqual(response.status, 200)
+      self.assertEqual(response.headers['CONTENT-TYPE'], 'text/html')
+      self.assertEqual(response_bytes, "content of bar.txt".encode('utf8'))
+
+    test_session = KoaTestSession(app)
+    test_session.run_async_test(test())
+
+  def test_koa_logger(self):
+    app = koa.core.app()
+    app.use(koa.common.logger)
+
+    @asyncio.coroutine
+    def test():
+      response = yield from test_session.request('get', '/foo')
+      response_text = yield from response.text()
+      self.assertEqual(response.status, 404)
+      # note this test didn't verify anything actually got logged, kinda lame
+
+    test_session = KoaTestSession(app)
+    test_session.run_async_test(test())
+
+  def test_koa_auth(self):
+    app = koa.core.app()
+
+    # this is not a middleware, it's just a regular coroutine returning a bool
+    @asyncio.coroutine
+    def my_credential_validator(user, password):
+      return user == 'foo' and password == 'secret'
+
+    # this is middleware that is supposed to be basic-auth-protected
+    @asyncio.coroutine
+    def my_middleware(koa_context, next):
+      koa_context.response.body = "hi"
+
+    app.use(koa.common.basic_auth(my_credential_validator))
+    app.use(my_middleware)
+
+    @asyncio.coroutine
+    def test():
+
+      # test successful auth
+      response = yield from test_session.request('get', '/foo', auth = aiohttp.helpers.BasicAuth('foo', 'secret', 'utf-8'))
+      responseText = yield from response.text()
+      self.assertEqual(response.status, 200)
+      self.assertEqual(responseText, "hi")
+
+      # test wrong pass
+      response = yield from test_session.request('get', '/foo', auth = aiohttp.helpers.BasicAuth('foo', 'wrong pass', 'utf-8'))
+      self.assertEqual(response.status, 401)
+
+      # test missing auth
+      response = yield from test_session.request('get', '/foo')
+      self.assertEqual(response.status, 401)
+
+    test_session = KoaTestSession(app)
+    test_session.run_async_test(test())
+
+  def test_koa_auth_credential_cache(self):
+    app = koa.core.app()
+    validated = []
+
+    @asyncio.coroutine
+    def slow_credential_validator(user, password):
+      validated.append((user, password))
+      yield from asyncio.sleep(0.05)
+      return user == 'foo' and password == 'secret'
+
+    @asyncio.coroutine
+    def my_middleware(koa_context, next):
+      koa_context.response.body = "hi"
+
+    cache = koa.common.CredentialCache(max_entries=2)
+    app.use(koa.common.basic_auth(slow_credential_validator, cache=cache))
+    app.use(my_middleware)
+
+    @asyncio.coroutine
+    def get(password):
+      response = yield from test_session.request('get', '/foo', auth = aiohttp.helpers.BasicAuth('foo', password, 'utf-8'))
+      yield from response.read()
+      return response.status
+
+    @asyncio.coroutine
+    def test():
+      # concurrent requests share a single validation
+      statuses = yield from asyncio.gather(*[get('secret') for i in range(3)])
+      self.assertEqual(statuses, [200] * 3)
+      self.assertEqual(validated, [('foo', 'secret')])
+      self.assertEqual(len(cache), 1)
+
+      self.assertEqual((yield from get('wrong pass')), 401)
+      self.assertEqual((yield from get('wrong pass')), 401) # negative result is cached
+      self.assertEqual(validated, [('foo', 'secret'), ('foo', 'wrong pass')])
+
+      self.assertEqual((yield from get('other pass')), 401) # evicts the least recently used entry
+      self.assertEqual((yield from get('secret')), 200)
+      self.assertEqual(validated[-1], ('foo', 'secret'))
+      self.assertEqual(len(validated), 4)
+
+    test_session = KoaTestSession(app)
+    test_session.run_async_test(test())
+
+  def test_koa_auth_backs_off_failing_clients(self):
+    app = koa.core.app()
+    validated = []
+
+    @asyncio.coroutine
+    def my_credential_validator(user, password):
+      validated.append(password)
+      return user == 'foo' and password == 'secret'
+
+    @asyncio.coroutine
+    def my_middleware(koa_context, next):
+      koa_context.response.body = "hi"
+
+    cache = koa.common.CredentialCache(max_failures=2, failure_backoff=0.2)
+    app.use(koa.common.basic_auth(my_credential_validator, cache=cache))
+    app.use(my_middleware)
+
+    @asyncio.coroutine
+    def get(password):
+      response = yield from test_session.request('get', '/foo', auth = aiohttp.helpers.BasicAuth('foo', password, 'utf-8'))
+      yield from response.read()
+      return response
+
+    @asyncio.coroutine
+    def test():
+      self.assertEqual((yield from get('guess 1')).status, 401)
+      self.assertEqual((yield from get('guess 2')).status, 401)
+      # rejected without calling the validator, even with the right password
+      response = yield from get('secret')
+      self.assertEqual(response.status, 429)
+      self.assertEqual(response.headers['RETRY-AFTER'], '1')
+      self.assertEqual(validated, ['guess 1', 'guess 2'])
+
+      yield from asyncio.sleep(0.25)
+      self.assertEqual((yield from get('guess 3')).status, 401)
+      self.assertGreater(cache.get_retry_after('127.0.0.1'), 0.3) # backoff doubled
+
+      cache.record_success('127.0.0.1') # as a successful login would
+      self.assertEqual((yield from get('secret')).status, 200)
+      self.assertEqual(cache.get_retry_after('127.0.0.1'), 0)
+
+    test_session = KoaTestSession(app)
+    test_session.run_async_test(test())
+
+  def test_credential_cache_survives_cancelled_leader(self):
+    cache = koa.common.CredentialCache()
+    validated = []
+
+    @asyncio.coroutine
+    def validate():
+      validated.append(True)
+      yield from asyncio.sleep(0.05)
+      return True
+
+    @asyncio.coroutine
+    def test():
+      leader = asyncio.ensure_future(cache.validate('Basic Zm9vOnNlY3JldA==', validate))
+      follower = asyncio.ensure_future(cache.validate('Basic Zm9vOnNlY3JldA==', validate))
+      yield from asyncio.sleep(0.01)
+      leader.cancel() # e.g. the client disconnected
+      self.assertTrue((yield from follower))
+      self.assertTrue(leader.cancelled())
+      self.assertEqual(len(validated), 1)
+      self.assertEqual(len(cache), 1)
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    loop.run_until_complete(test())
+    loop.close()
+
+  def test_rate_limit(self):
+    app = koa.core.app()
+    handled = []
+
+    @asyncio.coroutine
+    def my_middleware(koa_context, next):
+      handled.append(koa_context.request.ip)
+      koa_context.response.body = "hi"
+
+    limiter = koa.common.rate_limit(rate=0.5, burst=2, key=lambda koa_context: koa_context.request.headers.get('X-CLIENT', koa_context.request.ip))
+    app.use(limiter)
+    app.use(my_middleware)
+
+    @asyncio.coroutine
+    def test():
+      for i in range(2):
+        response = yield from test_session.request('get', '/foo')
+        yield from response.read()
+        self.assertEqual(response.status, 200)
+        self.assertEqual(response.headers['RATELIMIT-LIMIT'], '2')
+        self.assertEqual(response.headers['RATELIMIT-REMAINING'], str(1 - i))
+
+      response = yield from test_session.request('get', '/foo')
+      yield from response.read()
+      self.assertEqual(response.status, 429)
+      self.assertEqual(response.headers['RETRY-AFTER'], '2')
+      self.assertEqual(response.headers['RATELIMIT-REMAINING'], '0')
+      self.assertEqual(response.headers['RATELIMIT-RESET'], '4')
+      self.assertEqual(handled, ['127.0.0.1'] * 2) # never reached downstream middleware
+
+      # other keys have their own buckets
+      response = yield from test_session.request('get', '/foo', headers={'X-Client': 'other'})
+      yield from response.read()
+      self.assertEqual(response.status, 200)
+      self.assertEqual(len(limiter.buckets), 2)
+
+    test_session = KoaTestSession(app)
+    test_session.run_async_test(test())
+
+  def test_rate_limit_rejects_invalid_limits(self):
+    for (rate, burst) in ((0, None), (-1, 5), (1, 0), (1, 0.5)):
+      with self.assertRaises(ValueError):
+        koa.common.rate_limit(rate=rate, burst=burst)
+
+  def test_token_buckets_expire_idle_buckets(self):
+    buckets = koa.common.TokenBuckets(rate=100, burst=1, shards=1)
+    self.assertEqual(buckets.idle_timeout, 0.01)
+    self.assertTrue(buckets.take('a')[0])
+    self.assertFalse(buckets.take('a')[0])
+    time.sleep(0.02)
+    self.assertTrue(buckets.take('b')[0]) # sweeps 'a', which had refilled anyway
+    self.assertEqual(len(buckets), 1)
+    self.assertTrue(buckets.take('a')[0])
+
+  def test_max_requests_in_flight_sheds_load_with_503(self):
+
+    @asyncio.coroutine
+    def handle_slow(koa_context, next):
+      yield from asyncio.sleep(0.2)
+      koa_context.response.body = "slow"
+
+    app = koa.core.app()
+    app.server_settings.max_requests_in_flight = 1
+    app.server_settings.retry_after = 3
+    router = koa.common.router()
+    router.get("/slow", handle_slow)
+    app.use(router.middleware())
+
+    @asyncio.coroutine
+    def test():
+      slow_request = asyncio.get_event_loop().create_task(test_session.request('get', '/slow'))
+      yield from asyncio.sleep(0.05)
+      self.assertEqual(app.requests_in_flight, 1)
+
+      response = yield from test_session.request('get', '/slow')
+      yield from response.read()
+      self.assertEqual(response.status, 503)
+      self.assertEqual(response.headers['RETRY-AFTER'], '3')
+
+      response = yield from slow_request
+      response_text = yield from response.text()
+      self.assertEqual(response.status, 200)
+      self.assertEqual(response_text, "slow")
+      self.assertEqual(app.requests_in_flight, 0)
+
+    test_session = KoaTestSession(app)
+    test_session.run_async_test(test())
+
+  def test_max_connections_sheds_load_with_503(self):
+
+    @asyncio.coroutine
+    def handle_slow(koa_context, next):
+      yield from asyncio.sleep(0.2)
+      koa_context.response.body = "slow"
+
+    app = koa.core.app()
+    app.server_settings.max_connections = 1
+    router = koa.common.router()
+    router.get("/slow", handle_slow)
+    app.use(router.middleware())
+
+    @asyncio.coroutine
+    def test():
+      slow_request = asyncio.get_event_loop().create_task(test_session.request('get', '/slow'))
+      yield from asyncio.sleep(0.05)
+
+      response = yield from test_session.request('get', '/slow')
+      yield from response.read()
+      self.assertEqual(response.status, 503)
+
+      response = yield from slow_request
+      self.assertEqual(response.status, 200)
+      self.assertEqual(response.headers['CONNECTION'], 'keep-alive')
+      yield from response.read()
+
+    test_session = KoaTestSession(app)
+    test_session.run_async_test(test())
+
+  def test_overload_response_uses_the_request_http_version(self):
+    app = koa.core.app()
+    app.server_settings.max_requests_in_flight = 0 # sheds every request
+
+    @asyncio.coroutine
+    def test():
+      (reader, writer) = yield from asyncio.open_connection('127.0.0.1', test_session.port)
+      writer.write(b'GET /foo HTTP/1.0\r\n\r\n')
+      response = yield from asyncio.wait_for(reader.read(), 1)
+      writer.close()
+      self.assertTrue(response.startswith(b'HTTP/1.0 503 Service Unavailable\r\n'), response)
+
+    test_session = KoaTestSession(app)
+    test_session.run_async_test(test())
+
+  def test_header_timeout_closes_connections_with_slow_headers(self):
+    app = koa.core.app()
+    app.server_settings.header_timeout = 0.1
+
+    @asyncio.coroutine
+    def test():
+      (reader, writer) = yield from asyncio.open_connection('127.0.0.1', test_session.port)
+      writer.write(b'GET /foo HTTP/1.1\r\nHost: localhost\r\n') # and never the final blank line
+      response = yield from asyncio.wait_for(reader.read(), 1) # EOF once the server closes the connection
+      writer.close()
+      self.assertEqual(response, b'')
+
+    test_session = KoaTestSession(app)
+    test_session.run_async_test(test())
+
+  def test_body_timeout_closes_connections_with_slow_bodies(self):
+
+    @asyncio.coroutine
+    def handle_post(koa_context, next):
+      koa_context.response.body = koa_context.request.body
+
+    app = koa.core.app()
+    app.server_settings.body_timeout = 0.1
+    app.use(koa.common.body_parser)
+    router = koa.common.router()
+    router.post("/foo", handle_post)
+    app.use(router.middleware())
+
+    @asyncio.coroutine
+    def test():
+      (reader, writer) = yield from asyncio.open_connection('127.0.0.1', test_session.port)
+      writer.write(b'POST /foo HTTP/1.1\r\nHost: localhost\r\nContent-Type: application/json\r\nContent-Length: 100\r\n\r\n{"a"')
+      response = yield from asyncio.wait_for(reader.read(), 1) # reads until the server closes the connection
+      writer.close()
+      self.assertTrue(response.startswith(b'HTTP/1.1 408 '), response)
+      self.assertEqual(app.requests_in_flight, 0)
+
+    test_session = KoaTestSession(app)
+    test_session.run_async_test(test())
+
+  def test_shutdown_drains_in_flight_requests(self):
+
+    @asyncio.coroutine
+    def handle_slow(koa_context, next):
+      yield from asyncio.sleep(0.2)
+      koa_context.response.body = "slow"
+
+    app = koa.core.app()
+    router = koa.common.router()
+    router.get("/slow", handle_slow)
+    app.use(router.middleware())
+
+    @asyncio.coroutine
+    def test():
+      slow_request = asyncio.get_event_loop().create_task(test_session.request('get', '/slow'))
+      yield from asyncio.sleep(0.05)
+      yield from app.shutdown(test_session.server, timeout=5)
+      self.assertEqual(app.requests_in_flight, 0)
+
+      response = yield from slow_request
+      response_text = yield from response.text()
+      self.assertEqual(response.status, 200)
+      self.assertEqual(response.headers['CONNECTION'], 'close')
+      self.assertEqual(response_text, "slow")
+
+      with self.assertRaises(Exception):
+        yield from test_session.request('get', '/slow') # no longer accepting connections
+
+    test_session = KoaTestSession(app)
+    test_session.run_async_test(test())
+
+  def test_shutdown_cancels_requests_exceeding_timeout(self):
+    finished = []
+
+    @asyncio.coroutine
+    def handle_slow(koa_context, next):
+      yield from asyncio.sleep(5)
+      finished.append(True)
+
+    app = koa.core.app()
+    router = koa.common.router()
+    router.get("/slow", handle_slow)
+    app.use(router.middleware())
+
+    @asyncio.coroutine
+    def test():
+      slow_request = asyncio.get_event_loop().create_task(test_session.request('get', '/slow'))
+      yield from asyncio.sleep(0.05)
+      yield from app.shutdown(test_session.server, timeout=0.1)
+      self.assertEqual(app.requests_in_flight, 0)
+      self.assertEqual(finished, [])
+      with self.assertRaises(Exception):
+        yield from slow_request # connection got closed without a response
+
+    test_session = KoaTestSession(app)
+    test_session.run_async_test(test())
+
+  def test_request_timeout_cancels_chain_with_504(self):
+    cancelled = []
+
+    @asyncio.coroutine
+    def handle_slow(koa_context, next):
+      self.assertTrue(0 < koa_context.time_remaining() <= 0.1)
+      try:
+        yield from asyncio.sleep(5)
+      except asyncio.CancelledError:
+        cancelled.append(True)
+        raise
+
+    app = koa.core.app()
+    app.server_settings.request_timeout = 0.1
+    router = koa.common.router()
+    router.get("/slow", handle_slow)
+    app.use(router.middleware())
+
+    @asyncio.coroutine
+    def test():
+      response = yield from test_session.request('get', '/slow')
+      response_text = yield from response.text()
+      self.assertEqual(response.status, 504)
+      self.assertEqual(response_text, "request timed out")
+      self.assertEqual(cancelled, [True])
+
+    test_session = KoaTestSession(app)
+    test_session.run_async_test(test())
+
+  def test_unsent_file_bodies_get_closed(self):
+    temp_dir = tempfile.TemporaryDirectory()
+    self.addCleanup(temp_dir.cleanup)
+    path = os.path.join(temp_dir.name, 'data.bin')
+    with open(path, 'wb') as f:
+      f.write(b'data')
+    fd_cache = koa.common.FileDescriptorCache()
+    self.addCleanup(fd_cache.clear)
+    files = []
+
+    @asyncio.coroutine
+    def send_file(koa_context, next):
+      files.append(fd_cache.acquire(path, os.stat(path)))
+      koa_context.response.body = koa.core.KoaFileBody(files[-1])
+      yield from next
+
+    @asyncio.coroutine
+    def handle_replaced(koa_context, next):
+      koa_context.response.body = "replaced"
+
+    @asyncio.coroutine
+    def handle_slow(koa_context, next):
+      yield from asyncio.sleep(5)
+
+    app = koa.core.app()
+    app.server_settings.request_timeout = 0.1
+    app.use(send_file)
+    router = koa.common.router()
+    router.get("/replaced", handle_replaced)
+    router.get("/slow", handle_slow)
+    app.use(router.middleware())
+
+    @asyncio.coroutine
+    def test():
+      response = yield from test_session.request('get', '/replaced')
+      response_text = yield from response.text()
+      self.assertEqual(response_text, "replaced")
+      self.assertTrue(files[-1].closed)
+
+      response = yield from test_session.request('get', '/slow')
+      yield from response.read()
+      self.assertEqual(response.status, 504)
+      self.assertTrue(files[-1].closed)
+      self.assertEqual(fd_cache._entries[path].refcount, 0) # released back to the cache
+
+    test_session = KoaTestSession(app)
+    test_session.run_async_test(test())
+
+  def test_route_timeout_tightens_app_deadline(self):
+
+    @asyncio.coroutine
+    def handle_slow(koa_context, next):
+      yield from asyncio.sleep(5)
+
+    @asyncio.coroutine
+    def handle_fast(koa_context, next):
+      koa_context.response.body = "fast"
+
+    app = koa.core.app()
+    app.server_settings.request_timeout = 10
+    router = koa.common.router()
+    router.get("/slow", handle_slow, timeout=0.1)
+    router.get("/fast", handle_fast, timeout=0.1)
+    app.use(router.middleware())
+
+    @asyncio.coroutine
+    def test():
+      response = yield from test_session.request('get', '/slow')
+      self.assertEqual(response.status, 504)
+      yield from response.read()
+
+      response = yield from test_session.request('get', '/fast')
+      response_text = yield from response.text()
+      self.assertEqual(response.status, 200)
+      self.assertEqual(response_text, "fast")
+
+    test_session = KoaTestSession(app)
+    test_session.run_async_test(test())
+
+  def test_active_middleware_is_restored_after_exceptions(self):
+    seen = []
+
+    @asyncio.coroutine
+    def catch_errors(koa_context, next):
+      try:
+        yield from next
+      except ValueError:
+        seen.append(koa_context.active_middleware)
+        koa_context.throw("recovered", 400)
+
+    @asyncio.coroutine
+    def handle_get(koa_context, next):
+      raise ValueError("oops")
+
+    @asyncio.coroutine
+    def failing(koa_context, next):
+      raise ValueError("oops")
+
+    app = koa.core.app()
+    app.use(catch_errors)
+    router = koa.common.router()
+    router.get("/route", handle_get)
+    app.use(router.middleware())
+    app.use(failing)
+
+    @asyncio.coroutine
+    def test():
+      for path in ('/route', '/plain'):
+        response = yield from test_session.request('get', path)
+        response_text = yield from response.text()
+        self.assertEqual(response.status, 400)
+        self.assertEqual(response_text, "recovered")
+      self.assertEqual(seen, [catch_errors, catch_errors])
+
+    test_session = KoaTestSession(app)
+    test_session.run_async_test(test())
+
+  def test_watchdog_logs_stalled_request(self):
+    logged = []
+
+    @asyncio.coroutine
+    def stalling_middleware(koa_context, next):
+      yield from asyncio.sleep(0.15)
+      koa_context.response.body = "done"
+
+    app = koa.core.app()
+    app.use(koa.common.watchdog(0.05, log=logged.append))
+    app.use(stalling_middleware)
+
+    @asyncio.coroutine
+    def test():
+      response = yield from test_session.request('get', '/foo')
+      yield from response.read()
+      self.assertEqual(response.status, 200)
+      self.assertEqual(len(logged), 1)
+      self.assertIn("potentially stalled request: GET /foo", logged[0])
+      self.assertIn("stalling_middleware", logged[0])
+
+    test_session = KoaTestSession(app)
+    test_session.run_async_test(test())
+
+  def test_buffered_response_is_written_at_once(self):
+
+    class RecordingWriter:
+      def __init__(self):
+        self.writes = []
+      def write(self, data):
+        self.writes.append(data)
+      def writelines(self, data):
+        self.writes.append(b''.join(data))
+
+    writer = RecordingWriter()
+    headers = [('X-Foo', 'bar'), ('Connection', 'keep-alive'), ('Date', 'ignored')]
+    keep_alive = koa.core.write_buffered_response(writer, 200, (1, 1), False, headers, 'application/json', b'{}')
+    self.assertTrue(keep_alive)
+    self.assertEqual(len(writer.writes), 1)
+    (head, body) = writer.writes[0].split(b'\r\n\r\n')
+    lines = head.decode('ascii').split('\r\n')
+    self.assertEqual(lines[0], 'HTTP/1.1 200 OK')
+    self.assertIn('X-Foo: bar', lines)
+    self.assertIn('Content-Type: application/json', lines)
+    self.assertIn('Content-Length: 2', lines)
+    self.assertIn('Connection: keep-alive', lines)
+    self.assertIn('Date: ' + koa.core.get_http_date(), lines)
+    self.assertEqual(len([line for line in lines if line.startswith('Date:')]), 1)
+    self.assertEqual(body, b'{}')
+
+    writer = RecordingWriter()
+    keep_alive = koa.core.write_buffered_response(writer, 304, (1, 0), False, [], None, None)
+    self.assertFalse(keep_alive)
+    lines = writer.writes[0].decode('ascii').split('\r\n')
+    self.assertEqual(lines[0], 'HTTP/1.0 304 Not Modified')
+    self.assertIn('Connection: close', lines)
+    self.assertFalse(any(line.startswith('Content-Length') for line in lines))
+
+  def test_verify_is_middleware_passes_for_decorated_coro(self):
+    @asyncio.coroutine
+    def f(context, next):
+      yield from next
+    koa.core.verify_is_middleware(f)
 
   def test_verify_is_middleware_passes_for_decorated_func(self):
     @asyncio.coroutine
@@ -478,3 +2197,75 @@ class KoaAppTestCase(unittest.TestCase):
 
     test_session = KoaTestSession(app)
     test_session.run_async_test(test())
+
+
+# runs koa.serve() in a child process, since it forks & installs signal handlers
+class KoaServeTestCase(unittest.TestCase):
+
+  SCRIPT = textwrap.dedent("""
+    import asyncio, os, koa, koa.core
+
+    @asyncio.coroutine
+    def handle_get(koa_context, next):
+      koa_context.response.body = str(os.getpid())
+
+    app = koa.core.app()
+    app.use(handle_get)
+    koa.serve(app, host='127.0.0.1', port=8482, workers=2)
+  """)
+
+  # returns the pid of the worker that served the request, retrying while the server starts up
+  def get_worker_pid(self):
+    for attempt in range(50):
+      try:
+        with urllib.request.urlopen('http://127.0.0.1:8482/') as response:
+          return int(response.read())
+      except OSError:
+        time.sleep(0.1)
+    self.fail("server did not respond")
+
+  def test_serve_forks_and_restarts_workers(self):
+    master = subprocess.Popen([sys.executable, '-c', self.SCRIPT])
+    try:
+      worker_pid = self.get_worker_pid()
+      self.assertNotEqual(worker_pid, master.pid)
+
+      os.kill(worker_pid, signal.SIGKILL)
+      pids = set(self.get_worker_pid() for i in range(20))
+      self.assertNotIn(worker_pid, pids) # surviving or restarted workers serve the requests
+    finally:
+      master.terminate()
+      self.assertEqual(master.wait(10), 0)
+
+  def test_worker_supervisor_excludes_back_off_from_uptime(self):
+    # seconds each forked worker lives: the 1st dies right away, making the supervisor back
+    # off for a second, the 2nd lives through that back-off and must not count as a quick failure
+    lifetimes = [0, 1.3, 0.5]
+
+    class ScriptedSupervisor(koa.server.WorkerSupervisor):
+      def spawn_worker(self):
+        if len(lifetimes) == 0:
+          return
+        lifetime = lifetimes.pop(0)
+        pid = os.fork()
+        if pid == 0:
+          time.sleep(lifetime)
+          os._exit(0)
+        self.start_times[pid] = time.monotonic()
+
+    for signum in (signal.SIGINT, signal.SIGTERM):
+      self.addCleanup(signal.signal, signum, signal.getsignal(signum))
+    supervisor = ScriptedSupervisor(None, 2, None, 0, max_quick_failures=2)
+    self.assertEqual(supervisor.run(), 0)
+    self.assertEqual(supervisor.quick_failures, 1) # just the 3rd worker
+
+  def test_serve_gives_up_on_workers_failing_at_startup(self):
+    # with reuse_port each worker binds its own socket, which fails for a non-local address
+    script = self.SCRIPT.replace("host='127.0.0.1', port=8482, workers=2", "host='192.0.2.1', port=8483, workers=2, reuse_port=True, max_quick_failures=2")
+    master = subprocess.Popen([sys.executable, '-c', script], stderr=subprocess.PIPE)
+    try:
+      (_, stderr) = master.communicate(timeout=20)
+    finally:
+      master.kill() # no-op unless it timed out
+    self.assertEqual(master.returncode, 1)
+    self.assertIn(b'exited with status 1, giving up', stderr)